@@ -3,8 +3,12 @@
 from flask import Flask
 from flask_cors import CORS
 
+from .upload_spool import SpooledUploadRequest
+
 # 创建 Flask 应用
 app = Flask(__name__, template_folder='../templates', static_folder='../static')
+# /v1/files 上传的文件边接收边计算哈希，大文件缓冲到磁盘（其它接口不受影响）
+app.request_class = SpooledUploadRequest
 CORS(app)
 
 # 延迟导入，避免循环依赖
@@ -173,5 +177,33 @@ def init_app():
     except Exception as e:
         print(f"[健康检查] 启动失败: {e}")
     
+    # 启动 JWT 预刷新（启动时并发预热所有可用账号，之后在过期前提前刷新）
+    try:
+        from .account_manager import account_manager
+        if account_manager.config is None:
+            account_manager.load_config()
+        if (account_manager.config or {}).get("jwt_prerefresh_enabled", True):
+            from .jwt_refresher import start_jwt_refresher
+            start_jwt_refresher(account_manager)
+    except Exception as e:
+        print(f"[JWT预刷新] 启动失败: {e}")
+    
+    # 加载媒体缓存索引（扫描内容寻址目录，迁移旧版平铺缓存文件），并启动后台过期清理
+    try:
+        from .media_cache import image_cache, video_cache
+        from .cache_janitor import cache_janitor
+        image_cache.load()
+        video_cache.load()
+        cache_janitor.start()
+    except Exception as e:
+        print(f"[媒体缓存] 加载失败: {e}")
+    
+    # 启动会话池后台补充（为近期活跃账号预创建空闲会话）
+    try:
+        from .session_pool import session_pool
+        session_pool.start()
+    except Exception as e:
+        print(f"[会话池] 启动失败: {e}")
+    
     return app, socketio
 
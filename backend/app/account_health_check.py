@@ -83,7 +83,7 @@ def test_single_account(account_manager, account_idx: int, auto_delete: bool = F
     
     try:
         # 尝试获取 JWT
-        jwt = get_jwt_for_account(account, proxy)
+        jwt = get_jwt_for_account(account, proxy, use_cache=False)
         print(f"[健康检查] 账号 {account_idx} ({team_id}): ✓ 连接正常")
         
         # 确保账号标记为可用
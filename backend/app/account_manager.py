@@ -377,6 +377,17 @@ class AccountManager:
             with open(CONFIG_FILE, "w", encoding="utf-8") as f:
                 json.dump(self.config, f, indent=4, ensure_ascii=False)
     
+    def _drop_account_sessions(self, index: int):
+        """账号冷却或不可用后，丢弃会话池中预创建的会话和该账号的上传去重缓存"""
+        # 使用延迟导入避免循环导入
+        import sys
+        session_pool_module = sys.modules.get('app.session_pool')
+        if session_pool_module is not None:
+            session_pool_module.session_pool.discard(index)
+        file_manager_module = sys.modules.get('app.file_manager')
+        if file_manager_module is not None:
+            file_manager_module.upload_cache.invalidate_account(index)
+    
     def mark_account_unavailable(self, index: int, reason: str = ""):
         """标记账号不可用"""
         need_save = False
@@ -400,6 +411,7 @@ class AccountManager:
         # 在释放锁后保存配置，避免阻塞
         if need_save:
             self.save_config()
+            self._drop_account_sessions(index)
         
         # 如果检测到 Cookie 过期且自动刷新已启用，立即触发刷新检查
         if cookie_expired:
@@ -460,6 +472,7 @@ class AccountManager:
             quota_type: 配额类型（"images", "videos", "text_queries"），如果为 None 则冷却整个账号
         """
         need_save = False
+        discard_sessions = False
         with self.lock:
             if 0 <= index < len(self.accounts):
                 now_ts = time.time()
@@ -536,6 +549,7 @@ class AccountManager:
                     state["jwt"] = None
                     state["jwt_time"] = 0
                     state["session"] = None
+                    discard_sessions = True
 
                     # 在配置中记录冷却信息，便于前端展示
                     self.accounts[index]["cooldown_until"] = until
@@ -562,6 +576,8 @@ class AccountManager:
         # 在释放锁后保存配置，避免阻塞
         if need_save:
             self.save_config()
+        if discard_sessions:
+            self._drop_account_sessions(index)
     
     def _is_quota_type_in_cooldown(self, index: int, quota_type: str, now_ts: Optional[float] = None) -> bool:
         """检查账号的特定配额类型是否处于冷却期"""
@@ -607,6 +623,7 @@ class AccountManager:
         # 在释放锁后保存配置，避免阻塞
         if need_save:
             self.save_config()
+            self._drop_account_sessions(index)
 
     def _is_in_cooldown(self, index: int, now_ts: Optional[float] = None) -> bool:
         """检查账号是否处于冷却期"""
@@ -285,7 +285,9 @@ def get_api_key_stats(key_id: int, days: int = 30) -> Dict:
         # 统计
         total_calls = len(logs)
         success_calls = len([log for log in logs if log.status == "success"])
-        error_calls = total_calls - success_calls
+        # 客户端主动断开的流式请求单独统计，不计入错误
+        cancelled_calls = len([log for log in logs if log.status == "cancelled"])
+        error_calls = total_calls - success_calls - cancelled_calls
         
         # 计算平均响应时间
         response_times = [log.response_time for log in logs if log.response_time]
@@ -296,10 +298,12 @@ def get_api_key_stats(key_id: int, days: int = 30) -> Dict:
         for log in logs:
             model = log.model or "unknown"
             if model not in model_stats:
-                model_stats[model] = {"total": 0, "success": 0, "error": 0}
+                model_stats[model] = {"total": 0, "success": 0, "error": 0, "cancelled": 0}
             model_stats[model]["total"] += 1
             if log.status == "success":
                 model_stats[model]["success"] += 1
+            elif log.status == "cancelled":
+                model_stats[model]["cancelled"] += 1
             else:
                 model_stats[model]["error"] += 1
         
@@ -309,6 +313,7 @@ def get_api_key_stats(key_id: int, days: int = 30) -> Dict:
             "total_calls": total_calls,
             "success_calls": success_calls,
             "error_calls": error_calls,
+            "cancelled_calls": cancelled_calls,
             "success_rate": (success_calls / total_calls * 100) if total_calls > 0 else 0,
             "avg_response_time": round(avg_response_time, 2),
             "model_stats": model_stats,
@@ -0,0 +1,104 @@
+"""缓存清理模块 - 后台线程按过期堆删除到期的图片/视频缓存，不再在请求路径上扫描目录"""
+
+import threading
+import time
+from typing import List, Optional
+
+from .media_cache import MediaCache, image_cache, video_cache
+
+# 每批最多删除的文件数，批次之间释放缓存锁
+_BATCH_SIZE = 200
+# 没有到期文件时的最长等待时间（秒）
+_IDLE_SCAN_SECONDS = 60
+
+
+class CacheJanitor:
+    """媒体缓存清理任务
+
+    保存文件时 MediaCache 会把到期时间写入最小堆（启动时一次性重建），
+    清理线程睡眠到最早的到期时间，然后分批删除到期文件。
+    """
+
+    def __init__(self, caches: List[MediaCache]):
+        self._caches = caches
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._stats = {"sweeps": 0, "files_reclaimed": 0, "bytes_reclaimed": 0,
+                       "last_sweep_ms": None, "max_sweep_ms": 0.0, "last_sweep_time": None}
+
+    def _sweep(self) -> int:
+        """删除所有已到期文件，返回删除数量"""
+        from .logger import print
+
+        start_time = time.time()
+        total_files = 0
+        total_bytes = 0
+        for cache in self._caches:
+            cache_files = 0
+            while not self._stop_event.is_set():
+                files, reclaimed = cache.expire_due(_BATCH_SIZE)
+                cache_files += files
+                total_bytes += reclaimed
+                if files < _BATCH_SIZE:
+                    break
+            if cache_files:
+                print(f"[清理] 已删除 {cache_files} 个过期{cache.label}缓存文件")
+            total_files += cache_files
+
+        elapsed_ms = (time.time() - start_time) * 1000
+        with self._lock:
+            self._stats["sweeps"] += 1
+            self._stats["files_reclaimed"] += total_files
+            self._stats["bytes_reclaimed"] += total_bytes
+            self._stats["last_sweep_ms"] = round(elapsed_ms, 2)
+            self._stats["max_sweep_ms"] = round(max(self._stats["max_sweep_ms"], elapsed_ms), 2)
+            self._stats["last_sweep_time"] = start_time
+        return total_files
+
+    def _seconds_until_next(self) -> float:
+        expiries = [t for t in (cache.next_expiry() for cache in self._caches) if t is not None]
+        if not expiries:
+            return _IDLE_SCAN_SECONDS
+        return min(_IDLE_SCAN_SECONDS, max(0.0, min(expiries) - time.time()))
+
+    def _loop(self):
+        from .logger import print
+
+        print("[清理] 缓存清理后台任务已启动")
+        while not self._stop_event.is_set():
+            try:
+                wait_seconds = self._seconds_until_next()
+                if wait_seconds <= 0:
+                    self._sweep()
+                    continue
+            except Exception as e:
+                print(f"[清理] 缓存清理出错: {e}")
+                wait_seconds = _IDLE_SCAN_SECONDS
+            # 到期时间精确到秒即可，避免频繁唤醒
+            self._stop_event.wait(max(1.0, wait_seconds))
+        print("[清理] 缓存清理后台任务已停止")
+
+    def get_stats(self) -> dict:
+        """获取清理统计信息"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats["running"] = bool(self._thread and self._thread.is_alive())
+        stats["index_rebuild_ms"] = {cache.label: cache.get_stats()["load_ms"] for cache in self._caches}
+        return stats
+
+    def start(self):
+        """启动后台清理任务"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止后台清理任务"""
+        self._stop_event.set()
+
+
+# 全局清理任务实例
+cache_janitor = CacheJanitor([image_cache, video_cache])
@@ -1,10 +1,54 @@
 """cfbed 上传模块 - 将生成的图片/视频上传到 cfbed 服务"""
 
 import base64
+import uuid
 import requests
 from typing import Optional, Dict
 
 from .config import MEDIA_STREAM_CHUNK_SIZE
+from .http_client import StreamingBody, http_client_registry
+from .deadline import Deadline
+
+# cfbed 上传在客户端注册表中使用的键（与账号无关，所有上传共用同一个连接池）
+_CFBED_CLIENT_KEY = "cfbed"
+
+
+def _build_upload_url(
+    endpoint: str,
+    api_token: str,
+    upload_channel: str = "telegram",
+    server_compress: bool = True,
+    auto_retry: bool = True,
+    upload_name_type: str = "default",
+    return_format: str = "default",
+    upload_folder: Optional[str] = None
+) -> str:
+    """构建带查询参数的 cfbed 上传 URL"""
+    # 构建查询参数
+    params = {
+        "authCode": api_token,
+        "uploadChannel": upload_channel,
+        "serverCompress": str(server_compress).lower(),
+        "autoRetry": str(auto_retry).lower(),
+        "uploadNameType": upload_name_type,
+        "returnFormat": return_format,
+    }
+    if upload_folder:
+        params["uploadFolder"] = upload_folder
+    
+    # 构建完整 URL
+    return f"{endpoint}?{'&'.join(f'{k}={v}' for k, v in params.items())}"
+
+
+def _parse_upload_response(resp: requests.Response) -> Dict[str, str]:
+    """解析 cfbed 上传响应"""
+    data = resp.json()
+    
+    # cfbed 返回格式: [{ src: "/file/abc123_image.jpg" }]
+    if isinstance(data, list) and len(data) > 0 and data[0].get("src"):
+        return data[0]
+    
+    raise ValueError(f"Invalid response format from cfbed: {data}")
 
 
 def upload_to_cfbed(
@@ -19,7 +63,8 @@ def upload_to_cfbed(
     upload_name_type: str = "default",
     return_format: str = "default",
     upload_folder: Optional[str] = None,
-    proxy: Optional[str] = None
+    proxy: Optional[str] = None,
+    deadline: Optional[Deadline] = None
 ) -> Dict[str, str]:
     """上传文件到 cfbed 服务
     
@@ -36,6 +81,7 @@ def upload_to_cfbed(
         return_format: 返回链接格式 (default/full)
         upload_folder: 上传目录（相对路径）
         proxy: HTTP 代理（可选）
+        deadline: 时间预算（可选），连接/读写超时不超过其数据间隔预算和剩余时间
     
     Returns:
         {"src": "/file/abc123_image.jpg"} - src 字段包含文件路径（不包含域名）
@@ -43,45 +89,23 @@ def upload_to_cfbed(
     Raises:
         Exception: 上传失败时抛出异常
     """
-    # 构建查询参数
-    params = {
-        "authCode": api_token,
-        "uploadChannel": upload_channel,
-        "serverCompress": str(server_compress).lower(),
-        "autoRetry": str(auto_retry).lower(),
-        "uploadNameType": upload_name_type,
-        "returnFormat": return_format,
-    }
-    if upload_folder:
-        params["uploadFolder"] = upload_folder
-    
-    # 构建完整 URL
-    url = f"{endpoint}?{'&'.join(f'{k}={v}' for k, v in params.items())}"
+    url = _build_upload_url(endpoint, api_token, upload_channel, server_compress, auto_retry,
+                            upload_name_type, return_format, upload_folder)
     
     # 准备文件上传
     files = {
         "file": (filename, file_data, mime_type)
     }
     
-    proxies = {"http": proxy, "https": proxy} if proxy else None
-    
     try:
-        resp = requests.post(
+        resp = http_client_registry.get(proxy, _CFBED_CLIENT_KEY).post(
             url,
             files=files,
-            proxies=proxies,
             verify=False,
-            timeout=300  # 5分钟超时，适合大文件
+            timeout=deadline.timeout("idle") if deadline else 300  # 5分钟超时，适合大文件
         )
         resp.raise_for_status()
-        
-        data = resp.json()
-        
-        # cfbed 返回格式: [{ src: "/file/abc123_image.jpg" }]
-        if isinstance(data, list) and len(data) > 0 and data[0].get("src"):
-            return data[0]
-        
-        raise ValueError(f"Invalid response format from cfbed: {data}")
+        return _parse_upload_response(resp)
     except requests.RequestException as e:
         raise Exception(f"cfbed 上传失败: {e}") from e
 
@@ -92,7 +116,8 @@ def upload_base64_to_cfbed(
     mime_type: str,
     endpoint: str,
     api_token: str,
-    proxy: Optional[str] = None
+    proxy: Optional[str] = None,
+    deadline: Optional[Deadline] = None
 ) -> Dict[str, str]:
     """从 base64 数据上传文件到 cfbed
     
@@ -103,6 +128,7 @@ def upload_base64_to_cfbed(
         endpoint: cfbed 上传端点
         api_token: cfbed API Token
         proxy: HTTP 代理（可选）
+        deadline: 时间预算（可选）
     
     Returns:
         {"src": "/file/abc123_image.jpg"}
@@ -119,7 +145,8 @@ def upload_base64_to_cfbed(
         mime_type=mime_type,
         endpoint=endpoint,
         api_token=api_token,
-        proxy=proxy
+        proxy=proxy,
+        deadline=deadline
     )
 
 
@@ -129,10 +156,13 @@ def upload_file_streaming_to_cfbed(
     mime_type: str,
     endpoint: str,
     api_token: str,
-    proxy: Optional[str] = None
+    proxy: Optional[str] = None,
+    deadline: Optional[Deadline] = None
 ) -> Dict[str, str]:
     """流式上传文件到 cfbed（适合大文件）
     
+    边从 file_stream 读取边写入上传请求，不在内存中缓存完整文件。
+    
     Args:
         file_stream: requests.Response 对象（支持 iter_content）
         filename: 文件名
@@ -140,27 +170,53 @@ def upload_file_streaming_to_cfbed(
         endpoint: cfbed 上传端点
         api_token: cfbed API Token
         proxy: HTTP 代理（可选）
+        deadline: 时间预算（可选），每读取一块下载数据记录一次进度；下载由调用方登记到超时检查线程
     
     Returns:
         {"src": "/file/abc123_image.jpg"}
     """
-    # 对于流式上传，我们需要先读取到内存
-    # 注意：cfbed 的 API 需要完整的文件数据，所以这里还是需要读取完整内容
-    # 但我们可以使用 iter_content 来避免一次性加载到内存
-    chunks = []
-    for chunk in file_stream.iter_content(chunk_size=MEDIA_STREAM_CHUNK_SIZE):
-        if chunk:
-            chunks.append(chunk)
+    url = _build_upload_url(endpoint, api_token)
     
-    # 合并所有块
-    file_data = b"".join(chunks)
+    # 手工构造 multipart/form-data：头部、下载流的各个块、尾部依次写入 socket，内存占用与文件大小无关
+    boundary = f"----cfbed{uuid.uuid4().hex}"
+    safe_filename = filename.replace('"', "_").replace("\r", "_").replace("\n", "_")
+    head = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="file"; filename="{safe_filename}"\r\n'
+        f"Content-Type: {mime_type}\r\n\r\n"
+    ).encode("utf-8")
+    tail = f"\r\n--{boundary}--\r\n".encode("utf-8")
     
-    return upload_to_cfbed(
-        file_data=file_data,
-        filename=filename,
-        mime_type=mime_type,
-        endpoint=endpoint,
-        api_token=api_token,
-        proxy=proxy
-    )
-
+    def iter_multipart():
+        yield head
+        for chunk in file_stream.iter_content(chunk_size=MEDIA_STREAM_CHUNK_SIZE):
+            if chunk:
+                if deadline:
+                    deadline.touch()
+                yield chunk
+        if deadline:
+            # 下载被超时检查线程关闭时读取可能直接结束，不能上传不完整的文件
+            deadline.raise_if_expired()
+        yield tail
+    
+    # 下载未经压缩且声明了长度时可以给出准确的 Content-Length，否则使用分块传输编码
+    content_length = None
+    headers = getattr(file_stream, "headers", None) or {}
+    if headers.get("Content-Length", "").isdigit() and headers.get("Content-Encoding", "identity") in ("", "identity"):
+        content_length = len(head) + int(headers["Content-Length"]) + len(tail)
+    body = StreamingBody(iter_multipart(), content_length)
+    
+    try:
+        resp = http_client_registry.get(proxy, _CFBED_CLIENT_KEY).post(
+            url,
+            data=body,
+            headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+            verify=False,
+            timeout=deadline.timeout("idle") if deadline else 300  # 5分钟超时，适合大文件
+        )
+        resp.raise_for_status()
+        return _parse_upload_response(resp)
+    except requests.RequestException as e:
+        raise Exception(f"cfbed 上传失败: {e}") from e
+    finally:
+        file_stream.close()
@@ -2,65 +2,114 @@
 包含流式聊天、响应解析、OpenAI格式转换等功能
 """
 
+import codecs
 import json
 import base64
+import threading
+import time
 import uuid
 import requests
-from typing import List, Optional, Dict, Any, Generator
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Optional, Dict, Any, Generator, Tuple
 
 from app.models import ChatResponse, ChatImage
-from app.config import STREAM_ASSIST_URL, IMAGE_CACHE_DIR, VIDEO_CACHE_DIR
+from app.config import (
+    STREAM_ASSIST_URL, MEDIA_STREAM_CHUNK_SIZE,
+    MEDIA_PIPELINE_WORKERS, MEDIA_IMAGE_TIMEOUT_SECONDS, MEDIA_VIDEO_TIMEOUT_SECONDS
+)
 from app.session_manager import get_headers
+from app.http_client import get_http_client, abort_response
 from app.utils import raise_for_account_response
 from app.exceptions import AccountRequestError
+from app.deadline import Deadline, deadline_watchdog, is_timeout, timeout_error
 from app.media_handler import (
     get_extension_for_mime,
     save_image_to_cache,
     save_video_to_cache,
     get_session_file_metadata,
     build_download_url,
-    download_file_with_jwt,
-    download_file_streaming
+    download_file_streaming,
+    download_image_to_cache
 )
+from app.media_cache import image_cache, video_cache
 from app.cfbed_upload import upload_base64_to_cfbed, upload_file_streaming_to_cfbed
+from app.sse import ChatChunkEncoder
 from .logger import print
 
 # account_manager 需要通过参数传递或导入
 # 为了避免循环引用，这里先不导入，通过参数传递
 
+# 生成图片/视频的下载、缓存、上传任务共享的有界线程池
+_media_executor = ThreadPoolExecutor(max_workers=MEDIA_PIPELINE_WORKERS, thread_name_prefix="media")
+
 
 # ---------- JSON 流式解析器 (参考 j.py) ----------
 class JSONStreamParser:
     """
     处理 Google 返回的非标准/分块 JSON 流。
     能够处理被截断的 JSON 对象，实现真正的流式解析。
+
+    解析位置用游标记录，已解析的部分超过缓冲区一半时才压缩缓冲区，避免每解析一个对象就复制剩余数据；
+    未完成的对象/数组在收到可能的结束符（} 或 ]）之前不会重复尝试解析，
+    大对象（如内联 base64 图片）的解析总耗时与数据量成线性关系。
     """
+    # 数组开始、分隔符、数组结束以及空白
+    _SEPARATORS = frozenset(" \t\r\n,[]")
+
     def __init__(self):
         self.buffer = ""
+        self.pos = 0
         self.decoder = json.JSONDecoder()
+        self._pending: List[str] = []  # 等待结束符期间收到的数据，稍后一次性拼接
+        self._waiting_close = False
 
     def decode(self, chunk: str) -> List[dict]:
         """解析分块 JSON 数据，返回完整的 JSON 对象列表"""
-        self.buffer += chunk
+        if not chunk:
+            return []
+        if self._waiting_close and "}" not in chunk and "]" not in chunk:
+            # 当前对象不可能在这个 chunk 中结束，直接等待更多数据
+            self._pending.append(chunk)
+            return []
+        self._waiting_close = False
+        if self._pending:
+            self._pending.append(chunk)
+            chunk = "".join(self._pending)
+            self._pending.clear()
+
+        buffer, pos = self.buffer, self.pos
+        if pos >= len(buffer):
+            # 上次的数据已全部解析（最常见的情况），新数据直接作为缓冲区
+            buffer, pos = chunk, 0
+        elif pos * 2 > len(buffer):
+            # 已解析的部分超过一半时才丢弃，压缩的总开销与数据量成线性关系
+            buffer, pos = buffer[pos:] + chunk, 0
+        else:
+            buffer += chunk
+
+        separators = self._SEPARATORS
+        end = len(buffer)
+        # 最后一个可能的结束符之后开始的对象/数组一定不完整，无需尝试解析（省去一次失败的解析和异常）
+        last_close = max(buffer.rfind("}"), buffer.rfind("]"))
         results = []
         while True:
-            self.buffer = self.buffer.lstrip()  # 去除头部空白
-            # 尝试跳过数组开始的 [ 或分隔符 ,
-            if self.buffer.startswith("[") or self.buffer.startswith(","):
-                self.buffer = self.buffer[1:]
-                continue
-            
-            if not self.buffer:
+            # 跳过空白、数组的 [ ] 和分隔符 ,
+            while pos < end and buffer[pos] in separators:
+                pos += 1
+            if pos >= end:
+                break
+            if pos > last_close and buffer[pos] in "{[":
+                self._waiting_close = True
                 break
-
             try:
                 # 尝试解析一个完整的 JSON 对象
-                obj, idx = self.decoder.raw_decode(self.buffer)
-                results.append(obj)
-                self.buffer = self.buffer[idx:]
+                obj, pos = self.decoder.raw_decode(buffer, pos)
             except json.JSONDecodeError:
                 # 缓冲区数据不完整，等待下一个 chunk
+                self._waiting_close = buffer[pos] in "{["
                 break
+            results.append(obj)
+        self.buffer, self.pos = buffer, pos
         return results
 
 
@@ -94,16 +143,270 @@ def get_tools_spec_for_model(model_id: Optional[str]) -> Dict[str, Any]:
     }
 
 
+class UpstreamStreamHandle:
+    """上游流式请求句柄：允许其他线程关闭尚未结束的上游响应（如对冲请求中落败的一方）"""
+
+    def __init__(self):
+        self.response = None
+        self.cancelled = False
+        self._lock = threading.Lock()
+
+    def attach(self, resp):
+        """登记上游响应；若已被取消则立即关闭并抛出异常"""
+        with self._lock:
+            self.response = resp
+            cancelled = self.cancelled
+        if cancelled:
+            resp.close()
+            raise AccountRequestError("上游请求已取消")
+
+    def cancel(self):
+        """取消请求并关闭上游连接（可重复调用）"""
+        with self._lock:
+            self.cancelled = True
+            resp = self.response
+        if resp is not None:
+            try:
+                abort_response(resp)
+            except Exception:
+                pass
+
+
+def iter_response_chunks(resp, deadline: Optional[Deadline] = None) -> Generator[bytes, None, None]:
+    """分块读取上游响应
+    
+    读取过程中的连接错误转换为 AccountRequestError，以便在首个对象之前失败时能够切换账号；
+    指定 deadline 时每收到数据块都会记录进度，响应因超时被关闭后抛出 AccountTimeoutError。
+    """
+    try:
+        for chunk in resp.iter_content(chunk_size=MEDIA_STREAM_CHUNK_SIZE):
+            if not chunk:
+                continue
+            if deadline:
+                deadline.touch()
+            yield chunk
+    except Exception as e:
+        # 超时检查线程关闭响应后，读取可能抛出各种连接/IO 异常
+        if deadline and deadline.expired_phase:
+            raise deadline.error(deadline.expired_phase) from e
+        if is_timeout(e):
+            phase = "idle" if deadline and deadline.last_activity is not None else "first_byte"
+            raise timeout_error("读取聊天响应", e, phase) from e
+        if isinstance(e, requests.RequestException):
+            raise AccountRequestError(f"读取聊天响应失败: {e}") from e
+        raise
+    # 响应被关闭时读取也可能直接结束
+    if deadline:
+        deadline.raise_if_expired()
+
+
+def iter_stream_json_objects(resp, deadline: Optional[Deadline] = None) -> Generator[dict, None, None]:
+    """分块读取上游流式响应，产出解析出的完整 JSON 对象
+    
+    直接按到达的数据块解析，不再按行切分（iter_lines 遇到几 MB 的单行 base64 时会反复拼接）。
+    """
+    parser = JSONStreamParser()
+    # 数据块可能在多字节字符中间截断，使用增量解码
+    utf8_decoder = codecs.getincrementaldecoder("utf-8")()
+    for chunk in iter_response_chunks(resp, deadline):
+        # 使用 JSONStreamParser 解析分块 JSON
+        for obj in parser.decode(utf8_decoder.decode(chunk)):
+            yield obj
+    for obj in parser.decode(utf8_decoder.decode(b"", final=True)):
+        yield obj
+
+
+def format_media_url_text(url: str, media_type: str, image_format: str) -> str:
+    """按客户端需要的格式输出图片/视频 URL（markdown 或纯 URL）"""
+    if image_format == "markdown":
+        return f"\n![{'video' if media_type == 'video' else 'image'}]({url})\n"
+    return f"\n{url}\n"
+
+
+def _process_stream_file(jwt: str, finfo: Dict, file_metadata: Dict, current_session: str, proxy: str,
+                         account_manager, account_idx: Optional[int],
+                         deadline: Optional[Deadline] = None) -> Optional[ChatImage]:
+    """下载单个生成的图片/视频，上传到图床或保存到本地缓存，返回媒体对象
+    
+    deadline 为该媒体自己的时间预算（见 _media_deadline）：超出时下载被关闭，工作线程随即释放。
+    """
+    fid = finfo["fileId"]
+    mime = finfo["mimeType"]
+    fname = finfo.get("fileName")
+    meta = file_metadata.get(fid)
+    
+    if meta:
+        fname = fname or meta.get("name")
+        mime = meta.get("mimeType", mime)
+        session_path = meta.get("session") or current_session
+    else:
+        session_path = current_session
+    
+    is_video = mime.startswith("video/")
+    media_type = "video" if is_video else "image"
+    upload_endpoint = account_manager.config.get("upload_endpoint", "").strip() if account_manager else ""
+    upload_api_token = account_manager.config.get("upload_api_token", "").strip() if account_manager else ""
+    
+    if upload_endpoint and upload_api_token:
+        url = build_download_url(session_path, fid)
+        # 下载响应由 with 关闭：raise_for_status 抛出异常时同样归还连接
+        with get_http_client(proxy, account_idx).get(
+            url,
+            headers=get_headers(jwt),
+            verify=False,
+            timeout=deadline.timeout("idle") if deadline else 600,
+            stream=True,
+            allow_redirects=True
+        ) as download_resp:
+            download_resp.raise_for_status()
+            if deadline:
+                deadline_watchdog.watch(deadline, download_resp)
+            try:
+                upload_result = upload_file_streaming_to_cfbed(
+                    file_stream=download_resp,
+                    filename=fname or (f"media_{uuid.uuid4().hex[:8]}{get_extension_for_mime(mime)}"),
+                    mime_type=mime,
+                    endpoint=upload_endpoint,
+                    api_token=upload_api_token,
+                    proxy=proxy,
+                    deadline=deadline
+                )
+            except Exception as e:
+                if deadline and deadline.expired_phase:
+                    raise deadline.error(deadline.expired_phase) from e
+                raise
+            finally:
+                deadline_watchdog.unwatch(download_resp)
+        
+        image_base_url = account_manager.config.get("image_base_url", "").strip() if account_manager else ""
+        if not image_base_url:
+            image_base_url = upload_endpoint.rstrip("/").replace("/upload", "")
+        full_url = f"{image_base_url.rstrip('/')}{upload_result['src']}"
+        
+        return ChatImage(
+            file_id=fid,
+            file_name=upload_result["src"].split("/")[-1],
+            mime_type=mime,
+            url=full_url,
+            media_type=media_type
+        )
+    
+    # 使用本地缓存
+    if is_video:
+        filename = download_file_streaming(jwt, session_path, fid, mime, fname, proxy, deadline=deadline,
+                                           account_idx=account_idx)
+    else:
+        filename = download_image_to_cache(jwt, session_path, fid, mime, fname, proxy, deadline=deadline,
+                                           account_idx=account_idx)
+    if not filename:
+        return None
+    
+    return ChatImage(
+        file_id=fid,
+        file_name=filename,
+        mime_type=mime,
+        local_path=str((video_cache if is_video else image_cache).path_for(filename)),
+        media_type=media_type
+    )
+
+
+def process_stream_files(jwt: str, current_session: str, team_id: str, proxy: str, file_ids_list: List[Dict],
+                         account_manager=None, account_idx: Optional[int] = None,
+                         deadline: Optional[Deadline] = None) -> Generator[ChatImage, None, None]:
+    """并发处理流式响应中通过 fileId 引用的图片/视频，按完成顺序产出媒体对象
+    
+    使用全局有界线程池；每个文件有独立的时间预算，超时的下载/上传会被中止，
+    失败或超时的文件只记录警告并跳过。流式和非流式响应共用。
+    """
+    try:
+        file_metadata = get_session_file_metadata(jwt, current_session, team_id, proxy, deadline=deadline,
+                                                  account_idx=account_idx)
+    except Exception as e:
+        print(f"[WARNING] 获取文件元数据失败: {e}")
+        file_metadata = {}
+    
+    futures = {}
+    for finfo in file_ids_list:
+        item_deadline = _media_deadline(deadline, finfo.get("mimeType"))
+        future = _media_executor.submit(_process_stream_file, jwt, finfo, file_metadata, current_session,
+                                        proxy, account_manager, account_idx, item_deadline)
+        futures[future] = (f"fileId={finfo['fileId']}", time.time() + item_deadline.remaining())
+    
+    yield from iter_completed_media(futures)
+
+
+def _media_timeout(mime_type: Optional[str]) -> float:
+    """单个媒体任务的超时时间"""
+    return MEDIA_VIDEO_TIMEOUT_SECONDS if (mime_type or "").startswith("video/") else MEDIA_IMAGE_TIMEOUT_SECONDS
+
+
+def _media_deadline(deadline: Optional[Deadline], mime_type: Optional[str]) -> Deadline:
+    """单个媒体任务的时间预算：从提交任务时开始计算，总时长为该媒体的超时时间
+    
+    与 iter_completed_media 放弃等待的时间一致；排队或下载/上传超出预算时任务自行中止，不会继续占用工作线程。
+    """
+    parent = deadline or Deadline("video" if (mime_type or "").startswith("video/") else "image")
+    return parent.child(_media_timeout(mime_type))
+
+
+def iter_completed_media(futures: Dict[Future, Tuple[str, float]], block: bool = True) -> Generator[Any, None, None]:
+    """按完成顺序产出媒体任务的结果，并从 futures 中移除已结束的任务
+    
+    Args:
+        futures: {Future: (描述, 截止时间)}
+        block: True 时等待所有任务完成或超时；False 时只取出当前已完成的任务
+    
+    失败或超时的任务只记录警告并跳过；调用方提前结束时取消尚未开始的任务。
+    已开始的任务无法取消，由各自的时间预算（_media_deadline）中止。
+    """
+    try:
+        while futures:
+            timeout = max(0, min(deadline for _, deadline in futures.values()) - time.time()) if block else 0
+            done, _ = wait(list(futures), timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                label, _ = futures.pop(future)
+                try:
+                    item = future.result()
+                except Exception as e:
+                    print(f"[WARNING] 处理媒体失败 {label}: {e}")
+                    continue
+                if item:
+                    yield item
+            
+            now = time.time()
+            for future in [f for f, (_, deadline) in futures.items() if deadline <= now]:
+                label, _ = futures.pop(future)
+                future.cancel()
+                print(f"[WARNING] 处理媒体超时 {label}，已跳过")
+            if not block:
+                break
+    except GeneratorExit:
+        for future in futures:
+            future.cancel()
+        raise
+
+
+def media_public_url(media: ChatImage, host_url: str, account_manager=None) -> str:
+    """媒体的访问 URL：图床 URL，或本地缓存的 /image、/video 路径"""
+    if media.url:
+        return media.url
+    base_url = get_image_base_url(host_url, account_manager, None)
+    return f"{base_url}{media.media_type}/{media.file_name}"
+
+
 def stream_chat_realtime_generator(jwt: str, sess_name: str, message: str, 
                                    proxy: str, team_id: str, file_ids: List[str] = None, 
                                    model_id: Optional[str] = None, account_manager=None, 
                                    account_idx: Optional[int] = None, quota_type: Optional[str] = None,
                                    chat_id: str = None, created: int = None, model_name: str = None,
-                                   host_url: str = None, image_format: str = "array") -> Generator[str, None, None]:
+                                   host_url: str = None, image_format: str = "array",
+                                   stream_handle: Optional[UpstreamStreamHandle] = None,
+                                   deadline: Optional[Deadline] = None) -> Generator[bytes, None, None]:
     """真正的流式处理：边接收边解析边转发
     
     这是一个生成器函数，实时解析 Gemini API 的流式响应并立即转发给客户端。
     同时收集图片/视频信息（因为需要下载，不能实时转发）。
+    第一次 yield 发生在收到上游首个 JSON 对象之后，调用方可先 next() 预读以确认请求成功。
     
     Args:
         jwt: JWT token
@@ -119,9 +422,11 @@ def stream_chat_realtime_generator(jwt: str, sess_name: str, message: str,
         chat_id: OpenAI 格式的聊天ID
         created: 创建时间戳
         model_name: 模型名称
+        stream_handle: 上游请求句柄（可选），用于从其他线程取消请求
+        deadline: 本次尝试的时间预算（可选），超出首字节/数据间隔/总时长时抛出 AccountTimeoutError
     
     Yields:
-        str: OpenAI 格式的 SSE 数据块（"data: {...}\n\n"）
+        bytes: OpenAI 格式的 SSE 数据块（"data: {...}\n\n"）
     
     Returns:
         ChatResponse: 包含图片/视频等媒体信息的响应对象
@@ -154,85 +459,108 @@ def stream_chat_realtime_generator(jwt: str, sess_name: str, message: str,
             "modelId": model_id
         }
     
-    proxies = {"http": proxy, "https": proxy} if proxy else None
-    
     # 初始化响应对象（用于收集图片/视频）
     result = ChatResponse()
     file_ids_list = []
     current_session = None
-    parser = JSONStreamParser()
-    
-    # 先发送 role 标记（降低首字延迟）
-    if chat_id and created is not None and model_name:
-        role_chunk = {
-            "id": chat_id,
-            "object": "chat.completion.chunk",
-            "created": created,
-            "model": model_name,
-            "choices": [{"index": 0, "delta": {"role": "assistant"}, "finish_reason": None}]
-        }
-        yield f"data: {json.dumps(role_chunk, ensure_ascii=False)}\n\n"
+    # 缺少 chat_id/created/model_name 时只收集结果，不产出数据块
+    encoder = ChatChunkEncoder(chat_id, created, model_name) if (chat_id and created is not None and model_name) else None
     
     try:
-        resp = requests.post(
+        resp = get_http_client(proxy, account_idx).post(
             STREAM_ASSIST_URL,
             headers=get_headers(jwt),
             json=body,
-            proxies=proxies,
             verify=False,
-            timeout=300,
+            timeout=deadline.timeout("stream") if deadline else 300,
             stream=True
         )
+    except requests.Timeout as e:
+        raise timeout_error("聊天请求", e) from e
     except requests.RequestException as e:
         raise AccountRequestError(f"聊天请求失败: {e}") from e
+    if stream_handle is not None:
+        stream_handle.attach(resp)
     
-    if resp.status_code != 200:
-        raise_for_account_response(resp, "聊天请求", account_idx, quota_type)
+    # role 标记在收到上游第一个 JSON 对象后才发送：调用方通过 next() 预读首个数据块，
+    # 在此之前发生的状态码错误、连接错误都会在重试循环中抛出，从而切换到下一个账号
+    role_sent = False
     
-    # ✅ 真正的流式处理：逐块读取并实时解析
-    buffer = ""
-    for line in resp.iter_lines():
-        if not line:
-            continue
-        
-        chunk_text = line.decode('utf-8')
-        buffer += chunk_text + "\n"
+    # 内联 base64 图片/视频的解码、保存、上传交给后台线程池，不阻塞文本转发: {Future: (描述, 截止时间)}
+    media_futures: Dict[Future, Tuple[str, float]] = {}
+    
+    try:
+        # 状态码检查放在 try 内：非 200 响应同样由 finally 关闭，连接归还连接池
+        if resp.status_code != 200:
+            raise_for_account_response(resp, "聊天请求", account_idx, quota_type)
+        if deadline:
+            deadline_watchdog.watch(deadline, resp)
+    
+        def submit_media(media_info: Optional[InlineMedia]):
+            if media_info:
+                b64_data, mime_type, suggested_name, source = media_info
+                item_deadline = _media_deadline(deadline, mime_type)
+                future = _media_executor.submit(save_base64_media, b64_data, mime_type, suggested_name, source,
+                                                proxy, account_manager, item_deadline)
+                media_futures[future] = (source, time.time() + item_deadline.remaining())
+    
+        def emit_media(media: ChatImage) -> Optional[bytes]:
+            """记录已就绪的媒体，返回其 URL 数据块"""
+            result.images.append(media)
+            if encoder is None:
+                return None
+            # ✅ 实时发送图片/视频 URL（根据客户端类型决定格式）
+            print(f"[流式图片] 使用格式: {image_format}")
+            media_url = media_public_url(media, host_url, account_manager)
+            return encoder.content(format_media_url_text(media_url, media.media_type, image_format))
+    
+        # ✅ 真正的流式处理：逐块读取并实时解析
+        for data in iter_stream_json_objects(resp, deadline):
+            if not role_sent:
+                role_sent = True
+                # 首个数据块交出后响应即提交给客户端，之后只按数据间隔限制，不再受总时长限制
+                if deadline:
+                    deadline.commit()
+                if encoder:
+                    yield encoder.role()
         
-        # 使用 JSONStreamParser 解析分块 JSON
-        json_objects = parser.decode(chunk_text)
+            # 发送已处理完成的内联媒体（不等待未完成的任务）
+            for media in iter_completed_media(media_futures, block=False):
+                media_chunk = emit_media(media)
+                if media_chunk:
+                    yield media_chunk
         
-        for data in json_objects:
             sar = data.get("streamAssistResponse")
             if not sar:
                 continue
-            
+        
             # 获取session信息
             session_info = sar.get("sessionInfo", {})
             if session_info.get("session"):
                 current_session = session_info["session"]
-            
-            # 检查顶层的generatedImages（图片需要下载，不能实时转发）
+        
+            # 检查顶层的generatedImages（图片需要解码保存，交给后台处理）
             for gen_img in sar.get("generatedImages", []):
-                parse_generated_media(gen_img, result, proxy, account_manager)
-            
+                submit_media(extract_generated_media(gen_img))
+        
             answer = sar.get("answer") or {}
-            
+        
             # 检查answer级别的generatedImages
             for gen_img in answer.get("generatedImages", []):
-                parse_generated_media(gen_img, result, proxy, account_manager)
-            
+                submit_media(extract_generated_media(gen_img))
+        
             # ✅ 实时处理文本回复（过滤思考输出）
             for reply in answer.get("replies", []):
                 # 检查reply级别的generatedImages
                 for gen_img in reply.get("generatedImages", []):
-                    parse_generated_media(gen_img, result, proxy, account_manager)
-                
+                    submit_media(extract_generated_media(gen_img))
+            
                 gc = reply.get("groundedContent", {})
                 content = gc.get("content", {})
                 text = content.get("text", "")
                 # ✅ 过滤思考输出
                 thought = content.get("thought", False)
-                
+            
                 # 检查file字段（图片生成的关键）
                 file_info = content.get("file")
                 if file_info and file_info.get("fileId"):
@@ -241,15 +569,15 @@ def stream_chat_realtime_generator(jwt: str, sess_name: str, message: str,
                         "mimeType": file_info.get("mimeType", "image/png"),
                         "fileName": file_info.get("name")
                     })
-                
-                # 解析图片数据（需要下载，不能实时转发）
-                parse_image_from_content(content, result, proxy, account_manager)
-                parse_image_from_content(gc, result, proxy, account_manager)
-                
+            
+                # 解析图片数据（交给后台处理，不阻塞文本转发）
+                submit_media(extract_inline_data(content))
+                submit_media(extract_inline_data(gc))
+            
                 # 检查attachments
                 for att in reply.get("attachments", []) + gc.get("attachments", []) + content.get("attachments", []):
-                    parse_attachment(att, result, proxy, account_manager)
-                
+                    submit_media(extract_attachment(att))
+            
                 # ✅ 只处理非思考输出，实时转发文本
                 if text and not thought:
                     # 过滤掉 "Image generated by Nano Banana Pro." 文本
@@ -258,190 +586,45 @@ def stream_chat_realtime_generator(jwt: str, sess_name: str, message: str,
                         lines = text.split('\n')
                         filtered_lines = [line for line in lines if "Image generated by Nano Banana Pro" not in line.strip()]
                         filtered_text = '\n'.join(filtered_lines).strip()
-                    
-                    if filtered_text and chat_id and created is not None and model_name:
-                        # 实时转发文本内容
-                        text_chunk = {
-                            "id": chat_id,
-                            "object": "chat.completion.chunk",
-                            "created": created,
-                            "model": model_name,
-                            "choices": [{"index": 0, "delta": {"content": filtered_text}, "finish_reason": None}]
-                        }
-                        yield f"data: {json.dumps(text_chunk, ensure_ascii=False)}\n\n"
-    
-    # 处理通过fileId引用的图片/视频（需要下载，在流式结束后处理）
-    if file_ids_list and current_session:
-        try:
-            upload_endpoint = account_manager.config.get("upload_endpoint", "").strip() if account_manager else ""
-            upload_api_token = account_manager.config.get("upload_api_token", "").strip() if account_manager else ""
-            use_cfbed = bool(upload_endpoint and upload_api_token)
-            
-            file_metadata = get_session_file_metadata(jwt, current_session, team_id, proxy)
-            for finfo in file_ids_list:
-                fid = finfo["fileId"]
-                mime = finfo["mimeType"]
-                fname = finfo.get("fileName")
-                meta = file_metadata.get(fid)
                 
-                if meta:
-                    fname = fname or meta.get("name")
-                    mime = meta.get("mimeType", mime)
-                    session_path = meta.get("session") or current_session
-                else:
-                    session_path = current_session
-                
-                try:
-                    is_video = mime.startswith("video/")
-                    
-                    if use_cfbed:
-                        url = build_download_url(session_path, fid)
-                        download_resp = requests.get(
-                            url,
-                            headers=get_headers(jwt),
-                            proxies={"http": proxy, "https": proxy} if proxy else None,
-                            verify=False,
-                            timeout=600,
-                            stream=True,
-                            allow_redirects=True
-                        )
-                        download_resp.raise_for_status()
-                        
-                        upload_result = upload_file_streaming_to_cfbed(
-                            file_stream=download_resp,
-                            filename=fname or (f"media_{uuid.uuid4().hex[:8]}{get_extension_for_mime(mime)}"),
-                            mime_type=mime,
-                            endpoint=upload_endpoint,
-                            api_token=upload_api_token,
-                            proxy=proxy
-                        )
-                        
-                        image_base_url = account_manager.config.get("image_base_url", "").strip() if account_manager else ""
-                        if not image_base_url:
-                            image_base_url = upload_endpoint.rstrip("/").replace("/upload", "")
-                        
-                        if not image_base_url.endswith("/"):
-                            image_base_url += "/"
-                        
-                        full_url = f"{image_base_url.rstrip('/')}{upload_result['src']}"
-                        
-                        img = ChatImage(
-                            file_id=fid,
-                            file_name=upload_result["src"].split("/")[-1],
-                            mime_type=mime,
-                            url=full_url,
-                            media_type="video" if is_video else "image"
-                        )
-                        result.images.append(img)
-                        
-                        # ✅ 实时发送图片 URL（根据客户端类型决定格式）
-                        if chat_id and created is not None and model_name:
-                            # 使用传入的图片格式参数
-                            print(f"[流式图片] 使用格式: {image_format}")
-                            if image_format == "markdown":
-                                image_url_text = f"\n![image]({full_url})\n"
-                            else:
-                                image_url_text = f"\n{full_url}\n"
-                            image_chunk = {
-                                "id": chat_id,
-                                "object": "chat.completion.chunk",
-                                "created": created,
-                                "model": model_name,
-                                "choices": [{
-                                    "index": 0,
-                                    "delta": {"content": image_url_text},
-                                    "finish_reason": None
-                                }]
-                            }
-                            yield f"data: {json.dumps(image_chunk, ensure_ascii=False)}\n\n"
-                    else:
-                        # 使用本地缓存
-                        if is_video:
-                            filename = download_file_streaming(jwt, session_path, fid, mime, fname, proxy, account_manager)
-                            if filename:
-                                video = ChatImage(
-                                    file_id=fid,
-                                    file_name=filename,
-                                    mime_type=mime,
-                                    media_type="video"
-                                )
-                                result.images.append(video)
-                                
-                                # ✅ 实时发送视频 URL（根据客户端类型决定格式）
-                                if chat_id and created is not None and model_name:
-                                    # 构建视频 URL
-                                    base_url = get_image_base_url(host_url, account_manager, None)
-                                    video_url = f"{base_url}video/{filename}"
-                                    # 使用传入的图片格式参数
-                                    if image_format == "markdown":
-                                        video_url_text = f"\n![video]({video_url})\n"
-                                    else:
-                                        video_url_text = f"\n{video_url}\n"
-                                    video_chunk = {
-                                        "id": chat_id,
-                                        "object": "chat.completion.chunk",
-                                        "created": created,
-                                        "model": model_name,
-                                        "choices": [{
-                                            "index": 0,
-                                            "delta": {"content": video_url_text},
-                                            "finish_reason": None
-                                        }]
-                                    }
-                                    yield f"data: {json.dumps(video_chunk, ensure_ascii=False)}\n\n"
-                        else:
-                            file_data = download_file_with_jwt(jwt, session_path, fid, proxy)
-                            if file_data:
-                                filename = save_image_to_cache(file_data, mime, fname)
-                                if filename:
-                                    img = ChatImage(
-                                        file_id=fid,
-                                        file_name=filename,
-                                        mime_type=mime,
-                                        media_type="image"
-                                    )
-                                    result.images.append(img)
-                                    
-                                    # ✅ 实时发送图片 URL（根据客户端类型决定格式）
-                                    if chat_id and created is not None and model_name:
-                                        # 构建图片 URL
-                                        base_url = get_image_base_url(host_url, account_manager, None)
-                                        image_url = f"{base_url}image/{filename}"
-                                        # 使用传入的图片格式参数
-                                        print(f"[流式图片-本地缓存] 使用格式: {image_format}")
-                                        if image_format == "markdown":
-                                            image_url_text = f"\n![image]({image_url})\n"
-                                        else:
-                                            image_url_text = f"\n{image_url}\n"
-                                        if image_format == "markdown":
-                                            image_url_text = f"\n![image]({image_url})\n"
-                                        else:
-                                            image_url_text = f"\n{image_url}\n"
-                                        image_chunk = {
-                                            "id": chat_id,
-                                            "object": "chat.completion.chunk",
-                                            "created": created,
-                                            "model": model_name,
-                                            "choices": [{
-                                                "index": 0,
-                                                "delta": {"content": image_url_text},
-                                                "finish_reason": None
-                                            }]
-                                        }
-                                        yield f"data: {json.dumps(image_chunk, ensure_ascii=False)}\n\n"
-                except Exception as e:
-                    print(f"[WARNING] 下载文件失败 {fid}: {e}")
-        except Exception as e:
-            print(f"[WARNING] 处理文件列表失败: {e}")
+                    if filtered_text and encoder:
+                        # 实时转发文本内容
+                        yield encoder.content(filtered_text)
     
-    # 流式模式下文本已实时转发，不需要返回 ChatResponse
-    # 图片/视频 URL 也已实时发送
-    pass
+        # 上游响应已读完，之后等待媒体处理的时间不计入数据间隔/总时长
+        deadline_watchdog.unwatch(resp)
+        
+        # 上游没有返回任何对象时也要保证 role 标记已发送
+        if not role_sent and encoder:
+            yield encoder.role()
+    
+        # 文本结束后等待剩余的内联媒体（单个失败或超时不影响其他媒体）
+        for media in iter_completed_media(media_futures):
+            media_chunk = emit_media(media)
+            if media_chunk:
+                yield media_chunk
+
+        # 处理通过fileId引用的图片/视频（需要下载，在流式结束后处理）
+        # 所有文件并发下载/上传，哪个先完成就先发送哪个，单个文件失败或超时不影响其他文件
+        if file_ids_list and current_session:
+            for media in process_stream_files(jwt, current_session, team_id, proxy, file_ids_list,
+                                              account_manager, account_idx, deadline):
+                media_chunk = emit_media(media)
+                if media_chunk:
+                    yield media_chunk
+    finally:
+        # 正常结束时已没有未完成的任务；客户端断开（生成器被 close）或出错时，
+        # 放弃尚未开始的媒体任务并立即关闭上游连接，不再等待 Gemini 生成完毕
+        for future in media_futures:
+            future.cancel()
+        deadline_watchdog.unwatch(resp)
+        resp.close()
 
 
 def stream_chat_with_images(jwt: str, sess_name: str, message: str, 
                             proxy: str, team_id: str, file_ids: List[str] = None, 
-                            model_id: Optional[str] = None, account_manager=None, account_idx: Optional[int] = None, quota_type: Optional[str] = None) -> ChatResponse:
+                            model_id: Optional[str] = None, account_manager=None, account_idx: Optional[int] = None, quota_type: Optional[str] = None,
+                            deadline: Optional[Deadline] = None) -> ChatResponse:
     """发送消息并流式接收响应
     
     Args:
@@ -453,6 +636,7 @@ def stream_chat_with_images(jwt: str, sess_name: str, message: str,
         file_ids: 文件ID列表
         model_id: 模型ID（可选）
         account_manager: AccountManager实例（用于访问配置）
+        deadline: 本次尝试的时间预算（可选）
     """
     query_parts = [{"text": message}]
     request_file_ids = file_ids if file_ids else []
@@ -521,19 +705,19 @@ def stream_chat_with_images(jwt: str, sess_name: str, message: str,
     # else:
     #     print(f"[DEBUG][stream_chat_with_images] 消息内容(前100字符): {message[:100]}...")
 
-    proxies = {"http": proxy, "https": proxy} if proxy else None
     try:
         # 增加超时时间，避免长时间请求导致 504 错误
         # 对于流式响应，需要更长的超时时间
-        resp = requests.post(
+        resp = get_http_client(proxy, account_idx).post(
             STREAM_ASSIST_URL,
             headers=get_headers(jwt),
             json=body,
-            proxies=proxies,
             verify=False,
-            timeout=300,  # 增加到 5 分钟，避免超时
+            timeout=deadline.timeout("stream") if deadline else 300,  # 未指定时间预算时使用 5 分钟，避免超时
             stream=True
         )
+    except requests.Timeout as e:
+        raise timeout_error("聊天请求", e) from e
     except requests.RequestException as e:
         raise AccountRequestError(f"聊天请求失败: {e}") from e
 
@@ -545,17 +729,23 @@ def stream_chat_with_images(jwt: str, sess_name: str, message: str,
             print(f"[ERROR][stream_chat_with_images] Session: {sess_name}")
             print(f"[ERROR][stream_chat_with_images] Team ID: {team_id}")
             print(f"[ERROR][stream_chat_with_images] Model ID: {model_id}")
-        raise_for_account_response(resp, "聊天请求", account_idx, quota_type)
+        try:
+            raise_for_account_response(resp, "聊天请求", account_idx, quota_type)
+        finally:
+            resp.close()
 
     # ⚠️ 注意：当前实现不是真正的流式
     # 这里是先收集完整响应，然后才解析，最后在 routes.py 中再分块发送
     # 要实现真正的流式（边接收边解析边转发），需要参考 j.py 的实现方式
     # 使用 JSONStreamParser 实时解析分块 JSON，并立即转发给客户端
     # 收集完整响应
-    full_response = ""
-    for line in resp.iter_lines():
-        if line:
-            full_response += line.decode('utf-8') + "\n"
+    if deadline:
+        deadline_watchdog.watch(deadline, resp)
+    try:
+        full_response = b"".join(iter_response_chunks(resp, deadline))
+    finally:
+        deadline_watchdog.unwatch(resp)
+        resp.close()
 
     # 解析响应
     result = ChatResponse()
@@ -627,107 +817,15 @@ def stream_chat_with_images(jwt: str, sess_name: str, message: str,
                     if filtered_text:
                         texts.append(filtered_text)
         
-        # 处理通过fileId引用的图片/视频
+        # 处理通过fileId引用的图片/视频（与流式响应相同，所有文件并发下载/上传，单个失败或超时不影响其他文件）
         if file_ids_list and current_session:
-            try:
-                # 检查是否配置了 cfbed
-                upload_endpoint = account_manager.config.get("upload_endpoint", "").strip() if account_manager else ""
-                upload_api_token = account_manager.config.get("upload_api_token", "").strip() if account_manager else ""
-                use_cfbed = bool(upload_endpoint and upload_api_token)
-                
-                file_metadata = get_session_file_metadata(jwt, current_session, team_id, proxy)
-                for finfo in file_ids_list:
-                    fid = finfo["fileId"]
-                    mime = finfo["mimeType"]
-                    fname = finfo.get("fileName")
-                    meta = file_metadata.get(fid)
-                    
-                    if meta:
-                        fname = fname or meta.get("name")
-                        mime = meta.get("mimeType", mime)
-                        session_path = meta.get("session") or current_session
-                    else:
-                        session_path = current_session
-                    
-                    try:
-                        is_video = mime.startswith("video/")
-                        
-                        if use_cfbed:
-                            # 使用 cfbed 上传
-                            print(f"[cfbed] 开始上传 {'视频' if is_video else '图片'}: {fname or fid}")
-                            
-                            # 流式下载文件
-                            url = build_download_url(session_path, fid)
-                            download_resp = requests.get(
-                                url,
-                                headers=get_headers(jwt),
-                                proxies={"http": proxy, "https": proxy} if proxy else None,
-                                verify=False,
-                                timeout=600,
-                                stream=True,
-                                allow_redirects=True
-                            )
-                            download_resp.raise_for_status()
-                            
-                            # 上传到 cfbed
-                            upload_result = upload_file_streaming_to_cfbed(
-                                file_stream=download_resp,
-                                filename=fname or (f"media_{uuid.uuid4().hex[:8]}{get_extension_for_mime(mime)}"),
-                                mime_type=mime,
-                                endpoint=upload_endpoint,
-                                api_token=upload_api_token,
-                                proxy=proxy
-                            )
-                            
-                            # 构建完整 URL
-                            image_base_url = account_manager.config.get("image_base_url", "").strip() if account_manager else ""
-                            if not image_base_url:
-                                # 从 upload_endpoint 推断（去掉 /upload）
-                                image_base_url = upload_endpoint.rstrip("/").replace("/upload", "")
-                            
-                            if not image_base_url.endswith("/"):
-                                image_base_url += "/"
-                            
-                            # upload_result["src"] 格式: "/file/abc123_image.jpg"
-                            full_url = f"{image_base_url.rstrip('/')}{upload_result['src']}"
-                            
-                            img = ChatImage(
-                                file_id=fid,
-                                file_name=upload_result["src"].split("/")[-1],  # 只保留文件名
-                                mime_type=mime,
-                                url=full_url,  # 公网 URL
-                                media_type="video" if is_video else "image"
-                            )
-                            result.images.append(img)
-                            print(f"[cfbed] 上传成功: {full_url}")
-                        else:
-                            # 本地缓存
-                            if is_video:
-                                filename = download_file_streaming(jwt, session_path, fid, mime, fname, proxy)
-                                local_path = VIDEO_CACHE_DIR / filename
-                                media_type = "video"
-                            else:
-                                image_data = download_file_with_jwt(jwt, session_path, fid, proxy)
-                                filename = save_image_to_cache(image_data, mime, fname)
-                                local_path = IMAGE_CACHE_DIR / filename
-                                media_type = "image"
-                            img = ChatImage(
-                                file_id=fid,
-                                file_name=filename,
-                                mime_type=mime,
-                                local_path=str(local_path),
-                                media_type=media_type
-                            )
-                            result.images.append(img)
-                            print(f"[{'视频' if is_video else '图片'}] 已保存: {filename}")
-                    except Exception as e:
-                        print(f"[{'视频' if mime.startswith('video/') else '图片'}] 处理失败 (fileId={fid}): {e}")
-                        import traceback
-                        traceback.print_exc()
-            except Exception as e:
-                print(f"[文件处理] 获取文件元数据失败: {e}")
-                import traceback
-                traceback.print_exc()
+            for media in process_stream_files(jwt, current_session, team_id, proxy, file_ids_list,
+                                              account_manager, account_idx, deadline):
+                result.images.append(media)
+                if media.url:
+                    print(f"[cfbed] 上传成功: {media.url}")
+                else:
+                    print(f"[{'视频' if media.media_type == 'video' else '图片'}] 已保存: {media.file_name}")
                 
     except json.JSONDecodeError:
         pass
@@ -736,232 +834,130 @@ def stream_chat_with_images(jwt: str, sess_name: str, message: str,
     return result
 
 
-def parse_generated_media(gen_img: Dict, result: ChatResponse, proxy: Optional[str] = None, account_manager=None):
-    """解析generatedImages中的多媒体内容"""
+def save_base64_media(b64_data: str, mime_type: str, suggested_name: Optional[str] = None, source: str = "base64",
+                      proxy: Optional[str] = None, account_manager=None,
+                      deadline: Optional[Deadline] = None) -> ChatImage:
+    """解码 base64 图片/视频，上传到 cfbed（已配置时）或保存到本地缓存，返回媒体对象"""
+    is_video = mime_type.startswith("video/")
+    
+    # 检查是否配置了 cfbed
+    upload_endpoint = account_manager.config.get("upload_endpoint", "").strip() if account_manager else ""
+    upload_api_token = account_manager.config.get("upload_api_token", "").strip() if account_manager else ""
+    use_cfbed = bool(upload_endpoint and upload_api_token)
+    
+    if use_cfbed:
+        # 上传到 cfbed
+        print(f"[cfbed] 开始上传 {'视频' if is_video else '图片'} ({source})")
+        filename = suggested_name or f"media_{uuid.uuid4().hex[:8]}{get_extension_for_mime(mime_type)}"
+        
+        upload_result = upload_base64_to_cfbed(
+            base64_data=b64_data,
+            filename=filename,
+            mime_type=mime_type,
+            endpoint=upload_endpoint,
+            api_token=upload_api_token,
+            proxy=proxy,
+            deadline=deadline
+        )
+        
+        # 构建完整 URL
+        image_base_url = account_manager.config.get("image_base_url", "").strip() if account_manager else ""
+        if not image_base_url:
+            image_base_url = upload_endpoint.rstrip("/").replace("/upload", "")
+        if not image_base_url.endswith("/"):
+            image_base_url += "/"
+        
+        full_url = f"{image_base_url.rstrip('/')}{upload_result['src']}"
+        
+        img = ChatImage(
+            base64_data=b64_data,
+            mime_type=mime_type,
+            file_name=upload_result["src"].split("/")[-1],
+            url=full_url,
+            media_type="video" if is_video else "image"
+        )
+        print(f"[cfbed] 上传成功: {full_url}")
+        return img
+    
+    # 本地缓存
+    decoded = base64.b64decode(b64_data)
+    if is_video:
+        filename = save_video_to_cache(decoded, mime_type, suggested_name)
+        local_path = video_cache.path_for(filename)
+        media_type = "video"
+    else:
+        filename = save_image_to_cache(decoded, mime_type, suggested_name)
+        local_path = image_cache.path_for(filename)
+        media_type = "image"
+    img = ChatImage(
+        base64_data=b64_data,
+        mime_type=mime_type,
+        file_name=filename,
+        local_path=str(local_path),
+        media_type=media_type
+    )
+    print(f"[{'视频' if is_video else '图片'}] 已保存: {filename}")
+    return img
+
+
+# 内联媒体信息: (base64 数据, MIME 类型, 建议文件名, 来源)
+InlineMedia = Tuple[str, str, Optional[str], str]
+
+
+def extract_generated_media(gen_img: Dict) -> Optional[InlineMedia]:
+    """从 generatedImages 条目中提取 base64 媒体"""
     image_data = gen_img.get("image")
-    if not image_data:
+    if not image_data or not image_data.get("bytesBase64Encoded"):
+        return None
+    return image_data["bytesBase64Encoded"], image_data.get("mimeType", "image/png"), None, "base64"
+
+
+def extract_inline_data(content: Dict) -> Optional[InlineMedia]:
+    """从 content 的 inlineData 中提取 base64 媒体"""
+    inline_data = content.get("inlineData")
+    if not inline_data or not inline_data.get("data"):
+        return None
+    return inline_data["data"], inline_data.get("mimeType", "image/png"), None, "inlineData"
+
+
+def extract_attachment(att: Dict) -> Optional[InlineMedia]:
+    """从 attachment 中提取 base64 图片/视频"""
+    mime_type = att.get("mimeType", "")
+    if not (mime_type.startswith("image/") or mime_type.startswith("video/")):
+        return None
+    b64_data = att.get("data") or att.get("bytesBase64Encoded")
+    if not b64_data:
+        return None
+    return b64_data, mime_type, att.get("name"), "attachment"
+
+
+def _parse_inline_media(media_info: Optional[InlineMedia], result: ChatResponse,
+                        proxy: Optional[str] = None, account_manager=None):
+    """同步保存内联媒体并加入响应对象（失败只记录日志）"""
+    if not media_info:
         return
-    
-    # 检查base64数据
-    b64_data = image_data.get("bytesBase64Encoded")
-    if b64_data:
-        try:
-            decoded = base64.b64decode(b64_data)
-            mime_type = image_data.get("mimeType", "image/png")
-            is_video = mime_type.startswith("video/")
-            
-            # 检查是否配置了 cfbed
-            upload_endpoint = account_manager.config.get("upload_endpoint", "").strip() if account_manager else ""
-            upload_api_token = account_manager.config.get("upload_api_token", "").strip() if account_manager else ""
-            use_cfbed = bool(upload_endpoint and upload_api_token)
-            
-            if use_cfbed:
-                # 上传到 cfbed
-                print(f"[cfbed] 开始上传 {'视频' if is_video else '图片'} (base64)")
-                filename = f"media_{uuid.uuid4().hex[:8]}{get_extension_for_mime(mime_type)}"
-                
-                upload_result = upload_base64_to_cfbed(
-                    base64_data=b64_data,
-                    filename=filename,
-                    mime_type=mime_type,
-                    endpoint=upload_endpoint,
-                    api_token=upload_api_token,
-                    proxy=proxy
-                )
-                
-                # 构建完整 URL
-                image_base_url = account_manager.config.get("image_base_url", "").strip() if account_manager else ""
-                if not image_base_url:
-                    image_base_url = upload_endpoint.rstrip("/").replace("/upload", "")
-                if not image_base_url.endswith("/"):
-                    image_base_url += "/"
-                
-                full_url = f"{image_base_url.rstrip('/')}{upload_result['src']}"
-                
-                img = ChatImage(
-                    base64_data=b64_data,
-                    mime_type=mime_type,
-                    file_name=upload_result["src"].split("/")[-1],
-                    url=full_url,
-                    media_type="video" if is_video else "image"
-                )
-                result.images.append(img)
-                print(f"[cfbed] 上传成功: {full_url}")
-            else:
-                # 本地缓存
-                if is_video:
-                    filename = save_video_to_cache(decoded, mime_type)
-                    media_type = "video"
-                    local_path = VIDEO_CACHE_DIR / filename
-                else:
-                    filename = save_image_to_cache(decoded, mime_type)
-                    media_type = "image"
-                    local_path = IMAGE_CACHE_DIR / filename
-                img = ChatImage(
-                    base64_data=b64_data,
-                    mime_type=mime_type,
-                    file_name=filename,
-                    local_path=str(local_path),
-                    media_type=media_type
-                )
-                result.images.append(img)
-                print(f"[{'视频' if is_video else '图片'}] 已保存: {filename}")
-        except Exception as e:
-            print(f"[{'视频' if image_data.get('mimeType', '').startswith('video/') else '图片'}] 解析base64失败: {e}")
-            import traceback
-            traceback.print_exc()
+    b64_data, mime_type, suggested_name, source = media_info
+    try:
+        result.images.append(save_base64_media(b64_data, mime_type, suggested_name, source, proxy, account_manager))
+    except Exception as e:
+        print(f"[{'视频' if mime_type.startswith('video/') else '图片'}] 解析{source}失败: {e}")
+        import traceback
+        traceback.print_exc()
+
+
+def parse_generated_media(gen_img: Dict, result: ChatResponse, proxy: Optional[str] = None, account_manager=None):
+    """解析generatedImages中的多媒体内容"""
+    _parse_inline_media(extract_generated_media(gen_img), result, proxy, account_manager)
 
 
 def parse_image_from_content(content: Dict, result: ChatResponse, proxy: Optional[str] = None, account_manager=None):
     """从content中解析图片"""
-    # 检查inlineData
-    inline_data = content.get("inlineData")
-    if inline_data:
-        b64_data = inline_data.get("data")
-        if b64_data:
-            try:
-                decoded = base64.b64decode(b64_data)
-                mime_type = inline_data.get("mimeType", "image/png")
-                is_video = mime_type.startswith("video/")
-                
-                # 检查是否配置了 cfbed
-                upload_endpoint = account_manager.config.get("upload_endpoint", "").strip() if account_manager else ""
-                upload_api_token = account_manager.config.get("upload_api_token", "").strip() if account_manager else ""
-                use_cfbed = bool(upload_endpoint and upload_api_token)
-                
-                if use_cfbed:
-                    # 上传到 cfbed
-                    print(f"[cfbed] 开始上传 {'视频' if is_video else '图片'} (inlineData)")
-                    filename = f"media_{uuid.uuid4().hex[:8]}{get_extension_for_mime(mime_type)}"
-                    
-                    upload_result = upload_base64_to_cfbed(
-                        base64_data=b64_data,
-                        filename=filename,
-                        mime_type=mime_type,
-                        endpoint=upload_endpoint,
-                        api_token=upload_api_token,
-                        proxy=proxy
-                    )
-                    
-                    # 构建完整 URL
-                    image_base_url = account_manager.config.get("image_base_url", "").strip() if account_manager else ""
-                    if not image_base_url:
-                        image_base_url = upload_endpoint.rstrip("/").replace("/upload", "")
-                    if not image_base_url.endswith("/"):
-                        image_base_url += "/"
-                    
-                    full_url = f"{image_base_url.rstrip('/')}{upload_result['src']}"
-                    
-                    img = ChatImage(
-                        base64_data=b64_data,
-                        mime_type=mime_type,
-                        file_name=upload_result["src"].split("/")[-1],
-                        url=full_url,
-                        media_type="video" if is_video else "image"
-                    )
-                    result.images.append(img)
-                    print(f"[cfbed] 上传成功: {full_url}")
-                else:
-                    # 本地缓存
-                    if is_video:
-                        filename = save_video_to_cache(decoded, mime_type)
-                        media_type = "video"
-                        local_path = VIDEO_CACHE_DIR / filename
-                    else:
-                        filename = save_image_to_cache(decoded, mime_type)
-                        media_type = "image"
-                        local_path = IMAGE_CACHE_DIR / filename
-                    img = ChatImage(
-                        base64_data=b64_data,
-                        mime_type=mime_type,
-                        file_name=filename,
-                        local_path=str(local_path),
-                        media_type=media_type
-                    )
-                    result.images.append(img)
-                    print(f"[{'视频' if is_video else '图片'}] 已保存: {filename}")
-            except Exception as e:
-                print(f"[{'视频' if inline_data.get('mimeType', '').startswith('video/') else '图片'}] 解析inlineData失败: {e}")
-                import traceback
-                traceback.print_exc()
+    _parse_inline_media(extract_inline_data(content), result, proxy, account_manager)
 
 
 def parse_attachment(att: Dict, result: ChatResponse, proxy: Optional[str] = None, account_manager=None):
     """解析attachment中的图片/视频"""
-    # 检查是否是图片或视频类型
-    mime_type = att.get("mimeType", "")
-    if not (mime_type.startswith("image/") or mime_type.startswith("video/")):
-        return
-    
-    # 检查base64数据
-    b64_data = att.get("data") or att.get("bytesBase64Encoded")
-    if b64_data:
-        try:
-            decoded = base64.b64decode(b64_data)
-            is_video = mime_type.startswith("video/")
-            
-            # 检查是否配置了 cfbed
-            upload_endpoint = account_manager.config.get("upload_endpoint", "").strip() if account_manager else ""
-            upload_api_token = account_manager.config.get("upload_api_token", "").strip() if account_manager else ""
-            use_cfbed = bool(upload_endpoint and upload_api_token)
-            
-            if use_cfbed:
-                # 上传到 cfbed
-                print(f"[cfbed] 开始上传 {'视频' if is_video else '图片'} (attachment)")
-                suggested_name = att.get("name")
-                filename = suggested_name or f"media_{uuid.uuid4().hex[:8]}{get_extension_for_mime(mime_type)}"
-                
-                upload_result = upload_base64_to_cfbed(
-                    base64_data=b64_data,
-                    filename=filename,
-                    mime_type=mime_type,
-                    endpoint=upload_endpoint,
-                    api_token=upload_api_token,
-                    proxy=proxy
-                )
-                
-                # 构建完整 URL
-                image_base_url = account_manager.config.get("image_base_url", "").strip() if account_manager else ""
-                if not image_base_url:
-                    image_base_url = upload_endpoint.rstrip("/").replace("/upload", "")
-                if not image_base_url.endswith("/"):
-                    image_base_url += "/"
-                
-                full_url = f"{image_base_url.rstrip('/')}{upload_result['src']}"
-                
-                img = ChatImage(
-                    base64_data=b64_data,
-                    mime_type=mime_type,
-                    file_name=upload_result["src"].split("/")[-1],
-                    url=full_url,
-                    media_type="video" if is_video else "image"
-                )
-                result.images.append(img)
-                print(f"[cfbed] 上传成功: {full_url}")
-            else:
-                # 本地缓存
-                suggested_name = att.get("name")
-                if is_video:
-                    filename = save_video_to_cache(decoded, mime_type, suggested_name)
-                    local_path = VIDEO_CACHE_DIR / filename
-                    media_type = "video"
-                else:
-                    filename = save_image_to_cache(decoded, mime_type, suggested_name)
-                    local_path = IMAGE_CACHE_DIR / filename
-                    media_type = "image"
-                img = ChatImage(
-                    base64_data=b64_data,
-                    mime_type=mime_type,
-                    file_name=filename,
-                    local_path=str(local_path),
-                    media_type=media_type
-                )
-                result.images.append(img)
-                print(f"[{'视频' if is_video else '图片'}] 已保存: {filename}")
-        except Exception as e:
-            print(f"[{'视频' if mime_type.startswith('video/') else '图片'}] 解析attachment失败: {e}")
-            import traceback
-            traceback.print_exc()
+    _parse_inline_media(extract_attachment(att), result, proxy, account_manager)
 
 
 def get_image_base_url(fallback_host_url: str, account_manager=None, request=None) -> str:
@@ -20,7 +20,33 @@ VIDEO_CACHE_DIR = DATA_DIR / "video"
 VIDEO_CACHE_HOURS = 6  # 视频缓存时间（小时）
 VIDEO_CACHE_DIR.mkdir(exist_ok=True)
 
+# 媒体缓存总大小上限（按内容哈希去重存储，超出后按最近访问时间淘汰；可通过配置 image_cache_max_mb / video_cache_max_mb 覆盖）
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_MB", "1024")) * 1024 * 1024
+VIDEO_CACHE_MAX_BYTES = int(os.getenv("VIDEO_CACHE_MAX_MB", "4096")) * 1024 * 1024
+
+# 文件上传配置（/v1/files）
+UPLOAD_SPOOL_THRESHOLD = 1024 * 1024  # 上传文件超过该大小（字节）后写入磁盘临时文件，而不是保存在内存中
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_MB", "100")) * 1024 * 1024  # 单个上传文件的大小上限（配置 upload_max_mb 覆盖，0 表示不限制）
+UPLOAD_FORM_OVERHEAD_BYTES = 64 * 1024  # 按 Content-Length 预先检查时允许的 multipart 表单额外开销
+INLINE_UPLOAD_WORKERS = int(os.getenv("INLINE_UPLOAD_WORKERS", "8"))  # 聊天请求中内联图片并发上传的线程数
+UPLOAD_CACHE_MAX_ENTRIES = 4096  # 上传去重缓存（账号+会话+内容哈希 -> fileId）的最大条目数
+
+# 远程图片（image_url 输入）缓存配置，按 Cache-Control/ETag 缓存和重新验证
+URL_IMAGE_CACHE_MAX_BYTES = int(os.getenv("URL_IMAGE_CACHE_MAX_MB", "64")) * 1024 * 1024  # 缓存总大小上限
+URL_IMAGE_CACHE_MAX_OBJECT_BYTES = 8 * 1024 * 1024  # 超过该大小的图片不缓存
+
+# 媒体文件交给反向代理发送（配置 media_offload_mode: "x-accel" 用于 Nginx，"x-sendfile" 用于 Apache/lighttpd，留空则由 Flask 发送）
+MEDIA_OFFLOAD_PREFIX = "/_media_cache/"  # X-Accel-Redirect 的内部 location 前缀（配置 media_offload_prefix），对应 DATA_DIR
+
 MEDIA_STREAM_CHUNK_SIZE = 65536  # 64KB
+MEDIA_PIPELINE_WORKERS = int(os.getenv("MEDIA_PIPELINE_WORKERS", "8"))  # 生成图片/视频并发处理线程数
+MEDIA_IMAGE_TIMEOUT_SECONDS = 120  # 单个生成图片的处理超时（秒）
+MEDIA_VIDEO_TIMEOUT_SECONDS = 600  # 单个生成视频的处理超时（秒）
+
+# 上游 HTTP 连接池配置（按 代理+账号 复用 keep-alive 连接）
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "4"))    # 每个客户端缓存的主机连接池数量
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "16"))           # 每个主机的最大保持连接数
+HTTP_POOL_IDLE_SECONDS = int(os.getenv("HTTP_POOL_IDLE_SECONDS", "600"))  # 客户端空闲多久后回收（秒）
 
 # API endpoints
 BASE_URL = "https://biz-discoveryengine.googleapis.com/v1alpha/locations/global"
@@ -30,6 +56,45 @@ LIST_FILE_METADATA_URL = f"{BASE_URL}/widgetListSessionFileMetadata"
 ADD_CONTEXT_FILE_URL = f"{BASE_URL}/widgetAddContextFile"
 GETOXSRF_URL = "https://business.gemini.google/auth/getoxsrf"
 
+# JWT 刷新配置（JWT 有效期 300 秒）
+JWT_REFRESH_AGE_SECONDS = 240       # 请求路径上 JWT 超过该年龄即同步刷新
+JWT_PREREFRESH_AGE_SECONDS = 180    # 后台预刷新：JWT 达到该年龄时提前刷新
+JWT_PREREFRESH_WORKERS = 8          # 后台预刷新/启动预热的并发数
+JWT_PREREFRESH_ACTIVE_SECONDS = 600 # 只为该时间内处理过请求的账号提前刷新 JWT
+XSRF_KEY_CACHE_SECONDS = 1800       # xsrf 签名材料（keyId/xsrfToken）本地缓存时长，期间 JWT 在本地签发
+XSRF_KEY_MIN_CACHE_SECONDS = 300    # 上游拒绝后学习到的缓存时长下限
+
+# 会话池配置
+SESSION_POOL_SIZE = 2               # 每个活跃账号预创建的空闲会话数（可通过配置 session_pool_size 覆盖，0 表示关闭）
+SESSION_POOL_ACTIVE_SECONDS = 600   # 账号超过该时间未取用会话则不再补充
+
+# 流式请求对冲配置（默认关闭，通过配置 hedging_enabled 开启）
+HEDGE_PERCENTILE = 95               # 首块耗时超过该分位数仍未返回时发出对冲请求（配置 hedging_percentile）
+HEDGE_DEFAULT_DELAY_SECONDS = 3.0   # 样本不足时使用的对冲等待时间
+HEDGE_MIN_DELAY_SECONDS = 1.0       # 对冲等待时间下限
+HEDGE_MAX_DELAY_SECONDS = 15.0      # 对冲等待时间上限
+HEDGE_MIN_SAMPLES = 20              # 计算分位数所需的最少首块耗时样本数
+HEDGE_TTFT_SAMPLES = 500            # 每个模型保留的最近首块耗时样本数
+HEDGE_BUDGET_RATIO = 0.05           # 每个模型允许对冲的请求比例（配置 hedging_budget_ratio）
+HEDGE_BUDGET_BURST = 3              # 对冲预算最多累积的次数
+HEDGE_WORKERS = int(os.getenv("HEDGE_WORKERS", "16"))  # 预读首块和构造对冲请求的共享线程数（占满时不再对冲）
+
+# 流式响应合并配置（默认关闭，通过配置 sse_coalesce 开启，可按 API Key / 客户端单独设置）
+SSE_COALESCE_MAX_BYTES = 2048       # 合并的文本达到该字节数时立即发送
+SSE_COALESCE_WINDOW_MS = 50         # 合并窗口：首个待发送文本最多等待的毫秒数
+SSE_COALESCE_QUEUE_SIZE = 256       # 读取线程与响应之间的队列长度（满时上游读取暂停）
+
+# 上游请求时间预算（秒），按模型类型区分，可通过配置 deadlines 覆盖（如 {"image": {"first_byte": 240}}）
+# connect: 建立连接；first_byte: 发出请求到收到首个数据；idle: 流式数据之间的最长间隔；
+# total: 单个账号一次尝试的总时长（流式响应开始向客户端输出后不再限制，只检查 idle）
+DEADLINE_PROFILES = {
+    "text": {"connect": 10, "first_byte": 90, "idle": 60, "total": 300},
+    "image": {"connect": 10, "first_byte": 180, "idle": 120, "total": 600},
+    "video": {"connect": 10, "first_byte": 300, "idle": 300, "total": 900},
+}
+DEADLINE_WATCHDOG_INTERVAL = 0.5    # 超时检查线程的检查间隔（秒）
+TIMEOUT_ERROR_COOLDOWN_SECONDS = 30 # 超出时间预算的账号短暂冷却，随后可再次使用
+
 # 账号错误冷却时间（秒）
 AUTH_ERROR_COOLDOWN_SECONDS = 900      # 凭证错误，15分钟
 RATE_LIMIT_COOLDOWN_SECONDS = 300      # 触发限额，5分钟
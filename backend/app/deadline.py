@@ -0,0 +1,211 @@
+"""请求时间预算模块 - 为一次上游尝试分别限制连接、首字节、数据间隔和总耗时
+
+每次向某个账号发起尝试时创建一个 Deadline，依次传给创建会话、上传、流式聊天和媒体下载；
+普通请求通过 requests 的 (连接, 读取) 超时实现，流式响应由 DeadlineWatchdog 后台检查，
+超出预算时关闭上游响应，读取方随即抛出可重试的 AccountTimeoutError。
+"""
+
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import requests
+from urllib3.exceptions import ReadTimeoutError
+
+from .config import DEADLINE_PROFILES, DEADLINE_WATCHDOG_INTERVAL
+from .exceptions import AccountTimeoutError
+from .http_client import abort_response
+
+_PHASE_LABELS = {"connect": "连接", "first_byte": "首字节", "idle": "数据间隔", "total": "总时长"}
+
+
+def profile_for_model(model_id: Optional[str]) -> str:
+    """根据模型ID选择时间预算配置（text / image / video）"""
+    if model_id == "gemini-image":
+        return "image"
+    if model_id == "gemini-video":
+        return "video"
+    return "text"
+
+
+def get_deadline_budgets(profile: str) -> Dict[str, float]:
+    """获取时间预算（配置 deadlines 中的同名项覆盖默认值）"""
+    from .account_manager import account_manager
+
+    budgets = {key: float(value) for key, value in (DEADLINE_PROFILES.get(profile) or DEADLINE_PROFILES["text"]).items()}
+    overrides = ((account_manager.config or {}).get("deadlines") or {}).get(profile)
+    if isinstance(overrides, dict):
+        for key, value in overrides.items():
+            if key in budgets:
+                try:
+                    budgets[key] = float(value)
+                except (TypeError, ValueError):
+                    pass
+    return budgets
+
+
+def is_timeout(error: BaseException) -> bool:
+    """是否为超时异常（流式读取超时会被 requests 包装成 ConnectionError）"""
+    if isinstance(error, requests.Timeout):
+        return True
+    return isinstance(error, requests.ConnectionError) and any(isinstance(arg, ReadTimeoutError) for arg in error.args)
+
+
+def timeout_error(action: str, error: BaseException, phase: Optional[str] = None) -> AccountTimeoutError:
+    """把 requests 的超时异常转换为 AccountTimeoutError"""
+    if phase is None:
+        phase = "connect" if isinstance(error, requests.ConnectTimeout) else "first_byte"
+    return AccountTimeoutError(f"{action}超时（{_PHASE_LABELS[phase]}）: {error}", phase=phase)
+
+
+class Deadline:
+    """一次上游尝试的时间预算"""
+
+    def __init__(self, profile: str = "text", budgets: Optional[Dict[str, float]] = None):
+        budgets = budgets or get_deadline_budgets(profile)
+        self.profile = profile
+        self.connect = budgets["connect"]
+        self.first_byte = budgets["first_byte"]
+        self.idle = budgets["idle"]
+        self.total = budgets["total"]
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + self.total
+        # 流式响应的读取进度，由 DeadlineWatchdog 检查
+        self.stream_started_at: Optional[float] = None
+        self.last_activity: Optional[float] = None
+        self.expired_phase: Optional[str] = None
+        # 流式响应已开始发送给客户端：此后无法切换账号，总时长不再限制，只检查数据间隔
+        self.committed = False
+
+    @classmethod
+    def for_model(cls, model_id: Optional[str]) -> "Deadline":
+        return cls(profile_for_model(model_id))
+
+    def child(self, total: float) -> "Deadline":
+        """派生独立的子任务预算（如单个媒体的下载/上传）：沿用连接、首字节和数据间隔预算，总时长从现在开始计算"""
+        return Deadline(self.profile, {"connect": self.connect, "first_byte": self.first_byte,
+                                       "idle": self.idle, "total": total})
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def error(self, phase: str) -> AccountTimeoutError:
+        return AccountTimeoutError(f"上游请求超时（{_PHASE_LABELS[phase]}超过 {getattr(self, phase):g} 秒）", phase=phase)
+
+    def check(self):
+        """总时长已用完时抛出 AccountTimeoutError（已提交的流式响应不再检查）"""
+        if not self.committed and self.remaining() <= 0:
+            self.expired_phase = self.expired_phase or "total"
+            raise self.error("total")
+
+    def timeout(self, read_phase: str = "first_byte", within_total: bool = True) -> Tuple[float, float]:
+        """requests 使用的 (连接超时, 读取超时)
+
+        Args:
+            read_phase: 读取超时使用的预算（first_byte、idle，或 stream 表示两者中较大者，
+                        流式响应的阶段由 DeadlineWatchdog 精确区分，socket 超时只作兜底）
+            within_total: 是否限制在剩余总时长之内（媒体下载有各自的截止时间，不受对话总时长限制）
+        """
+        connect = self.connect
+        read = max(self.first_byte, self.idle) if read_phase == "stream" else getattr(self, read_phase)
+        if not within_total:
+            return connect, read
+        self.check()
+        remaining = self.remaining()
+        return min(connect, remaining), min(read, remaining)
+
+    def begin_stream(self):
+        """开始读取流式响应：之后首个数据块受 first_byte 限制，后续数据块之间受 idle 限制"""
+        self.stream_started_at = time.monotonic()
+        self.last_activity = None
+
+    def touch(self):
+        """收到流式数据"""
+        self.last_activity = time.monotonic()
+
+    def commit(self):
+        """首个数据块已交给客户端：正常输出中的长回答不会因总时长被中途截断"""
+        self.committed = True
+
+    def overdue_phase(self, now: float) -> Optional[str]:
+        """返回已超出的预算阶段，未超出时返回 None"""
+        if now >= self.expires_at and not self.committed:
+            return "total"
+        if self.stream_started_at is None:
+            return None
+        if self.last_activity is None:
+            if now - self.stream_started_at >= self.first_byte:
+                return "first_byte"
+        elif now - self.last_activity >= self.idle:
+            return "idle"
+        return None
+
+    def raise_if_expired(self):
+        """上游响应已因超时被关闭时抛出 AccountTimeoutError"""
+        if self.expired_phase:
+            raise self.error(self.expired_phase)
+
+
+class DeadlineWatchdog:
+    """流式响应超时检查
+
+    socket 读取超时只能限制单次读取，无法区分首字节与数据间隔，也无法限制总时长；
+    后台线程定期检查登记的流式响应，超出预算时关闭上游响应，使阻塞中的读取立即结束。
+    """
+
+    def __init__(self, interval: float = DEADLINE_WATCHDOG_INTERVAL):
+        self.interval = interval
+        self._watched: Dict[int, Tuple[Deadline, Any]] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stats = {"watched": 0, "expired": {phase: 0 for phase in ("first_byte", "idle", "total")}}
+
+    def watch(self, deadline: Deadline, resp):
+        """登记流式响应，开始计算首字节时间"""
+        deadline.begin_stream()
+        with self._lock:
+            self._watched[id(resp)] = (deadline, resp)
+            self._stats["watched"] += 1
+            # 第一次使用时启动检查线程（流式读取依赖它才能结束卡住的连接）
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, daemon=True)
+                self._thread.start()
+
+    def unwatch(self, resp):
+        with self._lock:
+            self._watched.pop(id(resp), None)
+
+    def _loop(self):
+        from .logger import print
+
+        while True:
+            time.sleep(self.interval)
+            now = time.monotonic()
+            expired = []
+            with self._lock:
+                for key, (deadline, resp) in list(self._watched.items()):
+                    phase = deadline.overdue_phase(now)
+                    if phase:
+                        deadline.expired_phase = phase
+                        self._stats["expired"][phase] += 1
+                        del self._watched[key]
+                        expired.append((deadline, resp))
+            for deadline, resp in expired:
+                print(f"[超时] 上游流式响应{_PHASE_LABELS[deadline.expired_phase]}超过 "
+                      f"{getattr(deadline, deadline.expired_phase):g} 秒（{deadline.profile}），关闭连接")
+                try:
+                    abort_response(resp)
+                except Exception:
+                    pass
+
+    def get_stats(self) -> dict:
+        """获取超时统计信息"""
+        with self._lock:
+            stats = {"watched": self._stats["watched"], "expired": dict(self._stats["expired"]),
+                     "active": len(self._watched)}
+        stats["profiles"] = {profile: get_deadline_budgets(profile) for profile in DEADLINE_PROFILES}
+        return stats
+
+
+# 全局流式响应超时检查实例
+deadline_watchdog = DeadlineWatchdog()
@@ -23,6 +23,18 @@ class AccountRequestError(AccountError):
     """其他请求异常"""
 
 
+class AccountJwtRejectedError(AccountRequestError):
+    """本地签发的 JWT 被上游拒绝（缓存的签名材料已过期），缓存已丢弃，可以用同一账号重新获取后重试"""
+
+
+class AccountTimeoutError(AccountRequestError):
+    """上游请求超出时间预算（连接、首字节、数据间隔或总时长），可以切换账号重试"""
+
+    def __init__(self, message: str, phase: Optional[str] = None, status_code: Optional[int] = None):
+        super().__init__(message, status_code)
+        self.phase = phase
+
+
 class NoAvailableAccount(AccountError):
     """无可用账号异常"""
 
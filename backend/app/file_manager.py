@@ -1,7 +1,11 @@
 """文件管理器模块"""
 
+import threading
 import time
-from typing import Dict, List, Optional
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from .config import UPLOAD_CACHE_MAX_ENTRIES
 
 
 class FileManager:
@@ -11,7 +15,7 @@ class FileManager:
         self.files: Dict[str, Dict] = {}  # openai_file_id -> {gemini_file_id, session_name, filename, mime_type, size, created_at}
     
     def add_file(self, openai_file_id: str, gemini_file_id: str, session_name: str, 
-                 filename: str, mime_type: str, size: int) -> Dict:
+                 filename: str, mime_type: str, size: int, sha256: Optional[str] = None) -> Dict:
         """添加文件映射"""
         file_info = {
             "id": openai_file_id,
@@ -20,6 +24,7 @@ class FileManager:
             "filename": filename,
             "mime_type": mime_type,
             "bytes": size,
+            "sha256": sha256,
             "created_at": int(time.time()),
             "purpose": "assistants",
             "object": "file"
@@ -53,6 +58,68 @@ class FileManager:
         return file_info.get("session_name") if file_info else None
 
 
+class UploadCache:
+    """上传去重缓存 - (账号, 会话, 文件内容 sha256) -> Gemini fileId
+    
+    OpenAI 风格的客户端每轮都会重新发送完整的历史消息（包括之前的内联图片），
+    同一会话中已上传过的相同内容直接复用 fileId，不再重复上传。
+    会话被丢弃（账号冷却、不可用、会话失效）时清除对应条目；条目数超过上限时按 LRU 淘汰。
+    """
+    
+    def __init__(self, max_entries: int = UPLOAD_CACHE_MAX_ENTRIES):
+        self._entries: "OrderedDict[Tuple[int, str, str], str]" = OrderedDict()
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stored": 0, "invalidated": 0}
+    
+    def get(self, account_idx: int, session_name: str, sha256: str) -> Optional[str]:
+        """查找已上传文件的 fileId"""
+        key = (account_idx, session_name, sha256)
+        with self._lock:
+            file_id = self._entries.get(key)
+            if file_id is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return file_id
+    
+    def put(self, account_idx: int, session_name: str, sha256: str, file_id: str):
+        """记录上传结果"""
+        with self._lock:
+            self._entries[(account_idx, session_name, sha256)] = file_id
+            self._entries.move_to_end((account_idx, session_name, sha256))
+            self._stats["stored"] += 1
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+    
+    def _invalidate(self, match) -> int:
+        with self._lock:
+            keys = [key for key in self._entries if match(key)]
+            for key in keys:
+                del self._entries[key]
+            self._stats["invalidated"] += len(keys)
+        return len(keys)
+    
+    def invalidate_session(self, session_name: str) -> int:
+        """清除某个会话的所有条目"""
+        return self._invalidate(lambda key: key[1] == session_name)
+    
+    def invalidate_account(self, account_idx: int) -> int:
+        """清除某个账号的所有条目"""
+        return self._invalidate(lambda key: key[0] == account_idx)
+    
+    def get_stats(self) -> dict:
+        """获取缓存统计信息"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        return stats
+
+
 # 全局文件管理器实例
 file_manager = FileManager()
 
+# 全局上传去重缓存实例
+upload_cache = UploadCache()
+
@@ -0,0 +1,297 @@
+"""请求对冲模块 - 流式聊天首块迟迟未到时，向另一个账号发出对冲请求，先返回内容者胜出"""
+
+import math
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Deque, Dict, Generator, Optional, Tuple
+
+from .config import (
+    HEDGE_PERCENTILE, HEDGE_DEFAULT_DELAY_SECONDS, HEDGE_MIN_DELAY_SECONDS,
+    HEDGE_MAX_DELAY_SECONDS, HEDGE_MIN_SAMPLES, HEDGE_TTFT_SAMPLES,
+    HEDGE_BUDGET_RATIO, HEDGE_BUDGET_BURST, HEDGE_WORKERS
+)
+from .account_manager import account_manager
+
+# 预读首块和构造对冲请求共享的有界线程池；任务数由 _hedge_slots 限制，提交的任务不会排队
+_hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="hedge")
+_hedge_slots = threading.BoundedSemaphore(HEDGE_WORKERS)
+
+
+class StreamAttempt:
+    """一次已构造的流式聊天尝试"""
+
+    def __init__(self, account_idx: int, generator: Generator[bytes, None, None],
+                 stream_handle=None, session: Optional[str] = None):
+        self.account_idx = account_idx
+        self.generator = generator
+        self.stream_handle = stream_handle
+        self.session = session
+        self.started_at = time.time()
+        self.cancelled = False
+
+    def cancel(self):
+        """取消尝试：关闭上游连接，并在生成器未执行时关闭生成器（执行中的生成器由预读线程返回后关闭）"""
+        self.cancelled = True
+        if self.stream_handle is not None:
+            self.stream_handle.cancel()
+        try:
+            self.generator.close()
+        except ValueError:
+            # 生成器仍在其他线程中执行，上游连接关闭后该线程会自行结束
+            pass
+
+
+class StreamHedger:
+    """流式请求对冲器
+
+    按模型记录最近的首块耗时（TTFT），超过配置分位数仍未收到首块时向另一个账号发出对冲请求；
+    每个模型按请求数累积对冲预算（令牌桶），预算不足时不发出对冲，避免浪费配额。
+    """
+
+    def __init__(self):
+        self._ttft: Dict[str, Deque[float]] = {}
+        self._budget: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._stats = {"primed": 0, "hedged": 0, "hedge_wins": 0, "budget_denied": 0, "hedge_failed": 0, "pool_busy": 0}
+
+    def _config(self, key: str, default):
+        if not account_manager.config:
+            return default
+        try:
+            return type(default)(account_manager.config.get(key, default))
+        except (TypeError, ValueError):
+            return default
+
+    def is_enabled(self) -> bool:
+        """是否开启对冲（配置 hedging_enabled，默认关闭）"""
+        return bool(account_manager.config and account_manager.config.get("hedging_enabled", False))
+
+    def record_ttft(self, model: str, seconds: float):
+        """记录一次首块耗时"""
+        with self._lock:
+            samples = self._ttft.get(model)
+            if samples is None:
+                samples = self._ttft[model] = deque(maxlen=HEDGE_TTFT_SAMPLES)
+            samples.append(seconds)
+
+    def get_hedge_delay(self, model: str) -> float:
+        """计算对冲等待时间：最近首块耗时的分位数，限制在上下限之间"""
+        percentile = self._config("hedging_percentile", float(HEDGE_PERCENTILE))
+        with self._lock:
+            samples = sorted(self._ttft.get(model) or ())
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            delay = HEDGE_DEFAULT_DELAY_SECONDS
+        else:
+            rank = min(len(samples) - 1, max(0, math.ceil(percentile / 100 * len(samples)) - 1))
+            delay = samples[rank]
+        return min(HEDGE_MAX_DELAY_SECONDS, max(HEDGE_MIN_DELAY_SECONDS, delay))
+
+    def _credit_budget(self, model: str):
+        """每个请求为模型累积一部分对冲预算"""
+        ratio = self._config("hedging_budget_ratio", HEDGE_BUDGET_RATIO)
+        with self._lock:
+            self._budget[model] = min(HEDGE_BUDGET_BURST, self._budget.get(model, 0.0) + ratio)
+
+    def _try_acquire_budget(self, model: str) -> bool:
+        with self._lock:
+            if self._budget.get(model, 0.0) >= 1.0:
+                self._budget[model] -= 1.0
+                return True
+            self._stats["budget_denied"] += 1
+            return False
+
+    def get_stats(self) -> dict:
+        """获取对冲统计信息"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["budget"] = {model: round(tokens, 2) for model, tokens in self._budget.items()}
+            models = list(self._ttft.keys())
+        stats["enabled"] = self.is_enabled()
+        stats["delay_seconds"] = {model: round(self.get_hedge_delay(model), 3) for model in models}
+        return stats
+
+    def prime(self, model: str, primary: StreamAttempt,
+              hedge_factory: Optional[Callable[[], Optional[StreamAttempt]]] = None,
+              on_error: Optional[Callable[[int, BaseException], None]] = None) -> Tuple[Optional[bytes], StreamAttempt]:
+        """预读流式响应的首个数据块，必要时发出对冲请求
+
+        Args:
+            model: 模型名称（TTFT 统计和预算按模型区分）
+            primary: 主请求
+            hedge_factory: 构造对冲请求的函数（返回 None 表示没有可用账号）；为 None 时不对冲。
+                           在共享线程池中执行，创建对冲账号的会话不会推迟主请求首块的等待；
+                           构造过程中的账号错误由 factory 自行处理。线程池已满时不对冲
+            on_error: 不经过调用方重试循环的失败（对冲请求失败、对冲胜出前主请求已失败）按 (账号索引, 异常) 回调，
+                      用于与重试循环一致地冷却账号
+
+        Returns:
+            (首个数据块, 胜出的请求)
+
+        Raises:
+            主请求和对冲请求都未能产生首块时，抛出主请求的异常，由调用方的重试循环处理
+        """
+        with self._lock:
+            self._stats["primed"] += 1
+
+        from .logger import print
+
+        results: "queue.Queue[Tuple[Optional[StreamAttempt], Optional[bytes], Optional[BaseException]]]" = queue.Queue()
+        hedging = self.is_enabled() and hedge_factory is not None
+        if hedging and not _submit(_run_priming, primary, results):
+            # 线程池已满：在当前线程中预读，不对冲
+            hedging = False
+            with self._lock:
+                self._stats["pool_busy"] += 1
+        if not hedging:
+            first_chunk = _next_chunk(primary.generator)
+            self.record_ttft(model, time.time() - primary.started_at)
+            return first_chunk, primary
+
+        self._credit_budget(model)
+
+        delay = self.get_hedge_delay(model)
+        try:
+            pending = [results.get(timeout=delay)]
+        except queue.Empty:
+            pending = []
+
+        hedge: Optional[_HedgeLaunch] = None
+        if not pending and self._try_acquire_budget(model):
+            hedge = _HedgeLaunch(self, hedge_factory, primary, delay, results)
+            if not hedge.start():
+                # 线程池已满：不再对冲，继续等待主请求
+                hedge = None
+                with self._lock:
+                    self._stats["pool_busy"] += 1
+
+        primary_error: Optional[BaseException] = None
+        hedge_running = hedge is not None
+        while True:
+            attempt, first_chunk, error = pending.pop() if pending else results.get()
+            if error is None and attempt is not None:
+                self.record_ttft(model, time.time() - attempt.started_at)
+                if attempt is primary:
+                    if hedge is not None:
+                        hedge.cancel()
+                    return first_chunk, attempt
+                primary.cancel()
+                with self._lock:
+                    self._stats["hedge_wins"] += 1
+                print(f"[对冲] 对冲请求胜出（账号 {attempt.account_idx}），已取消账号 {primary.account_idx} 的请求")
+                if primary_error is not None and on_error is not None:
+                    on_error(primary.account_idx, primary_error)
+                return first_chunk, attempt
+
+            if attempt is primary:
+                if hedge_running:
+                    # 对冲请求仍在进行，继续等待它，而不是放弃已发出的请求
+                    primary_error = error
+                    print(f"[对冲] 账号 {primary.account_idx} 的主请求失败: {error}，继续等待对冲请求")
+                    continue
+                raise error
+
+            # 对冲请求失败（或没有可用的对冲账号），继续等待主请求
+            hedge_running = False
+            if error is not None:
+                with self._lock:
+                    self._stats["hedge_failed"] += 1
+                if attempt is None:
+                    print(f"[对冲] 创建对冲请求失败: {error}")
+                else:
+                    print(f"[对冲] 账号 {attempt.account_idx} 的对冲请求失败: {error}")
+                    if on_error is not None:
+                        on_error(attempt.account_idx, error)
+            if primary_error is not None:
+                raise primary_error
+
+
+class _HedgeLaunch:
+    """在共享线程池中构造对冲请求并预读首块，结果（或构造失败的异常）放入结果队列"""
+
+    def __init__(self, hedger: StreamHedger, factory: Callable[[], Optional[StreamAttempt]],
+                 primary: StreamAttempt, delay: float, results: queue.Queue):
+        self.hedger = hedger
+        self.factory = factory
+        self.primary = primary
+        self.delay = delay
+        self.results = results
+        self.attempt: Optional[StreamAttempt] = None
+        self._cancelled = False
+        self._lock = threading.Lock()
+
+    def start(self) -> bool:
+        """提交到共享线程池，线程池已满时返回 False"""
+        return _submit(self._run)
+
+    def cancel(self):
+        """主请求胜出：取消已发出的对冲请求；尚在构造的对冲请求构造完成后立即取消"""
+        with self._lock:
+            self._cancelled = True
+            attempt = self.attempt
+        if attempt is not None:
+            attempt.cancel()
+
+    def _run(self):
+        from .logger import print
+
+        try:
+            attempt = self.factory()
+        except BaseException as e:
+            self.results.put((None, None, e))
+            return
+        if attempt is None:
+            self.results.put((None, None, None))
+            return
+        with self._lock:
+            cancelled = self._cancelled
+            self.attempt = attempt
+        if cancelled:
+            attempt.cancel()
+            return
+        with self.hedger._lock:
+            self.hedger._stats["hedged"] += 1
+        print(f"[对冲] 账号 {self.primary.account_idx} 首块超过 {self.delay:.2f} 秒未返回，向账号 {attempt.account_idx} 发出对冲请求")
+        _run_priming(attempt, self.results)
+
+
+def _next_chunk(generator: Generator[bytes, None, None]) -> Optional[bytes]:
+    try:
+        return next(generator)
+    except StopIteration:
+        return None
+
+
+def _run_priming(attempt: StreamAttempt, results: queue.Queue):
+    """预读首个数据块，结果放入队列"""
+    try:
+        first_chunk = _next_chunk(attempt.generator)
+    except BaseException as e:
+        results.put((attempt, None, e))
+        return
+    if attempt.cancelled:
+        # 预读期间已落败：不会再有人读取这个生成器，立即关闭以执行其 finally（关闭上游响应、取消媒体任务）
+        attempt.generator.close()
+        return
+    results.put((attempt, first_chunk, None))
+
+
+def _submit(fn: Callable, *args) -> bool:
+    """占用一个空闲名额后提交到共享线程池，没有空闲名额时返回 False（不排队等待）"""
+    if not _hedge_slots.acquire(blocking=False):
+        return False
+
+    def run():
+        try:
+            fn(*args)
+        finally:
+            _hedge_slots.release()
+
+    _hedge_executor.submit(run)
+    return True
+
+
+# 全局对冲器实例
+stream_hedger = StreamHedger()
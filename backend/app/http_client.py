@@ -0,0 +1,203 @@
+"""上游 HTTP 客户端模块 - 按 (代理, 账号) 复用 keep-alive 连接池"""
+
+import base64
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from http.cookiejar import DefaultCookiePolicy
+from typing import BinaryIO, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .config import HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE, HTTP_POOL_IDLE_SECONDS
+
+
+class HTTPClientRegistry:
+    """上游 HTTP 客户端注册表
+
+    每个 (代理, 账号) 组合对应一个 requests.Session，其 HTTPAdapter 维护 keep-alive 连接池，
+    避免每次请求 biz-discoveryengine 都重新进行 TCP+TLS 握手（经代理时还会额外占用代理连接）。
+    长时间未使用的客户端会被回收，释放其持有的连接。
+    """
+
+    def __init__(self, pool_connections: int = HTTP_POOL_CONNECTIONS,
+                 pool_maxsize: int = HTTP_POOL_MAXSIZE,
+                 idle_seconds: int = HTTP_POOL_IDLE_SECONDS):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.idle_seconds = idle_seconds
+        self._clients: Dict[Tuple[str, Optional[Hashable]], Dict] = {}  # key -> {session, last_used}
+        self._lock = threading.Lock()
+        self._last_evict_time = time.time()
+
+    def _create_session(self, proxy: Optional[str]) -> requests.Session:
+        """创建带连接池的 Session"""
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            max_retries=0
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.verify = False
+        if proxy:
+            session.proxies = {"http": proxy, "https": proxy}
+            # 显式配置了代理时不再读取环境变量中的代理（与原先显式传 proxies 的行为一致）
+            session.trust_env = False
+        # 账号 Cookie 均通过请求头显式传递，禁止 Session 自动保存响应 Cookie，避免跨请求串号
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        return session
+
+    def get(self, proxy: Optional[str] = None, account_key: Optional[Hashable] = None) -> requests.Session:
+        """获取 (代理, 账号) 对应的客户端，不存在则创建
+
+        Args:
+            proxy: 代理地址（None 表示直连）
+            account_key: 账号标识（通常为账号索引），None 表示与账号无关的共享客户端
+
+        Returns:
+            可复用的 requests.Session
+        """
+        key = (proxy or "", account_key)
+        now = time.time()
+        stale_sessions: List[requests.Session] = []
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry is None:
+                entry = {"session": self._create_session(proxy), "last_used": now}
+                self._clients[key] = entry
+            entry["last_used"] = now
+            # 定期回收空闲客户端（在锁内只摘除，在锁外关闭）
+            if now - self._last_evict_time >= min(60, self.idle_seconds):
+                self._last_evict_time = now
+                for other_key, other in list(self._clients.items()):
+                    if other_key != key and now - other["last_used"] > self.idle_seconds:
+                        stale_sessions.append(other["session"])
+                        del self._clients[other_key]
+        for session in stale_sessions:
+            try:
+                session.close()
+            except Exception:
+                pass
+        return entry["session"]
+
+    def close_all(self):
+        """关闭所有客户端（用于代理配置变更等场景）"""
+        with self._lock:
+            sessions = [entry["session"] for entry in self._clients.values()]
+            self._clients.clear()
+        for session in sessions:
+            try:
+                session.close()
+            except Exception:
+                pass
+
+    def get_stats(self) -> dict:
+        """获取客户端池统计信息"""
+        with self._lock:
+            return {
+                "clients": len(self._clients),
+                "pool_connections": self.pool_connections,
+                "pool_maxsize": self.pool_maxsize,
+                "idle_seconds": self.idle_seconds
+            }
+
+
+class StreamingBody:
+    """流式请求体：按块产出字节，requests 会边迭代边写入 socket，不在内存中拼接完整请求体
+
+    已知总长度时提供 __len__，requests 据此设置 Content-Length；
+    长度未知（0）时 requests 改用 Transfer-Encoding: chunked。
+    """
+
+    def __init__(self, chunks: Iterable[bytes], length: Optional[int] = None):
+        self._chunks = chunks
+        self._length = length or 0
+        self.bytes_sent = 0
+
+    def __iter__(self) -> Iterator[bytes]:
+        for chunk in self._chunks:
+            if chunk:
+                self.bytes_sent += len(chunk)
+                yield chunk
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __bool__(self) -> bool:
+        # requests 内部使用 `data or {}`，长度未知时也不能被视为空请求体
+        return True
+
+
+# base64 编码时每次读取的原始字节数（3 的倍数，保证各块编码结果可以直接拼接）
+_BASE64_READ_SIZE = 48 * 1024
+
+
+def base64_json_body(envelope: Dict, field_path: Tuple[str, ...], source: Union[bytes, BinaryIO]) -> StreamingBody:
+    """构造 JSON 请求体，其中一个字段为文件内容的 base64 编码，编码结果逐块写入 socket
+
+    先把信封中的目标字段替换为占位符并序列化，再在占位符处逐块输出 base64 文本，
+    不会在内存中生成完整的 base64 字符串和 JSON 字符串，内存占用约为一个块。
+
+    Args:
+        envelope: JSON 信封（目标字段的值会被忽略）
+        field_path: 目标字段的路径，如 ("addContextFileRequest", "fileContents")
+        source: 文件内容（bytes，或从当前位置读取的二进制文件对象）
+    """
+    placeholder = f"__base64_{uuid.uuid4().hex}__"
+    target = envelope
+    for key in field_path[:-1]:
+        target = target[key]
+    target[field_path[-1]] = placeholder
+    head, tail = json.dumps(envelope).encode("utf-8").split(placeholder.encode("ascii"), 1)
+
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source)
+        size = len(view)
+        reads = (view[i:i + _BASE64_READ_SIZE] for i in range(0, size, _BASE64_READ_SIZE))
+    else:
+        start = source.tell()
+        size = source.seek(0, os.SEEK_END) - start
+        source.seek(start)
+        reads = iter(lambda: source.read(_BASE64_READ_SIZE), b"")
+
+    def iter_body():
+        yield head
+        for chunk in reads:
+            yield base64.b64encode(chunk)
+        yield tail
+
+    return StreamingBody(iter_body(), len(head) + 4 * ((size + 2) // 3) + len(tail))
+
+
+# 全局客户端注册表实例
+http_client_registry = HTTPClientRegistry()
+
+
+def get_http_client(proxy: Optional[str] = None, account_idx: Optional[int] = None) -> requests.Session:
+    """获取上游请求使用的 HTTP 客户端（带 keep-alive 连接池）"""
+    return http_client_registry.get(proxy, account_idx)
+
+
+def abort_response(resp: requests.Response):
+    """从其他线程中止流式响应
+
+    resp.close() 只关闭文件对象，正阻塞在 recv 中的读取线程不会被唤醒；
+    先 shutdown 底层 socket 让阻塞的读取立即返回，再关闭响应（连接不会回到连接池）。
+    """
+    raw = getattr(resp, "raw", None)
+    sock = getattr(getattr(raw, "_connection", None), "sock", None)
+    if sock is None:
+        # 读取中的 http.client 响应：SocketIO._sock
+        sock = getattr(getattr(getattr(getattr(raw, "_fp", None), "fp", None), "raw", None), "_sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    resp.close()
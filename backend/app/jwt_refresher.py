@@ -0,0 +1,187 @@
+"""JWT 预刷新模块 - 后台在过期前为近期活跃的账号重新生成 JWT，并在启动时预热所有可用账号"""
+
+import heapq
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import List, Optional, Set, Tuple
+
+from .config import JWT_PREREFRESH_AGE_SECONDS, JWT_PREREFRESH_WORKERS, JWT_PREREFRESH_ACTIVE_SECONDS
+from .session_manager import refresh_jwt_for_account, get_jwt_refresh_stats, get_recently_used_accounts
+
+# 全局变量
+_refresher_thread: Optional[threading.Thread] = None
+_refresher_stop_event = threading.Event()
+_refresher_running = False
+
+# 最近一次预热信息
+_last_warmup_time: Optional[str] = None
+_last_warmup_count = 0
+
+# 没有到期任务时的最长等待时间（秒），用于发现新增或重新加载的账号
+_IDLE_SCAN_SECONDS = 15
+# 刷新失败后的重试间隔（秒）
+_RETRY_DELAY_SECONDS = 60
+
+
+def get_jwt_refresher_status() -> dict:
+    """获取 JWT 预刷新状态和计数"""
+    return {
+        "running": _refresher_running,
+        "prerefresh_age_seconds": JWT_PREREFRESH_AGE_SECONDS,
+        "active_window_seconds": JWT_PREREFRESH_ACTIVE_SECONDS,
+        "active_accounts": len(get_recently_used_accounts(JWT_PREREFRESH_ACTIVE_SECONDS)),
+        "last_warmup_time": _last_warmup_time,
+        "last_warmup_count": _last_warmup_count,
+        "refreshes": get_jwt_refresh_stats()
+    }
+
+
+def _refresh_accounts(account_manager, account_indices: List[int], source: str) -> List[int]:
+    """并发刷新一批账号的 JWT，返回刷新失败的账号索引"""
+    from .logger import print
+
+    def refresh_one(account_idx: int) -> bool:
+        if _refresher_stop_event.is_set():
+            return False
+        if account_idx >= len(account_manager.accounts) or not account_manager.is_account_available(account_idx):
+            return False
+        try:
+            refresh_jwt_for_account(account_idx, account_manager.accounts[account_idx], source=source)
+            return True
+        except Exception as e:
+            print(f"[JWT预刷新] 账号 {account_idx} 刷新失败: {e}")
+            return False
+
+    if not account_indices:
+        return []
+    workers = max(1, min(JWT_PREREFRESH_WORKERS, len(account_indices)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="jwt-refresh") as executor:
+        results = list(executor.map(refresh_one, account_indices))
+    return [idx for idx, ok in zip(account_indices, results) if not ok]
+
+
+def warm_up_jwts(account_manager) -> int:
+    """启动预热：并发为所有可用账号生成 JWT，返回成功数量"""
+    global _last_warmup_time, _last_warmup_count
+    from .logger import print
+
+    account_indices = [idx for idx, _ in account_manager.get_available_accounts()]
+    if not account_indices:
+        return 0
+
+    start_time = time.time()
+    failed = _refresh_accounts(account_manager, account_indices, "warmup")
+    count = len(account_indices) - len(failed)
+    _last_warmup_time = datetime.now().isoformat()
+    _last_warmup_count = count
+    print(f"[JWT预刷新] 启动预热完成: {count}/{len(account_indices)} 个账号，耗时 {time.time() - start_time:.2f} 秒")
+    return count
+
+
+def _schedule_accounts(account_manager, heap: List[Tuple[float, int, float]], scheduled: Set[int], active: Set[int]):
+    """将尚未排期的近期活跃账号加入最小堆，按 jwt_time 计算到期时间
+
+    长期空闲的账号不提前刷新，下次被请求使用时在请求路径上按需刷新。
+    """
+    with account_manager.lock:
+        snapshot = [
+            (idx, state.get("jwt_time", 0) if state.get("jwt") else 0)
+            for idx, state in account_manager.account_states.items()
+            if idx in active and idx not in scheduled and idx < len(account_manager.accounts)
+        ]
+    for idx, jwt_time in snapshot:
+        if not account_manager.is_account_available(idx):
+            continue
+        heapq.heappush(heap, (jwt_time + JWT_PREREFRESH_AGE_SECONDS, idx, jwt_time))
+        scheduled.add(idx)
+
+
+def _refresher_loop(account_manager):
+    """预刷新循环：最小堆按到期时间排序，每次取出所有到期账号并发刷新"""
+    global _refresher_running
+    from .logger import print
+
+    _refresher_running = True
+    print(f"[JWT预刷新] 后台任务已启动，{JWT_PREREFRESH_ACTIVE_SECONDS} 秒内使用过的账号在 JWT 达到 "
+          f"{JWT_PREREFRESH_AGE_SECONDS} 秒时提前刷新")
+
+    try:
+        warm_up_jwts(account_manager)
+    except Exception as e:
+        print(f"[JWT预刷新] 启动预热出错: {e}")
+
+    heap: List[Tuple[float, int, float]] = []  # (到期时间, 账号索引, 排期时的 jwt_time)
+    scheduled: Set[int] = set()
+
+    while not _refresher_stop_event.is_set():
+        try:
+            active = set(get_recently_used_accounts(JWT_PREREFRESH_ACTIVE_SECONDS))
+            _schedule_accounts(account_manager, heap, scheduled, active)
+
+            now = time.time()
+            due = []
+            while heap and heap[0][0] <= now:
+                _, idx, scheduled_jwt_time = heapq.heappop(heap)
+                scheduled.discard(idx)
+                state = account_manager.account_states.get(idx)
+                if not state or idx not in active:
+                    # 账号已不再活跃：不再排期，再次被使用后重新加入
+                    continue
+                current_jwt_time = state.get("jwt_time", 0) if state.get("jwt") else 0
+                if current_jwt_time != scheduled_jwt_time:
+                    # JWT 已在请求路径上刷新（或被清除），按新的 jwt_time 重新排期
+                    continue
+                due.append(idx)
+
+            if due:
+                failed = _refresh_accounts(account_manager, due, "proactive")
+                # 失败的账号稍后重试，避免连续请求
+                retry_at = time.time() + _RETRY_DELAY_SECONDS
+                for idx in failed:
+                    state = account_manager.account_states.get(idx) or {}
+                    jwt_time = state.get("jwt_time", 0) if state.get("jwt") else 0
+                    heapq.heappush(heap, (retry_at, idx, jwt_time))
+                    scheduled.add(idx)
+                continue
+
+            wait_seconds = min(heap[0][0] - now, _IDLE_SCAN_SECONDS) if heap else _IDLE_SCAN_SECONDS
+        except Exception as e:
+            print(f"[JWT预刷新] 执行出错: {e}")
+            wait_seconds = _IDLE_SCAN_SECONDS
+
+        _refresher_stop_event.wait(max(0.5, wait_seconds))
+
+    _refresher_running = False
+    print("[JWT预刷新] 后台任务已停止")
+
+
+def start_jwt_refresher(account_manager):
+    """启动 JWT 预刷新后台任务（包含启动预热）"""
+    global _refresher_thread
+    from .logger import print
+
+    if _refresher_thread and _refresher_thread.is_alive():
+        print("[JWT预刷新] 后台任务已在运行中")
+        return
+
+    _refresher_stop_event.clear()
+    _refresher_thread = threading.Thread(
+        target=_refresher_loop,
+        args=(account_manager,),
+        daemon=True
+    )
+    _refresher_thread.start()
+
+
+def stop_jwt_refresher():
+    """停止 JWT 预刷新后台任务"""
+    from .logger import print
+
+    if not _refresher_running:
+        print("[JWT预刷新] 后台任务未在运行")
+        return
+
+    _refresher_stop_event.set()
+    print("[JWT预刷新] 正在停止后台任务...")
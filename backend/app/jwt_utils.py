@@ -5,12 +5,14 @@ import time
 import hmac
 import hashlib
 import base64
+import threading
 import requests
-from typing import Optional
+from typing import Optional, Dict, Tuple
 
-from .config import GETOXSRF_URL
+from .config import GETOXSRF_URL, XSRF_KEY_CACHE_SECONDS, XSRF_KEY_MIN_CACHE_SECONDS
 from .exceptions import AccountAuthError, AccountRequestError
 from .account_manager import account_manager
+from .http_client import get_http_client
 
 
 def url_safe_b64encode(data: bytes) -> str:
@@ -68,8 +70,131 @@ def create_jwt(key_bytes: bytes, key_id: str, csesidx: str) -> str:
     return f"{message}.{signature_b64}"
 
 
-def get_jwt_for_account(account: dict, proxy: str, account_idx: Optional[int] = None) -> str:
-    """为指定账号获取JWT"""
+def jwt_key_id(jwt: Optional[str]) -> Optional[str]:
+    """读取 JWT 头部的 kid（签名材料的 keyId），无法解析时返回 None"""
+    if not jwt:
+        return None
+    try:
+        header_b64 = jwt.split(".", 1)[0]
+        header = json.loads(base64.urlsafe_b64decode(header_b64 + "=" * (-len(header_b64) % 4)))
+        return header.get("kid")
+    except (ValueError, AttributeError):
+        return None
+
+
+# xsrf 签名材料缓存: {(csesidx, secure_c_ses): {key_id, key_bytes, fetched_at, local_mints}}
+_xsrf_key_cache: Dict[Tuple[str, str], Dict] = {}
+_xsrf_key_cache_lock = threading.Lock()
+_xsrf_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+# 根据上游拒绝时的缓存年龄学习到的有效期（None 表示尚未学习到）
+_xsrf_learned_lifetime: Optional[float] = None
+# 被拒绝但尚未确认原因的缓存年龄: {cache_key: age}，重新获取成功后才计入学习（排除 Cookie 本身失效的情况）
+_xsrf_pending_rejections: Dict[Tuple[str, str], float] = {}
+
+
+def _xsrf_cache_key(account: dict) -> Tuple[str, str]:
+    """缓存键：Cookie 变化后自动失效"""
+    return (account.get("csesidx") or "", account.get("secure_c_ses") or "")
+
+
+def _get_xsrf_cache_lifetime() -> float:
+    """获取签名材料缓存时长（配置值与学习值取较小者）"""
+    lifetime = XSRF_KEY_CACHE_SECONDS
+    if account_manager.config:
+        try:
+            lifetime = float(account_manager.config.get("xsrf_key_cache_seconds", lifetime))
+        except (TypeError, ValueError):
+            pass
+    if _xsrf_learned_lifetime is not None:
+        lifetime = min(lifetime, _xsrf_learned_lifetime)
+    return lifetime
+
+
+def get_xsrf_cache_stats() -> dict:
+    """获取 xsrf 签名材料缓存统计"""
+    with _xsrf_key_cache_lock:
+        stats = dict(_xsrf_cache_stats)
+        stats["entries"] = len(_xsrf_key_cache)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+    stats["lifetime_seconds"] = _get_xsrf_cache_lifetime()
+    stats["learned_lifetime_seconds"] = _xsrf_learned_lifetime
+    return stats
+
+
+def invalidate_xsrf_key(account_idx: int) -> bool:
+    """上游拒绝该账号的 JWT 时调用：丢弃缓存的签名材料和当前 JWT
+    
+    Returns:
+        被拒绝的 JWT 是否可能由缓存的签名材料在本地签发（即缓存可能已过期）
+    """
+    if not (0 <= account_idx < len(account_manager.accounts)):
+        return False
+    
+    with _xsrf_key_cache_lock:
+        entry = _xsrf_key_cache.pop(_xsrf_cache_key(account_manager.accounts[account_idx]), None)
+        if entry is None:
+            return False
+        _xsrf_cache_stats["invalidations"] += 1
+        stale = entry["local_mints"] > 0
+        if stale:
+            _xsrf_pending_rejections[_xsrf_cache_key(account_manager.accounts[account_idx])] = time.time() - entry["fetched_at"]
+    
+    if stale:
+        with account_manager.lock:
+            state = account_manager.account_states.get(account_idx)
+            if state:
+                state["jwt"] = None
+                state["jwt_time"] = 0
+    return stale
+
+
+def _store_xsrf_key(account: dict, key_id: str, key_bytes: bytes):
+    """保存新获取的签名材料；若此前缓存被拒绝且本次获取成功，说明缓存确已过期，据此学习有效期"""
+    global _xsrf_learned_lifetime
+    key = _xsrf_cache_key(account)
+    with _xsrf_key_cache_lock:
+        _xsrf_key_cache[key] = {
+            "key_id": key_id,
+            "key_bytes": key_bytes,
+            "fetched_at": time.time(),
+            "local_mints": 0
+        }
+        rejected_age = _xsrf_pending_rejections.pop(key, None)
+        if rejected_age is not None:
+            # 学习有效期：只缩短不延长，且不低于一个 JWT 的有效期
+            learned = max(XSRF_KEY_MIN_CACHE_SECONDS, rejected_age * 0.8)
+            if _xsrf_learned_lifetime is None or learned < _xsrf_learned_lifetime:
+                _xsrf_learned_lifetime = learned
+
+
+def _mint_jwt_from_cache(account: dict) -> Optional[str]:
+    """使用缓存的签名材料在本地签发 JWT，缓存不存在或已过期时返回 None"""
+    key = _xsrf_cache_key(account)
+    lifetime = _get_xsrf_cache_lifetime()
+    with _xsrf_key_cache_lock:
+        entry = _xsrf_key_cache.get(key)
+        if entry is None or time.time() - entry["fetched_at"] > lifetime:
+            _xsrf_key_cache.pop(key, None)
+            _xsrf_cache_stats["misses"] += 1
+            return None
+        entry["local_mints"] += 1
+        _xsrf_cache_stats["hits"] += 1
+        key_bytes, key_id = entry["key_bytes"], entry["key_id"]
+    return create_jwt(key_bytes, key_id, account.get("csesidx"))
+
+
+def get_jwt_for_account(account: dict, proxy: str, account_idx: Optional[int] = None, use_cache: bool = True) -> str:
+    """为指定账号获取JWT
+    
+    优先使用缓存的 keyId/xsrfToken 在本地签发；缓存缺失、过期或被上游拒绝后才请求 getoxsrf。
+    
+    Args:
+        account: 账号信息
+        proxy: 代理地址
+        account_idx: 账号索引（用于错误处理）
+        use_cache: 是否允许使用缓存的签名材料（健康检查等需要真实验证 Cookie 的场景传 False）
+    """
     from .utils import raise_for_account_response
     
     secure_c_ses = account.get("secure_c_ses")
@@ -78,9 +203,13 @@ def get_jwt_for_account(account: dict, proxy: str, account_idx: Optional[int] =
 
     if not secure_c_ses or not csesidx:
         raise ValueError("缺少 secure_c_ses 或 csesidx")
+    
+    if use_cache:
+        jwt = _mint_jwt_from_cache(account)
+        if jwt:
+            return jwt
 
     url = f"{GETOXSRF_URL}?csesidx={csesidx}"
-    proxies = {"http": proxy, "https": proxy} if proxy else None
 
     headers = {
         "accept": "*/*",
@@ -89,13 +218,13 @@ def get_jwt_for_account(account: dict, proxy: str, account_idx: Optional[int] =
     }
 
     try:
-        resp = requests.get(url, headers=headers, proxies=proxies, verify=False, timeout=30)
+        resp = get_http_client(proxy, account_idx).get(url, headers=headers, verify=False, timeout=30)
     except requests.RequestException as e:
         raise AccountRequestError(f"获取JWT 请求失败: {e}") from e
 
     if resp.status_code != 200:
         if account_idx is not None:
-            raise_for_account_response(resp, "获取JWT", account_idx)
+            raise_for_account_response(resp, "获取JWT", account_idx, jwt_auth=False)
         else:
             raise AccountAuthError(f"获取JWT失败: HTTP {resp.status_code}")
 
@@ -117,6 +246,8 @@ def get_jwt_for_account(account: dict, proxy: str, account_idx: Optional[int] =
     print(f"账号: {account.get('csesidx')} 账号可用! key_id: {key_id}")
 
     key_bytes = decode_xsrf_token(xsrf_token)
+    
+    _store_xsrf_key(account, key_id, key_bytes)
 
     return create_jwt(key_bytes, key_id, csesidx)
 
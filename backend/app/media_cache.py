@@ -0,0 +1,406 @@
+"""媒体缓存模块 - 按内容哈希存储图片/视频，相同内容只保存一份，按总字节数做 LRU 淘汰"""
+
+import hashlib
+import heapq
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from .config import (
+    IMAGE_CACHE_DIR, VIDEO_CACHE_DIR, IMAGE_CACHE_HOURS, VIDEO_CACHE_HOURS,
+    IMAGE_CACHE_MAX_BYTES, VIDEO_CACHE_MAX_BYTES, MEDIA_STREAM_CHUNK_SIZE
+)
+
+_OBJECTS_DIR = "objects"
+_TMP_DIR = "tmp"
+_ALIAS_FILE = "aliases.jsonl"
+
+
+class MediaCache:
+    """内容寻址的媒体缓存
+
+    文件按 sha256 命名，存放在 objects/ab/cd/<hash><ext> 的分片目录中，相同内容只保存一份；
+    对外仍使用原来的文件名（/image/<filename>、/video/<filename>），通过别名表映射到对象。
+    LRU 索引只保存在内存中，启动时扫描对象目录重建；别名表以追加方式写入 aliases.jsonl。
+    过期时间保存在最小堆中，由后台清理线程（cache_janitor）按到期顺序删除。
+    """
+
+    def __init__(self, root: Path, label: str, max_age_seconds: float, default_max_bytes: int, config_key: str):
+        self.root = root
+        self.label = label
+        self.max_age_seconds = max_age_seconds
+        self.default_max_bytes = default_max_bytes
+        self.config_key = config_key
+        self._objects: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()  # 对象名 -> (大小, 最近访问时间)，按访问顺序排列
+        self._aliases: Dict[str, str] = {}        # 对外文件名 -> 对象名
+        self._object_aliases: Dict[str, Set[str]] = {}  # 对象名 -> 对外文件名集合
+        self._expiry: List[Tuple[float, str]] = []  # 最小堆: (到期时间, 对象名)，访问后的到期时间在出堆时重新计算
+        self._total_bytes = 0
+        self._alias_log_lines = 0
+        self._load_seconds: Optional[float] = None
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._stats = {"stored": 0, "deduplicated": 0, "evicted": 0, "expired": 0, "hits": 0, "misses": 0,
+                       "responses_full": 0, "responses_partial": 0, "responses_not_modified": 0, "responses_offloaded": 0,
+                       "bytes_sent": 0}
+
+    # ---------- 路径 ----------
+
+    def _object_path(self, object_name: str) -> Path:
+        return self.root / _OBJECTS_DIR / object_name[:2] / object_name[2:4] / object_name
+
+    def _alias_path(self) -> Path:
+        return self.root / _ALIAS_FILE
+
+    def temp_path(self) -> Path:
+        """返回一个新的临时文件路径（与对象目录位于同一文件系统，便于原子重命名）"""
+        # 先完成加载，加载时会清理临时目录中的残留文件
+        self._ensure_loaded()
+        tmp_dir = self.root / _TMP_DIR
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        return tmp_dir / f"{uuid.uuid4().hex}.part"
+
+    def get_max_bytes(self) -> int:
+        """缓存总字节数上限（配置 image_cache_max_mb / video_cache_max_mb 覆盖，0 表示不限制）"""
+        from .account_manager import account_manager
+
+        if account_manager.config and self.config_key in account_manager.config:
+            try:
+                return max(0, int(float(account_manager.config[self.config_key]) * 1024 * 1024))
+            except (TypeError, ValueError):
+                pass
+        return self.default_max_bytes
+
+    # ---------- 启动加载 ----------
+
+    def load(self):
+        """扫描对象目录重建 LRU 索引，回放别名表，并把旧版平铺文件迁移到内容寻址目录"""
+        from .logger import print
+
+        start_time = time.time()
+        with self._lock:
+            if self._loaded:
+                return
+            self.root.mkdir(parents=True, exist_ok=True)
+
+            objects: List[Tuple[float, str, int]] = []
+            objects_dir = self.root / _OBJECTS_DIR
+            if objects_dir.exists():
+                for path in objects_dir.glob("*/*/*"):
+                    try:
+                        st = path.stat()
+                    except OSError:
+                        continue
+                    objects.append((st.st_mtime, path.name, st.st_size))
+            # 以修改时间作为初始访问时间，最旧的排在最前面
+            for mtime, name, size in sorted(objects):
+                self._objects[name] = (size, mtime)
+                self._total_bytes += size
+
+            self._replay_aliases()
+            migrated = self._migrate_legacy_files()
+            self._compact_aliases()
+
+            # 清理上次运行残留的临时文件
+            tmp_dir = self.root / _TMP_DIR
+            if tmp_dir.exists():
+                for path in tmp_dir.iterdir():
+                    try:
+                        path.unlink()
+                    except OSError:
+                        pass
+
+            # 启动时一次性建立过期堆，之后只在保存文件时追加
+            self._expiry = [(last_access + self.max_age_seconds, name)
+                            for name, (_, last_access) in self._objects.items()]
+            heapq.heapify(self._expiry)
+            self._loaded = True
+            victims = self._collect_evictions(self.get_max_bytes())
+            self._load_seconds = time.time() - start_time
+
+        self._unlink_objects(victims)
+        print(f"[媒体缓存] {self.label}缓存已加载: {len(self._objects)} 个文件，{self._total_bytes / 1024 / 1024:.1f} MB"
+              + (f"，迁移旧文件 {migrated} 个" if migrated else ""))
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+
+    def _replay_aliases(self):
+        path = self._alias_path()
+        if not path.exists():
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                alias, object_name = entry.get("a"), entry.get("o")
+                if alias and object_name in self._objects:
+                    self._link(alias, object_name)
+
+    def _migrate_legacy_files(self) -> int:
+        """旧版本直接保存在缓存目录下的文件：计算哈希后移入对象目录，原文件名作为别名"""
+        migrated = 0
+        for path in self.root.iterdir():
+            if not path.is_file() or path.name == _ALIAS_FILE or path.name.endswith(".part"):
+                continue
+            try:
+                digest = hashlib.sha256()
+                with open(path, "rb") as f:
+                    for chunk in iter(lambda: f.read(MEDIA_STREAM_CHUNK_SIZE), b""):
+                        digest.update(chunk)
+                object_name = digest.hexdigest() + path.suffix.lower()
+                mtime = path.stat().st_mtime
+                if object_name in self._objects:
+                    path.unlink()
+                else:
+                    size = self._place(path, object_name)
+                    self._objects[object_name] = (size, mtime)
+                    self._total_bytes += size
+                if path.name not in self._aliases:
+                    self._link(path.name, object_name)
+                migrated += 1
+            except OSError:
+                continue
+        return migrated
+
+    # ---------- 别名 ----------
+
+    def _link(self, alias: str, object_name: str):
+        old = self._aliases.get(alias)
+        if old and old != object_name:
+            self._object_aliases.get(old, set()).discard(alias)
+        self._aliases[alias] = object_name
+        self._object_aliases.setdefault(object_name, set()).add(alias)
+
+    def _append_alias(self, alias: str, object_name: str):
+        with open(self._alias_path(), "a", encoding="utf-8") as f:
+            f.write(json.dumps({"a": alias, "o": object_name}) + "\n")
+        self._alias_log_lines += 1
+
+    def _compact_aliases(self):
+        """重写别名表，只保留仍然有效的条目"""
+        path = self._alias_path()
+        tmp_path = path.with_name(path.name + ".part")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for alias, object_name in self._aliases.items():
+                f.write(json.dumps({"a": alias, "o": object_name}) + "\n")
+        os.replace(tmp_path, path)
+        self._alias_log_lines = len(self._aliases)
+
+    def _unique_alias(self, filename: str, object_name: str) -> str:
+        """别名已指向其他内容时添加数字后缀（只查内存中的别名表）"""
+        candidate = filename
+        stem, ext = os.path.splitext(filename)
+        counter = 1
+        while self._aliases.get(candidate, object_name) != object_name:
+            candidate = f"{stem}_{counter}{ext}"
+            counter += 1
+        return candidate
+
+    # ---------- 写入 ----------
+
+    def _place(self, src: Path, object_name: str) -> int:
+        dest = self._object_path(object_name)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(src, dest)
+        return dest.stat().st_size
+
+    def commit(self, tmp_path: Path, digest: str, filename: str) -> str:
+        """将已写好的临时文件按内容哈希入库，返回对外文件名
+
+        Args:
+            tmp_path: temp_path() 返回的临时文件
+            digest: 文件内容的 sha256 十六进制摘要
+            filename: 期望的对外文件名（决定扩展名）
+        """
+        self._ensure_loaded()
+        object_name = digest + os.path.splitext(filename)[1].lower()
+        now = time.time()
+        with self._lock:
+            if object_name in self._objects:
+                size, _ = self._objects.pop(object_name)
+                self._stats["deduplicated"] += 1
+                try:
+                    tmp_path.unlink()
+                except OSError:
+                    pass
+            else:
+                size = self._place(tmp_path, object_name)
+                self._total_bytes += size
+                self._stats["stored"] += 1
+                heapq.heappush(self._expiry, (now + self.max_age_seconds, object_name))
+            self._objects[object_name] = (size, now)
+
+            alias = self._unique_alias(filename, object_name)
+            if self._aliases.get(alias) != object_name:
+                self._link(alias, object_name)
+                self._append_alias(alias, object_name)
+            victims = self._collect_evictions(self.get_max_bytes(), keep=object_name)
+        self._unlink_objects(victims)
+        return alias
+
+    def store_bytes(self, data: bytes, filename: str) -> str:
+        """保存内存中的数据，返回对外文件名"""
+        return self.store_chunks((data,), filename)
+
+    def store_chunks(self, chunks: Iterable[bytes], filename: str) -> str:
+        """边写边计算哈希，逐块保存数据，返回对外文件名"""
+        tmp_path = self.temp_path()
+        digest = hashlib.sha256()
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in chunks:
+                    if chunk:
+                        digest.update(chunk)
+                        f.write(chunk)
+        except BaseException:
+            try:
+                tmp_path.unlink()
+            except OSError:
+                pass
+            raise
+        return self.commit(tmp_path, digest.hexdigest(), filename)
+
+    # ---------- 读取 ----------
+
+    def resolve(self, filename: str) -> Optional[Path]:
+        """根据对外文件名查找缓存文件，并更新 LRU 访问时间"""
+        self._ensure_loaded()
+        with self._lock:
+            object_name = self._aliases.get(filename)
+            entry = self._objects.get(object_name) if object_name else None
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._objects[object_name] = (entry[0], time.time())
+            self._objects.move_to_end(object_name)
+            self._stats["hits"] += 1
+        return self._object_path(object_name)
+
+    def record_response(self, status_code: int, content_length: int):
+        """记录一次文件响应（200 完整、206 分段、304 未修改，0 表示交给反向代理发送）"""
+        key = {206: "responses_partial", 304: "responses_not_modified", 0: "responses_offloaded"}.get(
+            status_code, "responses_full")
+        with self._lock:
+            self._stats[key] += 1
+            if status_code != 304:
+                self._stats["bytes_sent"] += content_length
+
+    def path_for(self, filename: str) -> Optional[Path]:
+        """根据对外文件名返回缓存文件路径（不计入命中统计，不更新访问时间）"""
+        with self._lock:
+            object_name = self._aliases.get(filename)
+        return self._object_path(object_name) if object_name else None
+
+    # ---------- 淘汰 ----------
+
+    def _drop(self, object_name: str) -> str:
+        # 过期堆中的条目不在此处删除，出堆时发现对象已不存在即跳过
+        size, _ = self._objects.pop(object_name)
+        self._total_bytes -= size
+        for alias in self._object_aliases.pop(object_name, ()):
+            self._aliases.pop(alias, None)
+        return object_name
+
+    def _collect_evictions(self, max_bytes: int, keep: Optional[str] = None) -> List[str]:
+        """超出总字节数上限时按 LRU 顺序移出索引，返回需要删除的对象（调用方持有锁）"""
+        victims = []
+        if max_bytes > 0:
+            for object_name in list(self._objects):
+                if self._total_bytes <= max_bytes:
+                    break
+                if object_name == keep:
+                    continue
+                victims.append(self._drop(object_name))
+            self._stats["evicted"] += len(victims)
+        self._maybe_compact()
+        return victims
+
+    def _maybe_compact(self):
+        # 别名表中失效的行多于有效行时重写
+        if self._alias_log_lines > 2 * len(self._aliases) + 100:
+            try:
+                self._compact_aliases()
+            except OSError:
+                pass
+
+    def _unlink_objects(self, object_names: List[str]):
+        """删除已移出索引的对象文件
+
+        释放锁之后 commit() 可能又保存了相同内容并重新登记该对象，
+        因此删除前在锁内再确认一次对象仍不在索引中，避免删掉刚入库的文件。
+        """
+        for object_name in object_names:
+            with self._lock:
+                if object_name in self._objects:
+                    continue
+                try:
+                    self._object_path(object_name).unlink()
+                except OSError:
+                    pass
+
+    def next_expiry(self) -> Optional[float]:
+        """最早的到期时间（可能因期间被访问而推迟），没有文件时返回 None"""
+        with self._lock:
+            return self._expiry[0][0] if self._expiry else None
+
+    def expire_due(self, limit: int) -> Tuple[int, int]:
+        """删除最多 limit 个已到期（超过缓存时间未被访问）的文件，返回 (文件数, 字节数)"""
+        now = time.time()
+        victims = []
+        reclaimed_bytes = 0
+        with self._lock:
+            while self._expiry and self._expiry[0][0] <= now and len(victims) < limit:
+                _, object_name = heapq.heappop(self._expiry)
+                entry = self._objects.get(object_name)
+                if entry is None:
+                    continue
+                size, last_access = entry
+                expires_at = last_access + self.max_age_seconds
+                if expires_at > now:
+                    # 入堆后又被访问过，按新的访问时间重新排期
+                    heapq.heappush(self._expiry, (expires_at, object_name))
+                    continue
+                victims.append(self._drop(object_name))
+                reclaimed_bytes += size
+            self._stats["expired"] += len(victims)
+            if victims:
+                self._maybe_compact()
+        self._unlink_objects(victims)
+        return len(victims), reclaimed_bytes
+
+    def get_stats(self) -> dict:
+        """获取缓存统计信息"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["files"] = len(self._objects)
+            stats["aliases"] = len(self._aliases)
+            stats["total_bytes"] = self._total_bytes
+        stats["max_bytes"] = self.get_max_bytes()
+        stats["loaded"] = self._loaded
+        stats["max_age_seconds"] = self.max_age_seconds
+        stats["load_ms"] = round(self._load_seconds * 1000, 1) if self._load_seconds is not None else None
+        return stats
+
+
+# 全局缓存实例
+image_cache = MediaCache(IMAGE_CACHE_DIR, "图片", IMAGE_CACHE_HOURS * 3600, IMAGE_CACHE_MAX_BYTES, "image_cache_max_mb")
+video_cache = MediaCache(VIDEO_CACHE_DIR, "视频", VIDEO_CACHE_HOURS * 3600, VIDEO_CACHE_MAX_BYTES, "video_cache_max_mb")
+
+
+def cache_for_mime(mime_type: Optional[str]) -> MediaCache:
+    """根据 MIME 类型选择缓存"""
+    return video_cache if (mime_type or "").startswith("video/") else image_cache
+
+
+def get_media_cache_stats() -> dict:
+    """获取图片/视频缓存统计信息"""
+    return {"image": image_cache.get_stats(), "video": video_cache.get_stats()}
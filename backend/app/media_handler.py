@@ -1,17 +1,18 @@
 """媒体处理模块 - 图片/视频缓存、下载、清理"""
 
-import os
 import re
 import uuid
+import itertools
 import mimetypes
 import shutil
 import base64
 import requests
-from pathlib import Path
 from datetime import datetime
-from typing import Optional, Dict, List, Any, Tuple
+from typing import Optional, Dict, List, Any, Tuple, Iterator
 
-from .config import IMAGE_CACHE_DIR, VIDEO_CACHE_DIR, IMAGE_CACHE_HOURS, VIDEO_CACHE_HOURS, MEDIA_STREAM_CHUNK_SIZE
+from .config import MEDIA_STREAM_CHUNK_SIZE
+from .media_cache import image_cache, video_cache, cache_for_mime
+from .deadline import Deadline, deadline_watchdog
 
 # MIME 类型到扩展名映射
 MIME_EXTENSION_MAP = {
@@ -44,21 +45,8 @@ def sanitize_filename(name: Optional[str], ext: str) -> str:
     return safe
 
 
-def ensure_unique_filename(directory: Path, filename: str) -> str:
-    """确保文件名唯一，如果存在则添加数字后缀"""
-    candidate = filename
-    stem, ext = os.path.splitext(candidate)
-    counter = 1
-    while (directory / candidate).exists():
-        candidate = f"{stem}_{counter}{ext}"
-        counter += 1
-    return candidate
-
-
-def save_image_to_cache(image_data: bytes, mime_type: str = "image/png", filename: Optional[str] = None) -> str:
-    """保存图片到缓存目录，返回文件名"""
-    IMAGE_CACHE_DIR.mkdir(exist_ok=True)
-    
+def _image_cache_filename(mime_type: str = "image/png", filename: Optional[str] = None) -> str:
+    """生成图片缓存文件名"""
     # 确定文件扩展名
     ext = get_extension_for_mime(mime_type or "image/png", ".png")
     
@@ -69,17 +57,16 @@ def save_image_to_cache(image_data: bytes, mime_type: str = "image/png", filenam
     else:
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = f"gemini_{timestamp}_{uuid.uuid4().hex[:8]}{ext}"
-    
-    filepath = IMAGE_CACHE_DIR / filename
-    with open(filepath, "wb") as f:
-        f.write(image_data)
-    
     return filename
 
 
+def save_image_to_cache(image_data: bytes, mime_type: str = "image/png", filename: Optional[str] = None) -> str:
+    """保存图片到缓存（相同内容只保存一份），返回文件名"""
+    return image_cache.store_bytes(image_data, _image_cache_filename(mime_type, filename))
+
+
 def save_video_to_cache(video_data: bytes, mime_type: str = "video/mp4", filename: Optional[str] = None) -> str:
-    """保存视频到缓存目录"""
-    VIDEO_CACHE_DIR.mkdir(exist_ok=True)
+    """保存视频到缓存（相同内容只保存一份），返回文件名"""
     ext = get_extension_for_mime(mime_type or "video/mp4", ".mp4")
     if filename:
         if not filename.lower().endswith(ext.lower()):
@@ -87,79 +74,134 @@ def save_video_to_cache(video_data: bytes, mime_type: str = "video/mp4", filenam
     else:
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = f"gemini_video_{timestamp}_{uuid.uuid4().hex[:8]}{ext}"
-    filename = ensure_unique_filename(VIDEO_CACHE_DIR, filename)
-    filepath = VIDEO_CACHE_DIR / filename
-    with open(filepath, "wb") as f:
-        f.write(video_data)
-    return filename
-
-
-def _cleanup_expired_cache(directory: Path, max_age_hours: int, label: str):
-    """清理过期的缓存文件"""
-    if not directory.exists():
-        return
-    
-    now = datetime.now().timestamp()
-    max_age_seconds = max_age_hours * 3600
-    removed = 0
-    
-    for filepath in directory.iterdir():
-        if filepath.is_file():
-            try:
-                file_age = now - filepath.stat().st_mtime
-                if file_age > max_age_seconds:
-                    filepath.unlink()
-                    removed += 1
-            except Exception:
-                pass
-    
-    if removed > 0:
-        print(f"[清理] 已删除 {removed} 个过期{label}缓存文件")
-
-
-def cleanup_expired_images():
-    """清理过期的图片缓存"""
-    _cleanup_expired_cache(IMAGE_CACHE_DIR, IMAGE_CACHE_HOURS, "图片")
-
-
-def cleanup_expired_videos():
-    """清理过期的视频缓存"""
-    _cleanup_expired_cache(VIDEO_CACHE_DIR, VIDEO_CACHE_HOURS, "视频")
+    return video_cache.store_bytes(video_data, filename)
 
 
 def download_file_streaming(jwt: str, session_name: str, file_id: str, mime_type: str,
-                            suggested_name: Optional[str] = None, proxy: Optional[str] = None) -> str:
-    """以流式方式下载文件并保存到对应缓存目录，返回文件名"""
-    import requests
+                            suggested_name: Optional[str] = None, proxy: Optional[str] = None,
+                            deadline: Optional[Deadline] = None, account_idx: Optional[int] = None) -> str:
+    """以流式方式下载文件并保存到对应缓存，返回文件名
+
+    指定 deadline 时连接/读取超时使用其 connect/idle 预算，超出总时长时由超时检查线程关闭下载，
+    卡住的下载不会占用线程到 600 秒。
+    """
     from .session_manager import get_headers
-    
-    target_dir = VIDEO_CACHE_DIR if (mime_type or "").startswith("video/") else IMAGE_CACHE_DIR
-    target_dir.mkdir(exist_ok=True)
+    from .http_client import get_http_client
     
     ext = get_extension_for_mime(mime_type, ".bin")
     filename = sanitize_filename(suggested_name, ext)
-    filename = ensure_unique_filename(target_dir, filename)
-    filepath = target_dir / filename
     
     url = build_download_url(session_name, file_id)
-    proxies = {"http": proxy, "https": proxy} if proxy else None
     
-    with requests.get(
+    with get_http_client(proxy, account_idx).get(
         url,
         headers=get_headers(jwt),
-        proxies=proxies,
         verify=False,
-        timeout=600,
+        timeout=deadline.timeout("idle") if deadline else 600,
         stream=True,
         allow_redirects=True
     ) as resp:
         resp.raise_for_status()
-        with open(filepath, "wb") as f:
-            for chunk in resp.iter_content(MEDIA_STREAM_CHUNK_SIZE):
-                if chunk:
-                    f.write(chunk)
+        return _store_download(resp, cache_for_mime(mime_type), filename, deadline)
+
+
+def download_image_to_cache(jwt: str, session_name: str, file_id: str, mime_type: str = "image/png",
+                            filename: Optional[str] = None, proxy: Optional[str] = None,
+                            deadline: Optional[Deadline] = None, account_idx: Optional[int] = None) -> str:
+    """流式下载生成的图片并保存到图片缓存，返回文件名
     
-    return filename
+    与 download_file_with_jwt + save_image_to_cache 结果相同，但不在内存中保存完整文件。
+    """
+    from .session_manager import get_headers
+    from .http_client import get_http_client
+    
+    filename = _image_cache_filename(mime_type, filename)
+    
+    with get_http_client(proxy, account_idx).get(
+        build_download_url(session_name, file_id),
+        headers=get_headers(jwt),
+        verify=False,
+        timeout=deadline.timeout("idle") if deadline else 120,
+        stream=True,
+        allow_redirects=True
+    ) as resp:
+        resp.raise_for_status()
+        return _store_download(resp, image_cache, filename, deadline)
+
+
+def _store_download(resp: requests.Response, cache, filename: str, deadline: Optional[Deadline] = None) -> str:
+    """把下载内容写入缓存；指定 deadline 时登记到超时检查线程，超出预算时关闭下载并抛出 AccountTimeoutError"""
+    if deadline:
+        deadline_watchdog.watch(deadline, resp)
+    try:
+        return cache.store_chunks(iter_download_content(resp, deadline), filename)
+    except Exception as e:
+        if deadline and deadline.expired_phase:
+            raise deadline.error(deadline.expired_phase) from e
+        raise
+    finally:
+        deadline_watchdog.unwatch(resp)
+
+
+# 下载接口有时以 base64 文本返回图片（PNG: iVBORw0KGgo，JPEG: /9j/），只需检查开头几个字节即可识别
+_BASE64_IMAGE_PREFIXES = (b"iVBORw0KGgo", b"/9j/")
+_SNIFF_BYTES = 16
+
+
+def _is_base64_image(head: bytes) -> bool:
+    """根据开头字节判断内容是否为 base64 编码的图片"""
+    return head.lstrip().startswith(_BASE64_IMAGE_PREFIXES)
+
+
+class _Base64StreamDecoder:
+    """增量 base64 解码器：每次只解码完整的 4 字符组，剩余字符留到下一块"""
+
+    def __init__(self):
+        self._pending = b""
+
+    def feed(self, chunk: bytes) -> bytes:
+        data = self._pending + b"".join(chunk.split())
+        usable = len(data) - len(data) % 4
+        self._pending = data[usable:]
+        return base64.b64decode(data[:usable]) if usable else b""
+
+    def finish(self) -> bytes:
+        if not self._pending:
+            return b""
+        data = self._pending + b"=" * (-len(self._pending) % 4)
+        self._pending = b""
+        return base64.b64decode(data)
+
+
+def iter_download_content(resp: requests.Response, deadline: Optional[Deadline] = None) -> Iterator[bytes]:
+    """逐块产出下载响应的文件内容
+    
+    只嗅探开头字节判断是原始数据还是 base64 文本，base64 内容边读边解码。
+    指定 deadline 时每收到一块数据记录一次进度（数据间隔由超时检查线程检查）。
+    """
+    chunks = resp.iter_content(MEDIA_STREAM_CHUNK_SIZE)
+    if deadline:
+        chunks = _touching(chunks, deadline)
+    head = b""
+    for chunk in chunks:
+        head += chunk
+        if len(head.lstrip()) >= _SNIFF_BYTES:
+            break
+    
+    decoder = _Base64StreamDecoder() if _is_base64_image(head) else None
+    for chunk in itertools.chain((head,), chunks):
+        if chunk:
+            yield decoder.feed(chunk) if decoder else chunk
+    if decoder:
+        yield decoder.finish()
+
+
+def _touching(chunks: Iterator[bytes], deadline: Deadline) -> Iterator[bytes]:
+    for chunk in chunks:
+        deadline.touch()
+        yield chunk
+    # 下载被超时检查线程关闭时读取可能直接结束，不能把不完整的文件当作下载成功
+    deadline.raise_if_expired()
 
 
 def build_download_url(session_name: str, file_id: str) -> str:
@@ -167,19 +209,17 @@ def build_download_url(session_name: str, file_id: str) -> str:
     return f"https://biz-discoveryengine.googleapis.com/v1alpha/{session_name}:downloadFile?fileId={file_id}&alt=media"
 
 
-def download_file_with_jwt(jwt: str, session_name: str, file_id: str, proxy: Optional[str] = None) -> bytes:
-    """使用JWT认证下载文件"""
-    import requests
-    import base64
+def download_file_with_jwt(jwt: str, session_name: str, file_id: str, proxy: Optional[str] = None,
+                           account_idx: Optional[int] = None) -> bytes:
+    """使用JWT认证下载文件（需要将内容保存到缓存时优先使用 download_image_to_cache）"""
     from .session_manager import get_headers
+    from .http_client import get_http_client
     
     url = build_download_url(session_name, file_id)
-    proxies = {"http": proxy, "https": proxy} if proxy else None
     
-    resp = requests.get(
+    resp = get_http_client(proxy, account_idx).get(
         url,
         headers=get_headers(jwt),
-        proxies=proxies,
         verify=False,
         timeout=120,
         allow_redirects=True
@@ -188,14 +228,12 @@ def download_file_with_jwt(jwt: str, session_name: str, file_id: str, proxy: Opt
     resp.raise_for_status()
     content = resp.content
     
-    # 检测是否为base64编码的内容
-    try:
-        text_content = content.decode("utf-8", errors="ignore").strip()
-        if text_content.startswith("iVBORw0KGgo") or text_content.startswith("/9j/"):
-            # 是base64编码，需要解码
-            return base64.b64decode(text_content)
-    except Exception:
-        pass
+    # 检测是否为base64编码的内容（只检查开头字节，不对整个文件做 UTF-8 解码）
+    if _is_base64_image(content[:_SNIFF_BYTES * 4]):
+        try:
+            return base64.b64decode(content)
+        except Exception:
+            pass
     
     return content
 
@@ -298,22 +336,23 @@ def extract_images_from_openai_content(content: Any) -> Tuple[str, List[Dict]]:
 
 
 def download_image_from_url(url: str, proxy: Optional[str] = None) -> Tuple[bytes, str]:
-    """从URL下载图片，返回(图片数据, mime_type)"""
-    proxies = {"http": proxy, "https": proxy} if proxy else None
-    resp = requests.get(url, proxies=proxies, verify=False, timeout=60)
-    resp.raise_for_status()
-    
-    content_type = resp.headers.get("Content-Type", "image/png")
-    # 提取主mime类型
-    mime_type = content_type.split(";")[0].strip()
+    """从URL下载图片，返回(图片数据, mime_type)
     
-    return resp.content, mime_type
+    结果按响应的 Cache-Control/ETag 缓存，过期后使用条件请求重新验证，同一 URL 的并发下载会合并。
+    """
+    from .url_image_cache import url_image_cache
+    return url_image_cache.fetch(url, proxy)
 
 
-def get_session_file_metadata(jwt: str, session_name: str, team_id: str, proxy: Optional[str] = None) -> Dict:
-    """获取会话中的文件元数据（AI生成的图片）"""
+def get_session_file_metadata(jwt: str, session_name: str, team_id: str, proxy: Optional[str] = None,
+                              deadline: Optional[Deadline] = None, account_idx: Optional[int] = None) -> Dict:
+    """获取会话中的文件元数据（AI生成的图片）
+    
+    指定 deadline 时使用其连接/首字节预算（不受对话总时长限制，媒体处理有各自的截止时间）。
+    """
     from .config import LIST_FILE_METADATA_URL
     from .session_manager import get_headers
+    from .http_client import get_http_client
     
     body = {
         "configId": team_id,
@@ -324,14 +363,12 @@ def get_session_file_metadata(jwt: str, session_name: str, team_id: str, proxy:
         }
     }
     
-    proxies = {"http": proxy, "https": proxy} if proxy else None
-    resp = requests.post(
+    resp = get_http_client(proxy, account_idx).post(
         LIST_FILE_METADATA_URL,
         headers=get_headers(jwt),
         json=body,
-        proxies=proxies,
         verify=False,
-        timeout=30
+        timeout=deadline.timeout("first_byte", within_total=False) if deadline else 30
     )
     
     if resp.status_code != 200:
@@ -8,14 +8,15 @@ import uuid
 import hashlib
 import mimetypes
 import re
+import random
 import secrets
 import traceback
-import base64
 from datetime import datetime
 from typing import List, Optional, Dict, Any
 from pathlib import Path
 
-from flask import request, Response, jsonify, send_from_directory, abort, redirect, render_template
+from flask import request, Response, jsonify, send_file, abort, redirect, render_template
+from werkzeug.exceptions import RequestEntityTooLarge
 
 # 导入 WebSocket 管理器
 from .websocket_manager import (
@@ -27,11 +28,11 @@ from .websocket_manager import (
 )
 
 # 导入配置和常量
-from .config import IMAGE_CACHE_DIR, VIDEO_CACHE_DIR, CONFIG_FILE, PLAYWRIGHT_AVAILABLE, PLAYWRIGHT_BROWSER_INSTALLED
+from .config import DATA_DIR, MEDIA_OFFLOAD_PREFIX, UPLOAD_FORM_OVERHEAD_BYTES, TIMEOUT_ERROR_COOLDOWN_SECONDS, CONFIG_FILE, PLAYWRIGHT_AVAILABLE, PLAYWRIGHT_BROWSER_INSTALLED
 
 # 导入账号管理和文件管理
 from .account_manager import account_manager
-from .file_manager import file_manager
+from .file_manager import file_manager, upload_cache
 
 # 导入认证装饰器
 from .auth import (
@@ -46,12 +47,16 @@ from .auth import (
 from . import auth
 
 # 导入会话管理
-from .session_manager import ensure_session_for_account, ensure_jwt_for_account, upload_file_to_gemini, upload_inline_image_to_gemini
+from .session_manager import (
+    ensure_session_for_account, ensure_jwt_for_account, upload_file_to_gemini,
+    prepare_inline_image, upload_inline_images_to_gemini
+)
 
 # 导入聊天处理
 from .chat_handler import (
     stream_chat_with_images,
     stream_chat_realtime_generator,
+    UpstreamStreamHandle,
     build_openai_response_content,
     get_image_base_url,
     detect_client_image_format
@@ -59,8 +64,6 @@ from .chat_handler import (
 
 # 导入媒体处理
 from .media_handler import (
-    cleanup_expired_images,
-    cleanup_expired_videos,
     extract_images_from_openai_content,
     extract_images_from_files_array
 )
@@ -72,16 +75,28 @@ except Exception:
     auto_refresh_account_cookie = None
 
 # 导入 JWT 工具
-from .jwt_utils import get_jwt_for_account
+from .jwt_utils import get_jwt_for_account, get_xsrf_cache_stats
+from .jwt_refresher import get_jwt_refresher_status
+from .session_pool import session_pool
+from .media_cache import image_cache, video_cache, get_media_cache_stats
+from .cache_janitor import cache_janitor
+from .upload_spool import HashingSpooledFile, get_upload_max_bytes
+from .url_image_cache import url_image_cache
+from .hedging import stream_hedger, StreamAttempt
+from .sse import ChatChunkEncoder, SSE_DONE, stream_coalescer
+from .deadline import Deadline, deadline_watchdog
 
 # 导入工具函数
 from .utils import check_proxy, seconds_until_next_pt_midnight
 
 # 导入异常类
 from .exceptions import (
+    AccountError,
     AccountRateLimitError,
     AccountAuthError,
     AccountRequestError,
+    AccountJwtRejectedError,
+    AccountTimeoutError,
     NoAvailableAccount
 )
 
@@ -89,6 +104,52 @@ from .exceptions import (
 from .logger import set_log_level, CURRENT_LOG_LEVEL_NAME, LOG_LEVELS, print
 
 
+def is_upstream_internal_error(error: BaseException) -> bool:
+    """上游 500 / internal error：会话可能已损坏，需要重建会话"""
+    error_str = str(error).lower()
+    return "500" in error_str or "internal error" in error_str
+
+
+def cool_down_account_for_error(account_idx: int, error: BaseException):
+    """按异常类型冷却账号（聊天和文件上传的重试循环、对冲请求的失败共用）
+    
+    AccountJwtRejectedError 不冷却（缓存的签名材料已丢弃，由调用方决定是否用同一账号重试），
+    非账号异常不处理。
+    """
+    if isinstance(error, AccountRateLimitError):
+        cooldown_seconds = max(account_manager.rate_limit_cooldown, seconds_until_next_pt_midnight())
+    elif isinstance(error, AccountAuthError):
+        error_msg = str(error).lower()
+        if "session is not owned" in error_msg or "not owned by the provided user" in error_msg:
+            with account_manager.lock:
+                state = account_manager.account_states.get(account_idx)
+                if state and state.get("session"):
+                    state["session"] = None
+        account_manager.mark_account_unavailable(account_idx, str(error))
+        cooldown_seconds = account_manager.auth_error_cooldown
+    elif isinstance(error, AccountJwtRejectedError):
+        return
+    elif isinstance(error, AccountTimeoutError):
+        # 超出时间预算：只短暂冷却该账号
+        cooldown_seconds = TIMEOUT_ERROR_COOLDOWN_SECONDS
+    elif isinstance(error, AccountRequestError):
+        if is_upstream_internal_error(error):
+            # 上游内部错误：丢弃该账号的会话和上传去重缓存，短暂冷却
+            with account_manager.lock:
+                state = account_manager.account_states.get(account_idx)
+                if state and state.get("session"):
+                    state["session"] = None
+                if account_idx in account_manager.conversation_sessions:
+                    account_manager.conversation_sessions[account_idx] = {}
+            upload_cache.invalidate_account(account_idx)
+            cooldown_seconds = 30
+        else:
+            cooldown_seconds = account_manager.generic_error_cooldown
+    else:
+        return
+    account_manager.mark_account_cooldown(account_idx, str(error), cooldown_seconds)
+
+
 def register_routes(app):
     """注册所有路由到 Flask 应用"""
     
@@ -146,14 +207,26 @@ def register_routes(app):
         print(f"[文件上传] 请求时间: {time.strftime('%Y-%m-%d %H:%M:%S')}")
         
         try:
-            if 'file' not in request.files:
+            # 在解析（缓冲）请求体之前先按 Content-Length 拒绝过大的上传，分块上传则在接收过程中检查
+            max_bytes = get_upload_max_bytes()
+            too_large = jsonify({"error": {"message": f"文件超过大小限制（{max_bytes // 1024 // 1024} MB）", "type": "invalid_request_error"}}), 413
+            if max_bytes and request.content_length and request.content_length > max_bytes + UPLOAD_FORM_OVERHEAD_BYTES:
+                return too_large
+            try:
+                has_file = 'file' in request.files
+            except RequestEntityTooLarge:
+                return too_large
+            if not has_file:
                 return jsonify({"error": {"message": "No file provided", "type": "invalid_request_error"}}), 400
             
             file = request.files['file']
             if file.filename == '':
                 return jsonify({"error": {"message": "No file selected", "type": "invalid_request_error"}}), 400
             
-            file_content = file.read()
+            # 文件已缓冲在内存或磁盘临时文件中，每次重试都从头流式读取，不再整体读入内存
+            file_stream = file.stream
+            file_size = file_stream.seek(0, 2)
+            file_sha256 = file_stream.hexdigest() if isinstance(file_stream, HashingSpooledFile) else None
             mime_type = file.content_type or mimetypes.guess_type(file.filename)[0] or 'application/octet-stream'
             
             available_accounts = account_manager.get_available_accounts()
@@ -167,15 +240,28 @@ def register_routes(app):
             max_retries = len(available_accounts)
             last_error = None
             gemini_file_id = None
+            # 本地签发的 JWT 被拒绝时，下一次尝试仍使用该账号（每个账号最多一次，不计入 retry_idx）
+            jwt_retry_account_idx = None
+            jwt_retried_accounts = set()
+            retry_idx = 0
             
-            for retry_idx in range(max_retries):
+            while retry_idx < max_retries or jwt_retry_account_idx is not None:
                 account_idx = None
                 try:
-                    account_idx, account = account_manager.get_next_account()
-                    session, jwt, team_id = ensure_session_for_account(account_idx, account)
+                    if jwt_retry_account_idx is not None:
+                        account_idx, jwt_retry_account_idx = jwt_retry_account_idx, None
+                        account = account_manager.accounts[account_idx]
+                    else:
+                        retry_idx += 1
+                        account_idx, account = account_manager.get_next_account()
+                    # 每个账号的尝试使用独立的时间预算，卡住的连接不会拖住整个重试循环
+                    deadline = Deadline()
+                    session, jwt, team_id = ensure_session_for_account(account_idx, account, deadline=deadline)
                     from .utils import get_proxy
                     proxy = get_proxy()
-                    gemini_file_id = upload_file_to_gemini(jwt, session, team_id, file_content, file.filename, mime_type, proxy)
+                    file_stream.seek(0)
+                    gemini_file_id = upload_file_to_gemini(jwt, session, team_id, file_stream, file.filename, mime_type, proxy,
+                                                           account_idx, sha256=file_sha256, deadline=deadline)
                     
                     if gemini_file_id:
                         openai_file_id = f"file-{uuid.uuid4().hex[:24]}"
@@ -185,40 +271,32 @@ def register_routes(app):
                             session_name=session,
                             filename=file.filename,
                             mime_type=mime_type,
-                            size=len(file_content)
+                            size=file_size,
+                            sha256=file_sha256
                         )
                         return jsonify({
                             "id": openai_file_id,
                             "object": "file",
-                            "bytes": len(file_content),
+                            "bytes": file_size,
                             "created_at": int(time.time()),
                             "filename": file.filename,
                             "purpose": request.form.get('purpose', 'assistants')
                         })
                 
-                except AccountRateLimitError as e:
-                    last_error = e
-                    if account_idx is not None:
-                        pt_wait = seconds_until_next_pt_midnight()
-                        cooldown_seconds = max(account_manager.rate_limit_cooldown, pt_wait)
-                        account_manager.mark_account_cooldown(account_idx, str(e), cooldown_seconds)
-                    continue
-                except AccountAuthError as e:
+                except AccountJwtRejectedError as e:
+                    # 缓存的签名材料已过期：不冷却账号，重新请求 getoxsrf 后用同一账号再试一次
                     last_error = e
-                    if account_idx is not None:
-                        error_msg = str(e).lower()
-                        if "session is not owned" in error_msg or "not owned by the provided user" in error_msg:
-                            with account_manager.lock:
-                                state = account_manager.account_states.get(account_idx)
-                                if state and state.get("session"):
-                                    state["session"] = None
-                        account_manager.mark_account_unavailable(account_idx, str(e))
-                        account_manager.mark_account_cooldown(account_idx, str(e), account_manager.auth_error_cooldown)
+                    if account_idx is not None and account_idx not in jwt_retried_accounts:
+                        print(f"[JWT] 账号 {account_idx}: {e}，重新获取签名材料后重试")
+                        jwt_retried_accounts.add(account_idx)
+                        jwt_retry_account_idx = account_idx
                     continue
-                except AccountRequestError as e:
+                except (AccountRateLimitError, AccountAuthError, AccountRequestError) as e:
                     last_error = e
+                    if isinstance(e, AccountTimeoutError):
+                        print(f"[超时] 账号 {account_idx}: {e}，切换账号重试")
                     if account_idx is not None:
-                        account_manager.mark_account_cooldown(account_idx, str(e), account_manager.generic_error_cooldown)
+                        cool_down_account_for_error(account_idx, e)
                     continue
                 except NoAvailableAccount as e:
                     last_error = e
@@ -306,9 +384,6 @@ def register_routes(app):
         request_size = len(request.data) if request.data else 0
         
         try:
-            cleanup_expired_images()
-            cleanup_expired_videos()
-            
             data = request.json
             requested_model = data.get('model', 'gemini-enterprise')  # 更新 requested_model
             auto_model_aliases = {"auto", "local-gemini-auto"}
@@ -531,13 +606,31 @@ def register_routes(app):
             
             try_without_model_id = is_auto_model
             
+            # 内联图片只解码/下载一次，切换账号重试时直接复用；每次尝试的文件 ID 在请求级文件 ID 基础上追加
+            prepared_images = []
+            if input_images:
+                from .utils import get_proxy
+                prepared_images = [image for image in (prepare_inline_image(img, get_proxy()) for img in input_images) if image]
+            request_gemini_file_ids = list(gemini_file_ids)
+            
             # 检测是否是图片生成请求
             is_image_model = selected_model_config and selected_model_config.get("id") == "gemini-image"
             # 如果使用默认工具集，也可能生成图片，需要检查图片配额
             # 但为了性能，只在明确是图片模型时检查，普通模型在生成图片后再检查
             
-            for retry_idx in range(max_retries):
+            # 时间预算按模型类型区分（文本 / 图片生成 / 视频生成）
+            deadline_profile = "image" if is_image_model else ("video" if is_video_model else "text")
+            
+            # 本地签发的 JWT 被拒绝时，下一次尝试仍使用该账号（每个账号最多一次，不计入 retry_idx）
+            jwt_retry_account_idx = None
+            jwt_retried_accounts = set()
+            retry_idx = 0
+            
+            while retry_idx < max_retries or jwt_retry_account_idx is not None:
                 account_idx = None
+                session = None
+                # 每个账号的尝试使用独立的时间预算：会话创建、上传、流式响应和媒体下载共用
+                deadline = Deadline(deadline_profile)
                 try:
                     # 被动检测方式：根据请求类型选择对应配额类型可用的账号
                     required_quota_type = None
@@ -547,16 +640,21 @@ def register_routes(app):
                         required_quota_type = "videos"
                     # 文本查询不需要指定配额类型（因为所有请求都需要文本配额）
                     
-                    if preferred_account_idx is not None and retry_idx == 0:
-                        account = account_manager.accounts[preferred_account_idx]
-                        account_idx = preferred_account_idx
-                        # 检查首选账号的配额类型是否可用
-                        if required_quota_type and not account_manager.is_account_available(account_idx, required_quota_type):
-                            preferred_account_idx = None
-                            account_idx, account = account_manager.get_next_account(required_quota_type)
+                    if jwt_retry_account_idx is not None:
+                        account_idx, jwt_retry_account_idx = jwt_retry_account_idx, None
+                        account = account_manager.accounts[account_idx]
                     else:
-                        # 根据请求类型选择对应配额类型可用的账号
-                        account_idx, account = account_manager.get_next_account(required_quota_type)
+                        retry_idx += 1
+                        if preferred_account_idx is not None and retry_idx == 1:
+                            account = account_manager.accounts[preferred_account_idx]
+                            account_idx = preferred_account_idx
+                            # 检查首选账号的配额类型是否可用
+                            if required_quota_type and not account_manager.is_account_available(account_idx, required_quota_type):
+                                preferred_account_idx = None
+                                account_idx, account = account_manager.get_next_account(required_quota_type)
+                        else:
+                            # 根据请求类型选择对应配额类型可用的账号
+                            account_idx, account = account_manager.get_next_account(required_quota_type)
                     
                     # ⚠️ 特殊处理：如果当前请求是新对话且有文本（不是 "empty"），
                     # 检查是否有 "empty" 会话键的 session（可能是之前只有图片的请求创建的）
@@ -611,31 +709,24 @@ def register_routes(app):
                         print(f"[检测] ✓ 使用文件关联的 session: {session}（跳过会话创建）")
                     else:
                         # 正常创建或复用 session
-                        session, jwt, team_id = ensure_session_for_account(account_idx, account, force_new=is_new_conversation, conversation_id=conversation_id)
+                        session, jwt, team_id = ensure_session_for_account(account_idx, account, force_new=is_new_conversation,
+                                                                           conversation_id=conversation_id, deadline=deadline)
                     from .utils import get_proxy
                     proxy = get_proxy()
                     
                     # 按照 Gemini-Link-System 的逻辑：如果有图片且还没上传到当前 Session，先上传
                     # 注意：如果 session 是复用的，图片可能已经在 session 中了，但这次请求有新的图片，需要上传
-                    if input_images:
-                        for img in input_images:
-                            uploaded_file_id = upload_inline_image_to_gemini(jwt, session, team_id, img, proxy, account_idx)
-                            if uploaded_file_id:
+                    # 多张图片并发上传，结果按原顺序返回
+                    gemini_file_ids = list(request_gemini_file_ids)
+                    if prepared_images:
+                        uploads = upload_inline_images_to_gemini(jwt, session, team_id, prepared_images, proxy, account_idx,
+                                                                 deadline=deadline)
+                        for (_, mime_type, _), uploaded in zip(prepared_images, uploads):
+                            if uploaded:
+                                uploaded_file_id, size = uploaded
                                 gemini_file_ids.append(uploaded_file_id)
                                 # 保存文件到 file_manager，关联 session（用于后续复用）
                                 if file_manager:
-                                    # 从图片数据中获取信息
-                                    mime_type = img.get("mime_type", "image/png")
-                                    if img.get("type") == "base64":
-                                        # 计算 base64 数据的大小
-                                        data = img.get("data", "")
-                                        size = len(base64.b64decode(data)) if data else 0
-                                    elif img.get("type") == "url":
-                                        # URL 类型，无法直接获取大小，使用 0
-                                        size = 0
-                                    else:
-                                        size = 0
-                                    
                                     # 生成文件名
                                     ext_map = {"image/png": ".png", "image/jpeg": ".jpg", "image/gif": ".gif", "image/webp": ".webp"}
                                     ext = ext_map.get(mime_type, ".png")
@@ -677,47 +768,79 @@ def register_routes(app):
                         print(f"[流式请求] 检测到图片格式: {image_format}")
                         
                         # 使用真正的流式生成器
-                        stream_generator = stream_chat_realtime_generator(
+                        primary_handle = UpstreamStreamHandle()
+                        primary_attempt = StreamAttempt(account_idx, stream_chat_realtime_generator(
                             jwt, session, user_message, proxy, team_id, 
                             gemini_file_ids, api_model_id, account_manager, 
                             account_idx, request_quota_type,
                             chat_id=chat_id, created=created_ts, model_name=requested_model,
-                            host_url=request.host_url, image_format=image_format
-                        )
-                        successful_account_idx = account_idx
+                            host_url=request.host_url, image_format=image_format,
+                            stream_handle=primary_handle, deadline=deadline
+                        ), primary_handle, session)
+                        
+                        # 对冲请求只用于不依赖已有 session 内容的新对话（文件、内联图片都绑定在当前 session 上）
+                        hedge_factory = None
+                        if is_new_conversation and not use_file_session and not gemini_file_ids:
+                            primary_idx = account_idx
+                            host_url = request.host_url
+                            
+                            def hedge_factory():
+                                candidates = [(idx, acc) for idx, acc in account_manager.get_available_accounts(request_quota_type) if idx != primary_idx]
+                                if not candidates:
+                                    return None
+                                hedge_idx, hedge_account = random.choice(candidates)
+                                hedge_deadline = Deadline(deadline_profile)
+                                try:
+                                    hedge_session, hedge_jwt, hedge_team_id = ensure_session_for_account(hedge_idx, hedge_account, force_new=True,
+                                                                                                       deadline=hedge_deadline)
+                                except AccountError as e:
+                                    cool_down_account_for_error(hedge_idx, e)
+                                    raise
+                                hedge_handle = UpstreamStreamHandle()
+                                return StreamAttempt(hedge_idx, stream_chat_realtime_generator(
+                                    hedge_jwt, hedge_session, user_message, proxy, hedge_team_id,
+                                    [], api_model_id, account_manager,
+                                    hedge_idx, request_quota_type,
+                                    chat_id=chat_id, created=created_ts, model_name=requested_model,
+                                    host_url=host_url, image_format=image_format,
+                                    stream_handle=hedge_handle, deadline=hedge_deadline
+                                ), hedge_handle, hedge_session)
+                        
+                        # 预读首个数据块：上游请求、状态码检查和首个 JSON 对象都在重试循环内完成，
+                        # 失败时由下面的异常处理冷却账号并切换到下一个账号；成功后才提交给 SSE 响应
+                        first_chunk, winner_attempt = stream_hedger.prime(requested_model, primary_attempt, hedge_factory,
+                                                                          on_error=cool_down_account_for_error)
+                        first_chunk_time = time.time()
+                        stream_generator = winner_attempt.generator
+                        successful_account_idx = winner_attempt.account_idx
+                        if winner_attempt is not primary_attempt and conversation_id:
+                            # 对冲请求胜出：对话改为关联胜出账号的 session
+                            with account_manager.lock:
+                                account_manager.conversation_sessions.get(account_idx, {}).pop(conversation_id, None)
+                                account_manager.conversation_sessions.setdefault(winner_attempt.account_idx, {})[conversation_id] = winner_attempt.session
                         # 流式响应将在下面的 if stream 块中处理
                         chat_response = None  # 流式模式下不需要完整响应
                         break
                     else:
                         # 非流式模式：使用原来的函数
-                        chat_response = stream_chat_with_images(jwt, session, user_message, proxy, team_id, gemini_file_ids, api_model_id, account_manager, account_idx, request_quota_type)
+                        chat_response = stream_chat_with_images(jwt, session, user_message, proxy, team_id, gemini_file_ids, api_model_id, account_manager, account_idx, request_quota_type,
+                                                                deadline=deadline)
                         successful_account_idx = account_idx
                         break
-                except AccountRateLimitError as e:
+                except AccountJwtRejectedError as e:
+                    # 缓存的签名材料已过期：不冷却账号，重新请求 getoxsrf 后用同一账号再试一次
                     last_error = e
-                    if account_idx is not None:
-                        pt_wait = seconds_until_next_pt_midnight()
-                        cooldown_seconds = max(account_manager.rate_limit_cooldown, pt_wait)
-                        account_manager.mark_account_cooldown(account_idx, str(e), cooldown_seconds)
-                    continue
-                except AccountAuthError as e:
-                    last_error = e
-                    if account_idx is not None:
-                        error_msg = str(e).lower()
-                        if "session is not owned" in error_msg or "not owned by the provided user" in error_msg:
-                            with account_manager.lock:
-                                state = account_manager.account_states.get(account_idx)
-                                if state and state.get("session"):
-                                    state["session"] = None
-                        account_manager.mark_account_unavailable(account_idx, str(e))
-                        account_manager.mark_account_cooldown(account_idx, str(e), account_manager.auth_error_cooldown)
+                    if account_idx is not None and account_idx not in jwt_retried_accounts:
+                        print(f"[JWT] 账号 {account_idx}: {e}，重新获取签名材料后重试")
+                        jwt_retried_accounts.add(account_idx)
+                        jwt_retry_account_idx = account_idx
                     continue
-                except AccountRequestError as e:
+                except (AccountRateLimitError, AccountAuthError, AccountRequestError) as e:
                     last_error = e
                     error_str = str(e).lower()
                     
                     # 检查是否是文件不存在的错误
-                    if "file" in error_str and ("not found" in error_str or "404" in error_str):
+                    if isinstance(e, AccountRequestError) and not isinstance(e, AccountTimeoutError) and "file" in error_str and ("not found" in error_str or "404" in error_str):
                         # 文件不存在错误，提供更友好的提示
                         # 尝试从错误消息中提取 fileId（re 模块已在文件顶部导入）
                         file_id_match = re.search(r'File with ID "([^"]+)"', str(e))
@@ -727,6 +850,10 @@ def register_routes(app):
                         else:
                             error_msg = f"文件不存在或已过期。请重新上传文件。错误详情: {str(e)}"
                         
+                        # 会话中的文件已失效，清除该会话的上传去重缓存，下次重新上传
+                        if session:
+                            upload_cache.invalidate_session(session)
+                        
                         # 文件不存在不应该导致账号冷却，直接返回错误
                         return jsonify({
                             "error": {
@@ -736,21 +863,14 @@ def register_routes(app):
                             }
                         }), 400
                     
-                    if "500" in error_str or "internal error" in error_str:
-                        cooldown_time = 30
-                        if account_idx is not None:
-                            with account_manager.lock:
-                                state = account_manager.account_states.get(account_idx)
-                                if state and state.get("session"):
-                                    state["session"] = None
-                                if account_idx in account_manager.conversation_sessions:
-                                    account_manager.conversation_sessions[account_idx] = {}
+                    if isinstance(e, AccountTimeoutError):
+                        # 超出时间预算：只短暂冷却该账号，立即换下一个账号重试
+                        print(f"[超时] 账号 {account_idx}: {e}，切换账号重试")
+                    elif isinstance(e, AccountRequestError) and is_upstream_internal_error(e):
                         try_without_model_id = True
-                    else:
-                        cooldown_time = account_manager.generic_error_cooldown
                     
                     if account_idx is not None:
-                        account_manager.mark_account_cooldown(account_idx, str(e), cooldown_time)
+                        cool_down_account_for_error(account_idx, e)
                     continue
                 except Exception as e:
                     last_error = e
@@ -766,10 +886,25 @@ def register_routes(app):
                     status_code = 429 if isinstance(last_error, (AccountRateLimitError, NoAvailableAccount)) else 500
                     return jsonify({"error": f"所有账号请求失败: {error_message}"}), status_code
                 
+                # 按 API Key / 客户端配置决定是否合并短文本块（需在请求上下文中确定）
+                encoder = ChatChunkEncoder(chat_id, created_ts, requested_model)
+                stream_generator = stream_coalescer.wrap(
+                    stream_generator, encoder,
+                    stream_coalescer.get_settings(api_key_id, request.headers.get("User-Agent", ""))
+                )
+                
                 def generate():
+                    stream_status = "success"
+                    stream_error = None
+                    stream_completed = False
+                    response_size = 0
                     try:
-                        # 使用真正的流式生成器，实时转发
+                        # 先发送预读的首个数据块，再继续实时转发
+                        if first_chunk:
+                            response_size += len(first_chunk)
+                            yield first_chunk
                         for chunk in stream_generator:
+                            response_size += len(chunk)
                             yield chunk
                         
                         # 流式生成器结束后，处理图片/视频（需要下载）
@@ -777,52 +912,47 @@ def register_routes(app):
                         # 但我们需要手动获取它，这里暂时跳过图片处理（图片会在生成器中处理）
                         
                         # 发送结束标记
-                        end_chunk = {
-                            "id": chat_id,
-                            "object": "chat.completion.chunk",
-                            "created": created_ts,
-                            "model": requested_model,
-                            "choices": [{
-                                "index": 0,
-                                "delta": {},
-                                "finish_reason": "stop"
-                            }]
-                        }
-                        yield f"data: {json.dumps(end_chunk, ensure_ascii=False)}\n\n"
-                        yield "data: [DONE]\n\n"
+                        yield encoder.finish("stop")
+                        yield SSE_DONE
+                        stream_completed = True
                     except Exception as e:
-                        # 错误处理
-                        error_chunk = {
-                            "id": chat_id,
-                            "object": "chat.completion.chunk",
-                            "created": created_ts,
-                            "model": requested_model,
-                            "choices": [{
-                                "index": 0,
-                                "delta": {},
-                                "finish_reason": "stop"
-                            }],
-                            "error": {"message": str(e)}
-                        }
-                        yield f"data: {json.dumps(error_chunk, ensure_ascii=False)}\n\n"
-                        yield "data: [DONE]\n\n"
-                
-                # 对于流式响应，在开始时就记录日志
-                response_time = int((time.time() - request_start_time) * 1000)
-                try:
-                    from .api_key_manager import log_api_call
-                    log_api_call(
-                        api_key_id=api_key_id,
-                        model=requested_model,
-                        status="success",
-                        response_time=response_time,
-                        ip_address=ip_address,
-                        endpoint=endpoint,
-                        request_size=request_size,
-                        response_size=None
-                    )
-                except Exception:
-                    pass
+                        # 错误处理（响应已提交，只能在流中返回错误）
+                        stream_status = "error"
+                        stream_error = str(e)[:500]
+                        stream_completed = True
+                        yield encoder.error(str(e))
+                        yield SSE_DONE
+                    finally:
+                        # 流式响应在结束时记录日志（包含完整耗时和实际发送的字节数）
+                        if not stream_completed:
+                            # 客户端断开连接（生成器被 close）：关闭上游响应并放弃未完成的媒体任务，
+                            # 不再让已放弃的生成继续占用连接和账号直到 Gemini 生成完毕
+                            stream_status = "cancelled"
+                            stream_error = "客户端已断开连接"
+                            try:
+                                stream_generator.close()
+                            except ValueError:
+                                # 生成器正在其他线程中执行，下面关闭上游连接后会自行结束
+                                pass
+                            winner_attempt.cancel()
+                        response_time = int((time.time() - request_start_time) * 1000)
+                        first_chunk_ms = int((first_chunk_time - request_start_time) * 1000)
+                        print(f"[流式请求] 账号 {successful_account_idx} 完成: 状态={stream_status}, 首块耗时={first_chunk_ms}ms, 总耗时={response_time}ms, 发送={response_size} bytes")
+                        try:
+                            from .api_key_manager import log_api_call
+                            log_api_call(
+                                api_key_id=api_key_id,
+                                model=requested_model,
+                                status=stream_status,
+                                response_time=response_time,
+                                ip_address=ip_address,
+                                endpoint=endpoint,
+                                error_message=stream_error,
+                                request_size=request_size,
+                                response_size=response_size
+                            )
+                        except Exception:
+                            pass
                 
                 return Response(generate(), mimetype='text/event-stream')
             
@@ -1002,17 +1132,48 @@ def register_routes(app):
     
     # ==================== 图片服务接口 ====================
     
+    def send_cached_media(cache, filename, mime_type):
+        """发送缓存中的图片/视频，支持 Range 分段请求和条件请求
+        
+        缓存文件按内容哈希命名，哈希即强 ETag；同一文件名在缓存期内内容不会变化，
+        因此以缓存时长作为 max-age 并标记 immutable。
+        配置了 media_offload_mode 时只解析文件路径，由反向代理发送文件内容（Range、条件请求也由代理处理）。
+        """
+        filepath = cache.resolve(filename)
+        if filepath is None or not filepath.exists():
+            abort(404)
+        
+        cache_control = f"public, max-age={int(cache.max_age_seconds)}, immutable"
+        offload_mode = str(account_manager.config.get("media_offload_mode") or "").strip().lower()
+        if offload_mode in ("x-accel", "x-sendfile"):
+            response = Response(mimetype=mime_type)
+            if offload_mode == "x-accel":
+                prefix = account_manager.config.get("media_offload_prefix") or MEDIA_OFFLOAD_PREFIX
+                response.headers['X-Accel-Redirect'] = f"{prefix.rstrip('/')}/{filepath.relative_to(DATA_DIR).as_posix()}"
+            else:
+                response.headers['X-Sendfile'] = str(filepath.resolve())
+            response.headers['Cache-Control'] = cache_control
+            cache.record_response(0, 0)
+            return response
+        
+        response = send_file(
+            filepath,
+            mimetype=mime_type,
+            conditional=True,
+            etag=filepath.stem,
+            max_age=int(cache.max_age_seconds)
+        )
+        response.headers['Cache-Control'] = cache_control
+        cache.record_response(response.status_code, response.content_length or 0)
+        return response
+    
     @app.route('/image/<path:filename>')
     def serve_image(filename):
         """提供缓存图片的访问"""
         if '..' in filename or filename.startswith('/'):
             abort(404)
         
-        filepath = IMAGE_CACHE_DIR / filename
-        if not filepath.exists():
-            abort(404)
-        
-        ext = filepath.suffix.lower()
+        ext = Path(filename).suffix.lower()
         mime_types = {
             '.png': 'image/png',
             '.jpg': 'image/jpeg',
@@ -1022,7 +1183,7 @@ def register_routes(app):
         }
         mime_type = mime_types.get(ext, 'application/octet-stream')
         
-        return send_from_directory(IMAGE_CACHE_DIR, filename, mimetype=mime_type)
+        return send_cached_media(image_cache, filename, mime_type)
     
     @app.route('/video/<path:filename>')
     def serve_video(filename):
@@ -1030,12 +1191,8 @@ def register_routes(app):
         if '..' in filename or filename.startswith('/'):
             abort(404)
         
-        filepath = VIDEO_CACHE_DIR / filename
-        if not filepath.exists():
-            abort(404)
-        
-        mime_type = mimetypes.guess_type(str(filepath))[0] or 'application/octet-stream'
-        return send_from_directory(VIDEO_CACHE_DIR, filename, mimetype=mime_type)
+        mime_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        return send_cached_media(video_cache, filename, mime_type)
     
     @app.route('/health', methods=['GET'])
     def health_check():
@@ -1065,7 +1222,17 @@ def register_routes(app):
                 "effective": effective_proxy,
                 "available": check_proxy(effective_proxy) if effective_proxy else False
             },
-            "models": account_manager.config.get("models", [])
+            "models": account_manager.config.get("models", []),
+            "jwt_refresh": get_jwt_refresher_status(),
+            "xsrf_cache": get_xsrf_cache_stats(),
+            "session_pool": session_pool.get_stats(),
+            "hedging": stream_hedger.get_stats(),
+            "media_cache": get_media_cache_stats(),
+            "cache_janitor": cache_janitor.get_stats(),
+            "upload_dedupe": upload_cache.get_stats(),
+            "url_image_cache": url_image_cache.get_stats(),
+            "sse_coalesce": stream_coalescer.get_stats(),
+            "deadlines": deadline_watchdog.get_stats()
         })
     
     # ==================== 管理接口 ====================
@@ -1622,7 +1789,7 @@ def register_routes(app):
             })
         
         try:
-            jwt = get_jwt_for_account(account, proxy)
+            jwt = get_jwt_for_account(account, proxy, use_cache=False)
             return jsonify({"success": True, "message": "JWT获取成功"})
         except AccountRateLimitError as e:
             pt_wait = seconds_until_next_pt_midnight()
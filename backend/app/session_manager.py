@@ -3,15 +3,21 @@
 import time
 import uuid
 import base64
+import hashlib
+import threading
 import requests
-from typing import Optional, Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, List, Tuple, Union, BinaryIO
 
-from .config import CREATE_SESSION_URL, ADD_CONTEXT_FILE_URL
+from .config import CREATE_SESSION_URL, ADD_CONTEXT_FILE_URL, JWT_REFRESH_AGE_SECONDS, INLINE_UPLOAD_WORKERS
 from .account_manager import account_manager
-from .jwt_utils import get_jwt_for_account
+from .jwt_utils import get_jwt_for_account, jwt_key_id
 from .exceptions import AccountRequestError, AccountError
+from .deadline import Deadline, timeout_error
 from .utils import raise_for_account_response
 from .media_handler import download_image_from_url
+from .http_client import get_http_client, base64_json_body
+from .file_manager import upload_cache
 
 
 def get_headers(jwt: str) -> dict:
@@ -29,61 +35,127 @@ def get_headers(jwt: str) -> dict:
     }
 
 
-def ensure_jwt_for_account(account_idx: int, account: dict):
-    """确保指定账号的JWT有效，必要时刷新"""
-    # 调试日志已关闭
-    # print(f"[DEBUG][ensure_jwt_for_account] 开始 - 账号索引: {account_idx}, CSESIDX: {account.get('csesidx')}")
-    start_time = time.time()
-    
-    # 先检查是否需要刷新（快速检查，最小化锁持有时间）
-    need_refresh = False
-    jwt = None
+class _JwtRefreshFlight:
+    """单个账号进行中的 JWT 刷新（single-flight），并发调用者共享其结果或异常"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.jwt: Optional[str] = None
+        self.error: Optional[BaseException] = None
+
+
+# 进行中的 JWT 刷新: {account_idx: _JwtRefreshFlight}
+_jwt_refresh_flights: Dict[int, _JwtRefreshFlight] = {}
+_jwt_refresh_flights_lock = threading.Lock()
+
+# JWT 刷新计数: request=请求路径上同步刷新, proactive=后台提前刷新, warmup=启动预热
+_jwt_refresh_stats = {"request": 0, "proactive": 0, "warmup": 0, "failed": 0}
+
+# 账号最近一次处理请求的时间: {account_idx: timestamp}，后台预刷新只处理近期活跃的账号
+_account_last_used: Dict[int, float] = {}
+
+
+def get_jwt_refresh_stats() -> dict:
+    """获取 JWT 刷新计数"""
+    with _jwt_refresh_flights_lock:
+        return dict(_jwt_refresh_stats)
+
+
+def get_recently_used_accounts(window_seconds: float) -> List[int]:
+    """返回最近 window_seconds 秒内处理过请求的账号索引"""
+    cutoff = time.time() - window_seconds
+    with _jwt_refresh_flights_lock:
+        return [idx for idx, used_at in _account_last_used.items() if used_at >= cutoff]
+
+
+def _get_fresh_jwt(account_idx: int) -> Optional[str]:
+    """返回账号当前仍然有效的缓存 JWT，需要刷新时返回 None"""
     with account_manager.lock:
         state = account_manager.account_states[account_idx]
         jwt = state.get("jwt")
         jwt_age = time.time() - state["jwt_time"] if jwt else float('inf')
         # 调试日志已关闭
         # print(f"[DEBUG][ensure_jwt_for_account] JWT状态 - 存在: {jwt is not None}, 年龄: {jwt_age:.2f}秒")
-        need_refresh = jwt is None or jwt_age > 240
+        return jwt if jwt_age <= JWT_REFRESH_AGE_SECONDS else None
+
+
+def refresh_jwt_for_account(account_idx: int, account: dict, force: bool = True, source: str = "request") -> str:
+    """刷新指定账号的 JWT（按账号 single-flight 合并并发刷新）
     
-    # 如果需要刷新，在锁外进行网络请求（避免长时间阻塞）
-    if need_refresh:
-        # 调试日志已关闭
-        # print(f"[DEBUG][ensure_jwt_for_account] 需要刷新JWT...")
-        from .utils import get_proxy
-        proxy = get_proxy()
-        try:
-            refresh_start = time.time()
-            new_jwt = get_jwt_for_account(account, proxy, account_idx)  # 网络请求在锁外进行
-            # 调试日志已关闭
-            # print(f"[DEBUG][ensure_jwt_for_account] JWT刷新成功 - 耗时: {time.time() - refresh_start:.2f}秒")
+    同一账号同一时刻只有一个调用者真正请求 getoxsrf，其余调用者等待该次刷新的结果；
+    刷新失败时，等待者收到同一个异常。
+    
+    Args:
+        account_idx: 账号索引
+        account: 账号信息
+        force: 为 False 时，若取得刷新权后发现 JWT 已被其他调用者刷新，则直接复用
+        source: 刷新来源（"request" / "proactive" / "warmup"），用于统计
+    """
+    with _jwt_refresh_flights_lock:
+        flight = _jwt_refresh_flights.get(account_idx)
+        is_leader = flight is None
+        if is_leader:
+            flight = _JwtRefreshFlight()
+            _jwt_refresh_flights[account_idx] = flight
+    
+    if not is_leader:
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.jwt
+    
+    try:
+        # 上一轮刷新可能刚刚完成，避免重复请求
+        jwt = None if force else _get_fresh_jwt(account_idx)
+        if jwt is None:
+            from .utils import get_proxy
+            proxy = get_proxy()
+            jwt = get_jwt_for_account(account, proxy, account_idx)  # 网络请求在锁外进行
             
             # 更新状态（重新获取锁）
             with account_manager.lock:
                 state = account_manager.account_states[account_idx]
-                state["jwt"] = new_jwt
+                old_key_id = jwt_key_id(state.get("jwt"))
+                state["jwt"] = jwt
                 state["jwt_time"] = time.time()
-                # JWT 刷新后，清除旧的 session，因为新的 JWT 与旧的 session 不匹配
-                if state["session"] is not None:
-                    # 调试日志已关闭
-                    # print(f"[DEBUG][ensure_jwt_for_account] JWT已刷新，清除旧session: {state['session']}")
+                # 签名材料更换后清除旧的 session；用同一签名材料重新签发的 JWT 仍可继续使用原 session
+                if state["session"] is not None and old_key_id != jwt_key_id(jwt):
                     state["session"] = None
-                jwt = new_jwt
-        except Exception as e:
-            # 调试日志已关闭
-            # print(f"[DEBUG][ensure_jwt_for_account] JWT刷新失败: {e}")
-            raise
-    else:
-        # 调试日志已关闭
-        # print(f"[DEBUG][ensure_jwt_for_account] 使用缓存JWT")
-        pass
+            with _jwt_refresh_flights_lock:
+                _jwt_refresh_stats[source] = _jwt_refresh_stats.get(source, 0) + 1
+        flight.jwt = jwt
+        return jwt
+    except BaseException as e:
+        flight.error = e
+        with _jwt_refresh_flights_lock:
+            _jwt_refresh_stats["failed"] += 1
+        raise
+    finally:
+        with _jwt_refresh_flights_lock:
+            _jwt_refresh_flights.pop(account_idx, None)
+        flight.done.set()
+
+
+def ensure_jwt_for_account(account_idx: int, account: dict, record_use: bool = True):
+    """确保指定账号的JWT有效，必要时刷新
+
+    Args:
+        record_use: 是否记为账号的一次使用（会话池等后台任务传 False，不让账号因此保持活跃）
+    """
+    if record_use:
+        with _jwt_refresh_flights_lock:
+            _account_last_used[account_idx] = time.time()
+    # 先检查是否需要刷新（快速检查，最小化锁持有时间）
+    jwt = _get_fresh_jwt(account_idx)
+    if jwt is not None:
+        return jwt
     
-    # 调试日志已关闭
-    # print(f"[DEBUG][ensure_jwt_for_account] 完成 - 总耗时: {time.time() - start_time:.2f}秒")
-    return jwt
+    # 需要刷新时在锁外进行网络请求，并发请求合并为同一次刷新
+    return refresh_jwt_for_account(account_idx, account, force=False)
 
 
-def create_chat_session(jwt: str, team_id: str, proxy: str, account_idx: Optional[int] = None) -> str:
+def create_chat_session(jwt: str, team_id: str, proxy: str, account_idx: Optional[int] = None,
+                        deadline: Optional[Deadline] = None) -> str:
     """创建会话，返回session ID"""
     # 调试日志已关闭
     # print(f"[DEBUG][create_chat_session] 开始 - team_id: {team_id}")
@@ -99,21 +171,21 @@ def create_chat_session(jwt: str, team_id: str, proxy: str, account_idx: Optiona
         }
     }
 
-    proxies = {"http": proxy, "https": proxy} if proxy else None
     # 调试日志已关闭
     # print(f"[DEBUG][create_chat_session] 发送请求到: {CREATE_SESSION_URL}")
     # print(f"[DEBUG][create_chat_session] 使用代理: {proxy}")
     
     request_start = time.time()
     try:
-        resp = requests.post(
+        resp = get_http_client(proxy, account_idx).post(
             CREATE_SESSION_URL,
             headers=get_headers(jwt),
             json=body,
-            proxies=proxies,
             verify=False,
-            timeout=30
+            timeout=deadline.timeout() if deadline else 30
         )
+    except requests.Timeout as e:
+        raise timeout_error("创建会话请求", e) from e
     except requests.RequestException as e:
         raise AccountRequestError(f"创建会话请求失败: {e}") from e
     # 调试日志已关闭
@@ -135,7 +207,8 @@ def create_chat_session(jwt: str, team_id: str, proxy: str, account_idx: Optiona
     return session_name
 
 
-def ensure_session_for_account(account_idx: int, account: dict, force_new: bool = False, conversation_id: Optional[str] = None):
+def ensure_session_for_account(account_idx: int, account: dict, force_new: bool = False, conversation_id: Optional[str] = None,
+                               deadline: Optional[Deadline] = None):
     """确保指定账号的会话有效
     
     Args:
@@ -143,6 +216,7 @@ def ensure_session_for_account(account_idx: int, account: dict, force_new: bool
         account: 账号信息
         force_new: 是否强制创建新 session（用于新对话）
         conversation_id: 对话标识符（用于区分不同的对话）
+        deadline: 本次尝试的时间预算（可选），用于创建会话请求
     """
     # 调试日志已关闭
     # print(f"[DEBUG][ensure_session_for_account] 开始 - 账号索引: {account_idx}, force_new: {force_new}, conversation_id: {conversation_id}")
@@ -152,6 +226,8 @@ def ensure_session_for_account(account_idx: int, account: dict, force_new: bool
     jwt = ensure_jwt_for_account(account_idx, account)
     # 调试日志已关闭
     # print(f"[DEBUG][ensure_session_for_account] JWT获取完成 - 耗时: {time.time() - jwt_start:.2f}秒")
+    if deadline:
+        deadline.check()
     
     with account_manager.lock:
         # 初始化对话 session 映射
@@ -173,101 +249,120 @@ def ensure_session_for_account(account_idx: int, account: dict, force_new: bool
         # 调试日志已关闭
         # print(f"[DEBUG][ensure_session_for_account] 当前session状态: {state['session'] is not None}")
         
-        # 如果需要强制创建新 session，或者当前没有 session，则创建新 session
-        if force_new or state["session"] is None:
-            if force_new and state["session"] is not None:
-                print(f"[检测] ⚠️ 强制创建新 session，旧 session: {state['session']}")
-            # 如果强制创建新 session，清除旧的 session 映射（如果有 conversation_id）
-            if force_new and conversation_id:
-                if conversation_id in account_manager.conversation_sessions[account_idx]:
-                    old_session = account_manager.conversation_sessions[account_idx][conversation_id]
-                    print(f"[检测] ⚠️ 清除对话 {conversation_id} 的旧 session: {old_session}（原因: force_new=True）")
-                    del account_manager.conversation_sessions[account_idx][conversation_id]
-            # 调试日志已关闭
-            # print(f"[DEBUG][ensure_session_for_account] 需要创建新session...")
-            from .utils import get_proxy
-            proxy = get_proxy()
-            team_id = account.get("team_id")
-            session_start = time.time()
-            new_session = create_chat_session(jwt, team_id, proxy, account_idx)
-            print(f"[检测] ✓ 创建新 session: {new_session}（原因: force_new={force_new}, 旧session存在={state['session'] is not None}）")
-            
-            # 如果有对话 ID，保存到对话 session 映射中
-            if conversation_id:
-                account_manager.conversation_sessions[account_idx][conversation_id] = new_session
-                print(f"[检测] ✓ 已保存对话 {conversation_id} 的 session: {new_session}")
-            
-            # 更新默认 session（用于非新对话的情况）
-            state["session"] = new_session
-            session = new_session
-        else:
+        # 已有默认 session 且不需要新 session 时直接复用
+        if not force_new and state["session"] is not None:
             # 调试日志已关闭
             # print(f"[DEBUG][ensure_session_for_account] 使用缓存session: {state['session']}")
             session = state["session"]
             # 如果有对话 ID，也保存到映射中（用于后续识别）
             if conversation_id:
                 account_manager.conversation_sessions[account_idx][conversation_id] = session
+            return session, jwt, account.get("team_id")
         
+        old_session_exists = state["session"] is not None
+        if force_new and old_session_exists:
+            print(f"[检测] ⚠️ 强制创建新 session，旧 session: {state['session']}")
+        # 如果强制创建新 session，清除旧的 session 映射（如果有 conversation_id）
+        if force_new and conversation_id:
+            if conversation_id in account_manager.conversation_sessions[account_idx]:
+                old_session = account_manager.conversation_sessions[account_idx][conversation_id]
+                print(f"[检测] ⚠️ 清除对话 {conversation_id} 的旧 session: {old_session}（原因: force_new=True）")
+                del account_manager.conversation_sessions[account_idx][conversation_id]
+    
+    # 优先从会话池取用预创建的 session；池为空时在锁外同步创建
+    from .session_pool import session_pool
+    new_session = session_pool.take(account_idx, jwt)
+    if new_session:
+        print(f"[检测] ✓ 使用预创建 session: {new_session}（原因: force_new={force_new}, 旧session存在={old_session_exists}）")
+    else:
         # 调试日志已关闭
-        # print(f"[DEBUG][ensure_session_for_account] 完成 - 总耗时: {time.time() - start_time:.2f}秒")
-        return state["session"], jwt, account.get("team_id")
+        # print(f"[DEBUG][ensure_session_for_account] 需要创建新session...")
+        from .utils import get_proxy
+        proxy = get_proxy()
+        team_id = account.get("team_id")
+        session_start = time.time()
+        new_session = create_chat_session(jwt, team_id, proxy, account_idx, deadline)
+        print(f"[检测] ✓ 创建新 session: {new_session}（原因: force_new={force_new}, 旧session存在={old_session_exists}）")
+    
+    with account_manager.lock:
+        if account_idx not in account_manager.conversation_sessions:
+            account_manager.conversation_sessions[account_idx] = {}
+        # 如果有对话 ID，保存到对话 session 映射中
+        if conversation_id:
+            account_manager.conversation_sessions[account_idx][conversation_id] = new_session
+            print(f"[检测] ✓ 已保存对话 {conversation_id} 的 session: {new_session}")
+        
+        # 更新默认 session（用于非新对话的情况）
+        account_manager.account_states[account_idx]["session"] = new_session
+    
+    # 调试日志已关闭
+    # print(f"[DEBUG][ensure_session_for_account] 完成 - 总耗时: {time.time() - start_time:.2f}秒")
+    return new_session, jwt, account.get("team_id")
 
 
 def upload_file_to_gemini(jwt: str, session_name: str, team_id: str, 
-                          file_content: bytes, filename: str, mime_type: str,
-                          proxy: str = None, account_idx: Optional[int] = None) -> str:
+                          file_content: Union[bytes, BinaryIO], filename: str, mime_type: str,
+                          proxy: str = None, account_idx: Optional[int] = None,
+                          sha256: Optional[str] = None, deadline: Optional[Deadline] = None) -> str:
     """
     上传文件到 Gemini，返回 Gemini 的 fileId
     
+    请求体中的 base64 文件内容逐块编码后直接写入 socket，不在内存中生成完整的 base64/JSON 字符串。
+    指定账号时按 (账号, 会话, 内容 sha256) 去重，同一会话中已上传过的相同内容直接返回已有的 fileId。
+    
     Args:
         jwt: JWT 认证令牌
         session_name: 会话名称
         team_id: 团队ID
-        file_content: 文件内容（字节）
+        file_content: 文件内容（字节，或二进制文件对象）
         filename: 文件名
         mime_type: MIME 类型
         proxy: 代理地址
+        account_idx: 账号索引
+        sha256: 文件内容的 sha256（文件对象需要由调用方提供，bytes 会自动计算）
+        deadline: 本次尝试的时间预算（可选）
     
     Returns:
         str: Gemini 返回的 fileId
     """
-    import base64
-    
     start_time = time.time()
-    # 调试日志已关闭
-    # print(f"[DEBUG][upload_file_to_gemini] 开始上传文件: {filename}, MIME类型: {mime_type}, 文件大小: {len(file_content)} bytes")
     
-    encode_start = time.time()
-    file_contents_b64 = base64.b64encode(file_content).decode('utf-8')
-    # 调试日志已关闭
-    # print(f"[DEBUG][upload_file_to_gemini] Base64编码完成 - 耗时: {time.time() - encode_start:.2f}秒, 编码后大小: {len(file_contents_b64)} chars")
+    if sha256 is None and isinstance(file_content, (bytes, bytearray)):
+        sha256 = hashlib.sha256(file_content).hexdigest()
+    dedupe = account_idx is not None and sha256 is not None
+    if dedupe:
+        cached_file_id = upload_cache.get(account_idx, session_name, sha256)
+        if cached_file_id:
+            from .logger import print
+            print(f"[文件上传] 会话中已存在相同内容，复用 fileId: {cached_file_id}")
+            return cached_file_id
     
-    body = {
+    body = base64_json_body({
         "addContextFileRequest": {
-            "fileContents": file_contents_b64,
+            "fileContents": None,
             "fileName": filename,
             "mimeType": mime_type,
             "name": session_name
         },
         "additionalParams": {"token": "-"},
         "configId": team_id
-    }
+    }, ("addContextFileRequest", "fileContents"), file_content)
     
-    proxies = {"http": proxy, "https": proxy} if proxy else None
     # 调试日志已关闭
     # print(f"[DEBUG][upload_file_to_gemini] 准备发送请求到: {ADD_CONTEXT_FILE_URL}")
     # print(f"[DEBUG][upload_file_to_gemini] 使用代理: {proxy if proxy else '无'}")
     
     request_start = time.time()
     try:
-        resp = requests.post(
+        resp = get_http_client(proxy, account_idx).post(
             ADD_CONTEXT_FILE_URL,
             headers=get_headers(jwt),
-            json=body,
-            proxies=proxies,
+            data=body,
             verify=False,
-            timeout=60
+            timeout=deadline.timeout() if deadline else 60
         )
+    except requests.Timeout as e:
+        raise timeout_error("文件上传请求", e) from e
     except requests.RequestException as e:
         raise AccountRequestError(f"文件上传请求失败: {e}") from e
     # 调试日志已关闭
@@ -289,6 +384,9 @@ def upload_file_to_gemini(jwt: str, session_name: str, team_id: str,
         # print(f"[DEBUG][upload_file_to_gemini] 响应中未找到fileId - 响应数据: {data}")
         raise ValueError(f"响应中未找到 fileId: {data}")
     
+    if dedupe:
+        upload_cache.put(account_idx, session_name, sha256, file_id)
+    
     # 调试日志已关闭
     # print(f"[DEBUG][upload_file_to_gemini] 上传成功 - fileId: {file_id}, 总耗时: {time.time() - start_time:.2f}秒")
     return file_id
@@ -299,9 +397,18 @@ def build_download_url(session_name: str, file_id: str) -> str:
     return f"https://biz-discoveryengine.googleapis.com/v1alpha/{session_name}:downloadFile?fileId={file_id}&alt=media"
 
 
-def upload_inline_image_to_gemini(jwt: str, session_name: str, team_id: str, 
-                                   image_data: Dict, proxy: str = None, account_idx: Optional[int] = None) -> Optional[str]:
-    """上传内联图片到 Gemini，返回 fileId"""
+# 内联图片: (文件内容, MIME 类型, 文件名)
+InlineImage = Tuple[bytes, str, str]
+
+# 内联图片并发上传线程池（所有请求共享，限制同时进行的上传数量）
+_inline_upload_executor = ThreadPoolExecutor(max_workers=INLINE_UPLOAD_WORKERS, thread_name_prefix="inline-upload")
+
+
+def prepare_inline_image(image_data: Dict, proxy: str = None) -> Optional[InlineImage]:
+    """解码 base64 图片或下载 URL 图片，返回 (文件内容, MIME 类型, 文件名)
+    
+    每个请求只需准备一次，结果可在切换账号重试时重复上传。
+    """
     try:
         ext_map = {"image/png": ".png", "image/jpeg": ".jpg", "image/gif": ".gif", "image/webp": ".webp"}
         
@@ -316,11 +423,53 @@ def upload_inline_image_to_gemini(jwt: str, session_name: str, team_id: str,
             filename = f"url_{uuid.uuid4().hex[:8]}{ext}"
         else:
             return None
-        
-        return upload_file_to_gemini(jwt, session_name, team_id, file_content, filename, mime_type, proxy, account_idx)
+        return file_content, mime_type, filename
+    except Exception as e:
+        from .logger import print
+        print(f"[图片上传] 内联图片解析失败: {e}")
+        return None
+
+
+def upload_inline_image_to_gemini(jwt: str, session_name: str, team_id: str, 
+                                   image: InlineImage, proxy: str = None, account_idx: Optional[int] = None,
+                                   deadline: Optional[Deadline] = None) -> Optional[Tuple[str, int]]:
+    """上传内联图片到 Gemini，返回 (fileId, 字节数)"""
+    file_content, mime_type, filename = image
+    try:
+        file_id = upload_file_to_gemini(jwt, session_name, team_id, file_content, filename, mime_type, proxy, account_idx,
+                                        deadline=deadline)
     except AccountError:
         # 让账号相关错误向上抛出，以便触发冷却
         raise
     except Exception:
         return None
+    return (file_id, len(file_content)) if file_id else None
+
+
+def upload_inline_images_to_gemini(jwt: str, session_name: str, team_id: str, images: List[InlineImage],
+                                   proxy: str = None, account_idx: Optional[int] = None,
+                                   deadline: Optional[Deadline] = None) -> List[Optional[Tuple[str, int]]]:
+    """并发上传多张内联图片，按原顺序返回每张图片的 (fileId, 字节数)，上传失败的为 None
+    
+    任一图片触发账号错误时等待其余上传结束后抛出该错误，由调用方切换账号重试。
+    """
+    if len(images) <= 1:
+        return [upload_inline_image_to_gemini(jwt, session_name, team_id, image, proxy, account_idx, deadline) for image in images]
+    
+    futures = [
+        _inline_upload_executor.submit(upload_inline_image_to_gemini, jwt, session_name, team_id, image, proxy, account_idx,
+                                       deadline)
+        for image in images
+    ]
+    results = []
+    account_error = None
+    for future in futures:
+        try:
+            results.append(future.result())
+        except AccountError as e:
+            account_error = account_error or e
+            results.append(None)
+    if account_error:
+        raise account_error
+    return results
 
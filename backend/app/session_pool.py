@@ -0,0 +1,191 @@
+"""会话池模块 - 为近期活跃的账号预先创建空闲会话，新对话可直接取用"""
+
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from .config import SESSION_POOL_SIZE, SESSION_POOL_ACTIVE_SECONDS
+from .account_manager import account_manager
+from .session_manager import ensure_jwt_for_account, create_chat_session
+from .jwt_utils import jwt_key_id
+
+# 会话所属的账号代次: (csesidx, team_id, 签名材料 keyId)
+Generation = Tuple[Optional[str], Optional[str], Optional[str]]
+
+# 没有补充请求时的最长等待时间（秒）
+_IDLE_SCAN_SECONDS = 15
+
+
+class SessionPool:
+    """按账号维护的预创建会话池
+
+    新对话（force_new=True）原本需要在 widgetStreamAssist 之前同步调用 createSession，
+    会话池在后台为近期使用过的账号预先创建若干空闲会话，取用时无需等待。
+    每个会话记录创建时的账号代次（凭证和签名材料 keyId），JWT 定期重新签发不影响已创建的会话，
+    只有凭证或签名材料更换后旧会话才不再取用；账号冷却或不可用时整池丢弃。
+    """
+
+    def __init__(self):
+        self._pools: Dict[int, Deque[Tuple[str, Generation]]] = {}  # account_idx -> deque[(session_name, 代次)]
+        self._last_used: Dict[int, float] = {}  # account_idx -> 最近一次取用时间
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._stats = {"hits": 0, "misses": 0, "created": 0, "discarded": 0, "failed": 0}
+
+    def get_target_size(self) -> int:
+        """每个账号的目标池深度（配置 session_pool_size，0 表示关闭）"""
+        size = SESSION_POOL_SIZE
+        if account_manager.config:
+            try:
+                size = int(account_manager.config.get("session_pool_size", size))
+            except (TypeError, ValueError):
+                pass
+        return max(0, size)
+
+    @staticmethod
+    def _generation(account_idx: int, jwt: Optional[str]) -> Generation:
+        """账号代次：Cookie/团队更换或签名材料更换后改变，同一签名材料重新签发 JWT 时不变"""
+        account = account_manager.accounts[account_idx] if account_idx < len(account_manager.accounts) else {}
+        return account.get("csesidx"), account.get("team_id"), jwt_key_id(jwt)
+
+    def take(self, account_idx: int, jwt: str) -> Optional[str]:
+        """取出一个与当前账号代次匹配的空闲会话，没有则返回 None（并触发后台补充）"""
+        generation = self._generation(account_idx, jwt)
+        session_name = None
+        with self._lock:
+            self._last_used[account_idx] = time.time()
+            pool = self._pools.get(account_idx)
+            while pool:
+                name, session_generation = pool.popleft()
+                if session_generation == generation:
+                    session_name = name
+                    break
+                self._stats["discarded"] += 1
+            self._stats["hits" if session_name else "misses"] += 1
+        self._wakeup.set()
+        return session_name
+
+    def discard(self, account_idx: int):
+        """丢弃账号的所有空闲会话（账号冷却、不可用时调用）"""
+        with self._lock:
+            pool = self._pools.pop(account_idx, None)
+            if pool:
+                self._stats["discarded"] += len(pool)
+
+    def clear(self):
+        """丢弃所有空闲会话"""
+        with self._lock:
+            for pool in self._pools.values():
+                self._stats["discarded"] += len(pool)
+            self._pools.clear()
+
+    def get_stats(self) -> dict:
+        """获取会话池统计信息"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["pooled"] = sum(len(pool) for pool in self._pools.values())
+            stats["accounts"] = len(self._pools)
+        stats["target_size"] = self.get_target_size()
+        stats["running"] = bool(self._thread and self._thread.is_alive())
+        return stats
+
+    def _current_generation(self, account_idx: int) -> Optional[Generation]:
+        """账号状态中当前 JWT 的代次；JWT 已被丢弃、尚未重新获取时返回 None（代次未知）"""
+        state = account_manager.account_states.get(account_idx) or {}
+        jwt = state.get("jwt")
+        return self._generation(account_idx, jwt) if jwt else None
+
+    def _active_accounts(self) -> List[int]:
+        """近期取用过会话的账号；长期未使用的账号不再补充，并释放其空闲会话"""
+        now = time.time()
+        with self._lock:
+            inactive = [idx for idx, t in self._last_used.items() if now - t > SESSION_POOL_ACTIVE_SECONDS]
+            for idx in inactive:
+                del self._last_used[idx]
+                pool = self._pools.pop(idx, None)
+                if pool:
+                    self._stats["discarded"] += len(pool)
+            return list(self._last_used.keys())
+
+    def _refill_account(self, account_idx: int, target: int):
+        """将单个账号的会话池补充到目标深度"""
+        if account_idx >= len(account_manager.accounts) or not account_manager.is_account_available(account_idx):
+            self.discard(account_idx)
+            return
+
+        account = account_manager.accounts[account_idx]
+        jwt = ensure_jwt_for_account(account_idx, account, record_use=False)
+        # 代次取自本次用于创建会话的 JWT，而不是可能已被其他线程清空的账号状态
+        generation = self._generation(account_idx, jwt)
+        with self._lock:
+            pool = self._pools.setdefault(account_idx, deque())
+            # 丢弃凭证或签名材料更换前创建的会话
+            valid = [entry for entry in pool if entry[1] == generation]
+            self._stats["discarded"] += len(pool) - len(valid)
+            pool.clear()
+            pool.extend(valid)
+            missing = target - len(pool)
+        if missing <= 0:
+            return
+
+        from .utils import get_proxy
+        proxy = get_proxy()
+        for _ in range(missing):
+            if self._stop_event.is_set():
+                return
+            session_name = create_chat_session(jwt, account.get("team_id"), proxy, account_idx)
+            # 创建期间账号可能进入冷却或已更换凭证/签名材料，此时不再入池；
+            # 账号状态中的 JWT 暂时为空时代次未知，照常入池，取用时 take() 会再按代次核对
+            current = self._current_generation(account_idx)
+            if not account_manager.is_account_available(account_idx) or (current is not None and current != generation):
+                return
+            with self._lock:
+                self._pools.setdefault(account_idx, deque()).append((session_name, generation))
+                self._stats["created"] += 1
+
+    def _refill_loop(self):
+        """后台补充循环：被取用时唤醒，否则定期检查签名材料更换后的补充"""
+        from .logger import print
+
+        print(f"[会话池] 后台任务已启动，每个活跃账号预创建 {self.get_target_size()} 个会话")
+        while not self._stop_event.is_set():
+            self._wakeup.wait(_IDLE_SCAN_SECONDS)
+            self._wakeup.clear()
+            if self._stop_event.is_set():
+                break
+
+            target = self.get_target_size()
+            if target <= 0:
+                self.clear()
+                continue
+
+            for account_idx in self._active_accounts():
+                if self._stop_event.is_set():
+                    break
+                try:
+                    self._refill_account(account_idx, target)
+                except Exception as e:
+                    with self._lock:
+                        self._stats["failed"] += 1
+                    print(f"[会话池] 账号 {account_idx} 补充会话失败: {e}")
+        print("[会话池] 后台任务已停止")
+
+    def start(self):
+        """启动后台补充任务"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._refill_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止后台补充任务"""
+        self._stop_event.set()
+        self._wakeup.set()
+
+
+# 全局会话池实例
+session_pool = SessionPool()
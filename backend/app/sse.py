@@ -0,0 +1,257 @@
+"""SSE 编码模块 - 流式响应的 chat.completion.chunk 编码
+
+每个流创建一个 ChatChunkEncoder，id/object/created/model 等不变部分只编码一次，
+之后每个数据块只需要序列化 delta 内容；输出 bytes，安装了 orjson 时使用 orjson 序列化。
+StreamCoalescer 可按配置把连续的短文本块合并成一帧发送。
+"""
+
+import json
+import queue
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from .config import SSE_COALESCE_MAX_BYTES, SSE_COALESCE_WINDOW_MS, SSE_COALESCE_QUEUE_SIZE
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_BACKEND = "orjson" if orjson is not None else "json"
+
+# 流结束标记
+SSE_DONE = b"data: [DONE]\n\n"
+
+
+def dumps_json(value: Any) -> bytes:
+    """序列化为紧凑的 UTF-8 JSON（不转义非 ASCII 字符）"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+class ChatChunkEncoder:
+    """OpenAI 流式响应数据块编码器"""
+
+    def __init__(self, chat_id: str, created: int, model_name: str):
+        self.chat_id = chat_id
+        self.created = created
+        self.model_name = model_name
+        header = dumps_json({"id": chat_id, "object": "chat.completion.chunk", "created": created, "model": model_name})
+        # 'data: {"id":...,"model":...,"choices":[{"index":0,"delta":' + delta + ',"finish_reason":...}]}\n\n'
+        self._prefix = b"data: " + header[:-1] + b',"choices":[{"index":0,"delta":'
+        self._content_prefix = self._prefix + b'{"content":'
+        self._content_suffix = b'},"finish_reason":null}]}\n\n'
+        self._role_chunk = self._prefix + b'{"role":"assistant"},"finish_reason":null}]}\n\n'
+
+    def role(self) -> bytes:
+        """role 标记块"""
+        return self._role_chunk
+
+    def content(self, text: str) -> bytes:
+        """文本内容块"""
+        return self._content_prefix + dumps_json(text) + self._content_suffix
+
+    def content_literal(self, chunk: bytes) -> Optional[bytes]:
+        """若 chunk 是本编码器格式的文本内容块，返回其中已编码的 JSON 字符串，否则返回 None"""
+        if chunk.startswith(self._content_prefix) and chunk.endswith(self._content_suffix):
+            return chunk[len(self._content_prefix):len(chunk) - len(self._content_suffix)]
+        return None
+
+    def merged_content(self, literals: List[bytes]) -> bytes:
+        """把多个已编码的 JSON 字符串合并为一个文本内容块（无需重新序列化）"""
+        if len(literals) == 1:
+            literal = literals[0]
+        else:
+            literal = b'"' + b"".join(item[1:-1] for item in literals) + b'"'
+        return self._content_prefix + literal + self._content_suffix
+
+    def finish(self, reason: str = "stop") -> bytes:
+        """结束块（空 delta + finish_reason）"""
+        return self._prefix + b'{},"finish_reason":' + dumps_json(reason) + b"}]}\n\n"
+
+    def error(self, message: str, reason: Optional[str] = "stop") -> bytes:
+        """流中途出错时的结束块，附带 error 字段"""
+        chunk = {
+            "id": self.chat_id,
+            "object": "chat.completion.chunk",
+            "created": self.created,
+            "model": self.model_name,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": reason}],
+            "error": {"message": message}
+        }
+        return b"data: " + dumps_json(chunk) + b"\n\n"
+
+
+class _PumpError:
+    """读取线程中上游生成器抛出的异常"""
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+_PUMP_END = object()
+
+
+class StreamCoalescer:
+    """流式响应合并器
+
+    Gemini 经常连续返回很多很短的文本片段，每个片段单独一帧会带来额外的系统调用和代理 flush。
+    开启后由后台线程读取上游数据块，连续的文本内容块合并到达到 max_bytes 或等待满合并窗口后再发送；
+    第一个文本块总是立即发送以保证首字延迟，其它数据块（role、结束块等）发送前先清空已合并的文本。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {"streams": 0, "frames_in": 0, "frames_out": 0, "size_flushes": 0, "window_flushes": 0}
+
+    def get_settings(self, api_key_id: Optional[int] = None, user_agent: str = "") -> Optional[Tuple[int, float]]:
+        """按配置确定本次请求的合并参数，返回 (max_bytes, 窗口秒数)，未开启时返回 None
+
+        配置示例（后面的层级覆盖前面的层级：默认值 < 全局 < 客户端 < API Key）::
+
+            "sse_coalesce": {
+                "enabled": true, "max_bytes": 2048, "window_ms": 50,
+                "clients": {"cherry": {"window_ms": 100}},
+                "api_keys": {"3": {"enabled": false}}
+            }
+
+        clients 的键按 User-Agent 子串（不区分大小写）匹配，api_keys 的键为 API Key ID。
+        """
+        from .account_manager import account_manager
+
+        config = (account_manager.config or {}).get("sse_coalesce")
+        if not isinstance(config, dict):
+            return None
+        settings: Dict[str, Any] = {"enabled": False, "max_bytes": SSE_COALESCE_MAX_BYTES, "window_ms": SSE_COALESCE_WINDOW_MS}
+        layers = [config]
+        user_agent = (user_agent or "").lower()
+        for pattern, layer in (config.get("clients") or {}).items():
+            if pattern and pattern.lower() in user_agent:
+                layers.append(layer)
+                break
+        if api_key_id is not None:
+            layers.append((config.get("api_keys") or {}).get(str(api_key_id)))
+        for layer in layers:
+            if isinstance(layer, dict):
+                settings.update({key: layer[key] for key in ("enabled", "max_bytes", "window_ms") if key in layer})
+        try:
+            max_bytes = int(settings["max_bytes"])
+            window_seconds = float(settings["window_ms"]) / 1000
+        except (TypeError, ValueError):
+            return None
+        if not settings["enabled"] or max_bytes <= 0 or window_seconds <= 0:
+            return None
+        return max_bytes, window_seconds
+
+    def wrap(self, chunks: Iterator[bytes], encoder: ChatChunkEncoder,
+             settings: Optional[Tuple[int, float]]) -> Iterator[bytes]:
+        """包装上游数据块生成器；settings 为 None 时原样返回"""
+        if settings is None:
+            return chunks
+        with self._lock:
+            self._stats["streams"] += 1
+        return self._coalesce(chunks, encoder, *settings)
+
+    def _pump(self, chunks: Iterator[bytes], out: queue.Queue, stop: threading.Event):
+        """后台读取上游数据块放入队列；响应已关闭时停止读取并关闭上游生成器"""
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    out.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            for chunk in chunks:
+                if not put(chunk):
+                    break
+            else:
+                put(_PUMP_END)
+        except BaseException as e:
+            put(_PumpError(e))
+        finally:
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                try:
+                    close()
+                except Exception:
+                    pass
+
+    def _coalesce(self, chunks: Iterator[bytes], encoder: ChatChunkEncoder,
+                  max_bytes: int, window_seconds: float) -> Iterator[bytes]:
+        pending: queue.Queue = queue.Queue(maxsize=SSE_COALESCE_QUEUE_SIZE)
+        stop = threading.Event()
+        threading.Thread(target=self._pump, args=(chunks, pending, stop), daemon=True).start()
+
+        literals: List[bytes] = []
+        buffered_bytes = 0
+        deadline = 0.0
+        frames_in = frames_out = size_flushes = window_flushes = 0
+        first_sent = False
+        try:
+            while True:
+                timeout = max(0.0, deadline - time.monotonic()) if literals else None
+                try:
+                    item = pending.get(timeout=timeout)
+                except queue.Empty:
+                    # 合并窗口已到，上游暂时没有新数据
+                    window_flushes += 1
+                    frames_out += 1
+                    yield encoder.merged_content(literals)
+                    literals, buffered_bytes = [], 0
+                    continue
+
+                literal = encoder.content_literal(item) if isinstance(item, bytes) else None
+                if literal is None:
+                    if literals:
+                        frames_out += 1
+                        yield encoder.merged_content(literals)
+                        literals, buffered_bytes = [], 0
+                    if item is _PUMP_END:
+                        break
+                    if isinstance(item, _PumpError):
+                        raise item.error
+                    yield item
+                    continue
+
+                frames_in += 1
+                if not first_sent:
+                    # 第一个文本块立即发送，不影响首字延迟
+                    first_sent = True
+                    frames_out += 1
+                    yield item
+                    continue
+                if not literals:
+                    deadline = time.monotonic() + window_seconds
+                literals.append(literal)
+                buffered_bytes += len(literal)
+                if buffered_bytes >= max_bytes or time.monotonic() >= deadline:
+                    if buffered_bytes >= max_bytes:
+                        size_flushes += 1
+                    else:
+                        window_flushes += 1
+                    frames_out += 1
+                    yield encoder.merged_content(literals)
+                    literals, buffered_bytes = [], 0
+        finally:
+            stop.set()
+            with self._lock:
+                self._stats["frames_in"] += frames_in
+                self._stats["frames_out"] += frames_out
+                self._stats["size_flushes"] += size_flushes
+                self._stats["window_flushes"] += window_flushes
+
+    def get_stats(self) -> dict:
+        """获取合并统计信息"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats["json_backend"] = JSON_BACKEND
+        return stats
+
+
+# 全局流式响应合并器实例
+stream_coalescer = StreamCoalescer()
@@ -0,0 +1,62 @@
+"""上传缓冲模块 - multipart 上传的文件边接收边计算哈希，超过阈值后写入磁盘临时文件"""
+
+import hashlib
+from tempfile import SpooledTemporaryFile
+from typing import Optional
+
+from flask import Request
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from .config import UPLOAD_SPOOL_THRESHOLD, UPLOAD_MAX_BYTES
+
+# 使用缓冲文件和大小上限的上传接口，其它接口保持 werkzeug 默认的文件处理
+SPOOLED_UPLOAD_PATHS = frozenset({"/v1/files"})
+
+
+def get_upload_max_bytes() -> int:
+    """单个上传文件的大小上限（配置 upload_max_mb 覆盖，0 表示不限制）"""
+    from .account_manager import account_manager
+
+    if account_manager.config and "upload_max_mb" in account_manager.config:
+        try:
+            return max(0, int(float(account_manager.config["upload_max_mb"]) * 1024 * 1024))
+        except (TypeError, ValueError):
+            pass
+    return UPLOAD_MAX_BYTES
+
+
+class HashingSpooledFile(SpooledTemporaryFile):
+    """接收时同步计算 sha256 的缓冲文件
+
+    小文件保存在内存中，超过 UPLOAD_SPOOL_THRESHOLD 后自动转存到磁盘临时文件；
+    写入量超过上限时立即抛出 413，不再继续缓冲。
+    """
+
+    def __init__(self, max_bytes: int = 0):
+        super().__init__(max_size=UPLOAD_SPOOL_THRESHOLD)
+        self._sha256 = hashlib.sha256()
+        self._max_bytes = max_bytes
+        self.size = 0
+
+    def write(self, data) -> int:
+        self.size += len(data)
+        if self._max_bytes and self.size > self._max_bytes:
+            raise RequestEntityTooLarge(f"上传文件超过大小限制（{self._max_bytes // 1024 // 1024} MB）")
+        self._sha256.update(data)
+        return super().write(data)
+
+    def hexdigest(self) -> str:
+        return self._sha256.hexdigest()
+
+
+class SpooledUploadRequest(Request):
+    """/v1/files 上传中的文件部分写入 HashingSpooledFile，而不是 werkzeug 默认的临时文件/BytesIO
+
+    只对 SPOOLED_UPLOAD_PATHS 中的接口生效（包括大小上限），其它接口的表单解析不受影响。
+    """
+
+    def _get_file_stream(self, total_content_length: Optional[int], content_type: Optional[str],
+                         filename: Optional[str] = None, content_length: Optional[int] = None):
+        if self.path not in SPOOLED_UPLOAD_PATHS:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        return HashingSpooledFile(get_upload_max_bytes())
@@ -0,0 +1,209 @@
+"""远程图片缓存模块 - 缓存 image_url 输入的下载结果，遵循 Cache-Control/ETag 并支持条件请求重新验证"""
+
+import re
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional, Tuple
+
+from .config import URL_IMAGE_CACHE_MAX_BYTES, URL_IMAGE_CACHE_MAX_OBJECT_BYTES, MEDIA_STREAM_CHUNK_SIZE
+
+# 只有 Last-Modified 时的启发式新鲜期：距上次修改时间的 10%，最长 1 天
+_HEURISTIC_FRACTION = 0.1
+_HEURISTIC_MAX_SECONDS = 86400
+
+
+class _CachedImage:
+    """缓存条目"""
+
+    def __init__(self, data: bytes, mime_type: str, etag: Optional[str], last_modified: Optional[str],
+                 fresh_until: float):
+        self.data = data
+        self.mime_type = mime_type
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fresh_until = fresh_until
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+
+class _DownloadFlight:
+    """同一 URL 进行中的下载（single-flight），并发调用者共享其结果或异常"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Optional[Tuple[bytes, str]] = None
+        self.error: Optional[BaseException] = None
+
+
+def _parse_cache_control(value: str) -> Dict[str, Optional[str]]:
+    directives = {}
+    for part in value.split(","):
+        name, _, arg = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = arg.strip('"') if arg else None
+    return directives
+
+
+def _freshness_seconds(headers) -> Optional[float]:
+    """根据响应头计算新鲜期（秒）；返回 None 表示不可缓存，0 表示每次使用前都需要重新验证
+
+    本服务的缓存在所有用户之间共享，因此 private 与 no-store 一样不缓存，s-maxage 优先于 max-age。
+    """
+    cc = _parse_cache_control(headers.get("Cache-Control", ""))
+    if "no-store" in cc or "private" in cc:
+        return None
+    vary = {v.strip().lower() for v in headers.get("Vary", "").split(",") if v.strip()}
+    if vary - {"accept-encoding"}:
+        return None
+    if "no-cache" in cc:
+        return 0
+    for key in ("s-maxage", "max-age"):
+        if cc.get(key) and re.fullmatch(r"\d+", cc[key]):
+            return float(cc[key])
+    now = time.time()
+    try:
+        if headers.get("Expires"):
+            return max(0.0, parsedate_to_datetime(headers["Expires"]).timestamp() - now)
+        if headers.get("Last-Modified"):
+            age = now - parsedate_to_datetime(headers["Last-Modified"]).timestamp()
+            return min(_HEURISTIC_MAX_SECONDS, max(0.0, age * _HEURISTIC_FRACTION))
+    except (TypeError, ValueError):
+        # 无法解析的日期按已过期处理
+        return 0
+    return 0
+
+
+class URLImageCache:
+    """远程图片缓存
+
+    条目保存在内存中，按总字节数做 LRU 淘汰，超过单个对象上限的图片不缓存；
+    过期条目带上 If-None-Match / If-Modified-Since 重新验证，304 时直接复用；
+    同一 URL 的并发下载合并为一次。
+    """
+
+    def __init__(self, max_bytes: int = URL_IMAGE_CACHE_MAX_BYTES, max_object_bytes: int = URL_IMAGE_CACHE_MAX_OBJECT_BYTES):
+        self.max_bytes = max_bytes
+        self.max_object_bytes = max_object_bytes
+        self._entries: "OrderedDict[str, _CachedImage]" = OrderedDict()
+        self._total_bytes = 0
+        self._flights: Dict[str, _DownloadFlight] = {}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "revalidated": 0, "coalesced": 0, "stored": 0,
+                       "evicted": 0, "uncacheable": 0, "too_large": 0}
+
+    def _count(self, key: str):
+        with self._lock:
+            self._stats[key] += 1
+
+    def fetch(self, url: str, proxy: Optional[str] = None) -> Tuple[bytes, str]:
+        """获取图片，返回 (图片数据, mime_type)"""
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None and entry.fresh_until > time.time():
+                self._entries.move_to_end(url)
+                self._stats["hits"] += 1
+                return entry.data, entry.mime_type
+            flight = self._flights.get(url)
+            is_leader = flight is None
+            if is_leader:
+                flight = _DownloadFlight()
+                self._flights[url] = flight
+            else:
+                self._stats["coalesced"] += 1
+
+        if not is_leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self._download(url, proxy, entry)
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(url, None)
+            flight.done.set()
+
+    def _download(self, url: str, proxy: Optional[str], stale: Optional[_CachedImage]) -> Tuple[bytes, str]:
+        from .http_client import get_http_client
+
+        headers = {}
+        if stale is not None:
+            if stale.etag:
+                headers["If-None-Match"] = stale.etag
+            if stale.last_modified:
+                headers["If-Modified-Since"] = stale.last_modified
+
+        with get_http_client(proxy).get(url, headers=headers, verify=False, timeout=60, stream=True) as resp:
+            if resp.status_code == 304 and stale is not None:
+                freshness = _freshness_seconds(resp.headers)
+                with self._lock:
+                    self._stats["revalidated"] += 1
+                    if url in self._entries:
+                        stale.fresh_until = time.time() + (freshness or 0)
+                        stale.etag = resp.headers.get("ETag", stale.etag)
+                        stale.last_modified = resp.headers.get("Last-Modified", stale.last_modified)
+                        self._entries.move_to_end(url)
+                return stale.data, stale.mime_type
+            resp.raise_for_status()
+
+            content_type = resp.headers.get("Content-Type", "image/png")
+            # 提取主mime类型
+            mime_type = content_type.split(";")[0].strip()
+            data = b"".join(resp.iter_content(MEDIA_STREAM_CHUNK_SIZE))
+            freshness = _freshness_seconds(resp.headers)
+            etag = resp.headers.get("ETag")
+            last_modified = resp.headers.get("Last-Modified")
+
+        self._count("misses")
+        if freshness is None or (freshness == 0 and not etag and not last_modified):
+            # 不允许缓存，或者既不新鲜也无法重新验证
+            self._count("uncacheable")
+            self._remove(url)
+        elif len(data) > self.max_object_bytes or len(data) > self.max_bytes:
+            self._count("too_large")
+            self._remove(url)
+        else:
+            self._store(url, _CachedImage(data, mime_type, etag, last_modified, time.time() + freshness))
+        return data, mime_type
+
+    def _remove(self, url: str):
+        with self._lock:
+            entry = self._entries.pop(url, None)
+            if entry is not None:
+                self._total_bytes -= entry.size
+
+    def _store(self, url: str, entry: _CachedImage):
+        with self._lock:
+            old = self._entries.pop(url, None)
+            if old is not None:
+                self._total_bytes -= old.size
+            self._entries[url] = entry
+            self._total_bytes += entry.size
+            self._stats["stored"] += 1
+            while self._total_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._total_bytes -= evicted.size
+                self._stats["evicted"] += 1
+
+    def get_stats(self) -> dict:
+        """获取缓存统计信息"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["total_bytes"] = self._total_bytes
+        stats["max_bytes"] = self.max_bytes
+        stats["max_object_bytes"] = self.max_object_bytes
+        return stats
+
+
+# 全局远程图片缓存实例
+url_image_cache = URLImageCache()
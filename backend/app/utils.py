@@ -3,7 +3,7 @@
 import requests
 from typing import Optional
 
-from .exceptions import AccountAuthError, AccountRateLimitError, AccountRequestError
+from .exceptions import AccountAuthError, AccountRateLimitError, AccountRequestError, AccountJwtRejectedError
 
 
 def check_proxy(proxy: str) -> bool:
@@ -53,7 +53,8 @@ def get_proxy() -> Optional[str]:
     return proxy
 
 
-def raise_for_account_response(resp: requests.Response, action: str, account_idx: Optional[int] = None, quota_type: Optional[str] = None):
+def raise_for_account_response(resp: requests.Response, action: str, account_idx: Optional[int] = None, quota_type: Optional[str] = None,
+                               jwt_auth: bool = True):
     """根据响应状态码抛出相应的账号异常，并被动检测配额错误
     
     Args:
@@ -61,6 +62,7 @@ def raise_for_account_response(resp: requests.Response, action: str, account_idx
         action: 操作名称（用于错误消息）
         account_idx: 账号索引（用于标记配额错误）
         quota_type: 配额类型（"images", "videos", "text_queries"），用于按类型冷却
+        jwt_auth: 请求是否使用 JWT 认证（getoxsrf 使用 Cookie 认证，其 401 与缓存的签名材料无关）
     """
     status = resp.status_code
     try:
@@ -73,6 +75,13 @@ def raise_for_account_response(resp: requests.Response, action: str, account_idx
     if account_idx is not None:
         msg = f"账号 {account_idx} {msg}"
     
+    # 401 可能是本地缓存的 xsrf 签名材料已失效：丢弃缓存后抛出 AccountJwtRejectedError，
+    # 由调用方不冷却账号、重新请求 getoxsrf 后用同一账号重试，而不是直接判定凭证失效
+    if account_idx is not None and status == 401 and jwt_auth:
+        from .jwt_utils import invalidate_xsrf_key
+        if invalidate_xsrf_key(account_idx):
+            raise AccountJwtRejectedError(f"{msg}（签名材料已过期，已丢弃缓存）", status)
+    
     # 被动检测配额错误：检测到 401, 403, 429 时标记账号配额错误
     # 429 通常是配额错误，按配额类型冷却；401/403 是认证错误，冷却整个账号
     if account_idx is not None and status in (401, 403, 429):
@@ -0,0 +1,137 @@
+"""cfbed 流式上传基准测试 - 对比旧版（先拼接完整文件再用 files= 上传）与 upload_file_streaming_to_cfbed 的内存峰值和吞吐量
+
+用法（在 backend 目录下运行）::
+
+    python bench/bench_cfbed_upload.py               # 默认 100 MB
+    python bench/bench_cfbed_upload.py --size-mb 300
+
+在本机启动一个读取并丢弃请求体的 HTTP 服务模拟 cfbed，Gemini 的媒体下载由逐块生成数据的假响应模拟；
+内存峰值由 tracemalloc 统计（只包含 Python 分配的内存）。流式上传分别测试下载声明了
+Content-Length（上传给出准确长度）和未声明（分块传输编码）两种情况，并确认服务端收到的字节数一致。
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.cfbed_upload import upload_file_streaming_to_cfbed, upload_to_cfbed  # noqa: E402
+from app.config import MEDIA_STREAM_CHUNK_SIZE  # noqa: E402
+
+# 本机服务不经过环境变量中的代理
+os.environ["NO_PROXY"] = "127.0.0.1,localhost"
+
+
+class SinkHandler(BaseHTTPRequestHandler):
+    """模拟 cfbed：读取并丢弃请求体（支持 Content-Length 和分块传输编码），在 src 中返回收到的字节数"""
+
+    def _read(self, size: int) -> int:
+        received = 0
+        while received < size:
+            data = self.rfile.read(min(size - received, 1 << 20))
+            if not data:
+                break
+            received += len(data)
+        return received
+
+    def do_POST(self):
+        received = 0
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                size = int(self.rfile.readline().split(b";", 1)[0], 16)
+                received += self._read(size)
+                self.rfile.readline()
+                if size == 0:
+                    break
+        else:
+            received = self._read(int(self.headers.get("Content-Length") or 0))
+        body = json.dumps([{"src": f"/file/{received}"}]).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeDownload:
+    """模拟 Gemini 媒体下载的 requests.Response：按需生成数据，不在内存中保存完整文件"""
+
+    def __init__(self, size: int, declare_length: bool = True):
+        self.size = size
+        self.headers = {"Content-Type": "video/mp4"}
+        if declare_length:
+            self.headers["Content-Length"] = str(size)
+        self._block = bytes(range(256)) * (MEDIA_STREAM_CHUNK_SIZE // 256 + 1)
+
+    def iter_content(self, chunk_size: int = MEDIA_STREAM_CHUNK_SIZE):
+        remaining = self.size
+        while remaining > 0:
+            n = min(chunk_size, remaining, len(self._block))
+            # 每块都是新分配的 bytes，与真实下载一致
+            yield bytes(self._block[:n])
+            remaining -= n
+
+    def close(self):
+        pass
+
+
+def legacy_upload(file_stream, filename, mime_type, endpoint, api_token, proxy=None):
+    """旧版实现：先把下载内容全部读入内存并拼接，再交给 requests 构造 multipart 请求体"""
+    try:
+        chunks = []
+        for chunk in file_stream.iter_content(chunk_size=MEDIA_STREAM_CHUNK_SIZE):
+            if chunk:
+                chunks.append(chunk)
+        file_data = b"".join(chunks)
+        return upload_to_cfbed(file_data=file_data, filename=filename, mime_type=mime_type,
+                               endpoint=endpoint, api_token=api_token, proxy=proxy)
+    finally:
+        file_stream.close()
+
+
+def measure(name: str, upload, endpoint: str, size: int, declare_length: bool):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = upload(FakeDownload(size, declare_length), "bench.mp4", "video/mp4", endpoint, "token")
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    received = int(result["src"].rsplit("/", 1)[1])
+    print(f"{name:<34} 峰值内存 {peak / 2**20:8.1f} MB   耗时 {elapsed:6.2f} s   "
+          f"{size / 2**20 / elapsed:7.1f} MB/s   服务端收到 {received / 2**20:.1f} MB")
+    return received
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=100, help="模拟媒体文件大小（MB）")
+    args = parser.parse_args()
+    size = args.size_mb * 2**20
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SinkHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = f"http://127.0.0.1:{server.server_address[1]}/upload"
+
+    print(f"文件大小 {args.size_mb} MB，下载块大小 {MEDIA_STREAM_CHUNK_SIZE // 1024} KB")
+    received = [
+        measure("旧版（拼接后 files= 上传）", legacy_upload, endpoint, size, True),
+        measure("流式（Content-Length）", upload_file_streaming_to_cfbed, endpoint, size, True),
+        measure("流式（分块传输编码）", upload_file_streaming_to_cfbed, endpoint, size, False),
+    ]
+    # multipart 边界长度不同，各实现的请求体只应相差几百字节
+    assert max(received) - min(received) < 1024 and min(received) > size, received
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
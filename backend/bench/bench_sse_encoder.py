@@ -0,0 +1,84 @@
+"""SSE 编码基准测试 - 对比旧版（每块构造完整 dict 并 json.dumps 为 str）与 ChatChunkEncoder 的编码速度
+
+用法（在 backend 目录下运行）::
+
+    python bench/bench_sse_encoder.py              # 默认 200000 个文本块
+    python bench/bench_sse_encoder.py -n 500000
+
+分别测试标准库 json 和 orjson（已安装时）两种后端，输出每秒编码的数据块数，
+并确认两种实现输出的数据块解码后内容一致。
+"""
+
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app import sse  # noqa: E402
+from app.sse import ChatChunkEncoder  # noqa: E402
+
+CHAT_ID = "chatcmpl-1a2b3c4d"
+CREATED = 1760000000
+MODEL = "gemini-2.5-pro"
+
+
+def legacy_content_chunk(text: str) -> str:
+    """旧版实现：每个数据块构造完整的 chat.completion.chunk 并序列化"""
+    chunk = {
+        "id": CHAT_ID,
+        "object": "chat.completion.chunk",
+        "created": CREATED,
+        "model": MODEL,
+        "choices": [{"index": 0, "delta": {"content": text}, "finish_reason": None}]
+    }
+    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+
+
+def build_deltas(count: int):
+    """中英文混合的短文本片段，接近实际的流式 token 长度"""
+    samples = ["Hello", " world", "，这是", "一个测试", " with \"quotes\"", "\n\n", "换行\t制表", " 😀", "x" * 40, "中文" * 10]
+    return [samples[i % len(samples)] + str(i % 97) for i in range(count)]
+
+
+def measure(func, deltas) -> float:
+    start = time.perf_counter()
+    for text in deltas:
+        func(text)
+    return len(deltas) / (time.perf_counter() - start)
+
+
+def bench_backend(name: str, deltas):
+    encoder = ChatChunkEncoder(CHAT_ID, CREATED, MODEL)
+    for text in deltas[:1000]:
+        old = json.loads(legacy_content_chunk(text)[len("data: "):])
+        new = json.loads(encoder.content(text)[len(b"data: "):])
+        assert old == new, "新旧编码结果不一致"
+
+    before = measure(legacy_content_chunk, deltas)
+    after = measure(encoder.content, deltas)
+    print(f"{name:<8} before {before:12,.0f} chunks/s   after {after:12,.0f} chunks/s   ({after / before:.1f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--chunks", type=int, default=200000, help="编码的文本块数量")
+    args = parser.parse_args()
+
+    deltas = build_deltas(args.chunks)
+    orjson = sse.orjson
+    try:
+        sse.orjson = None
+        bench_backend("json", deltas)
+    finally:
+        sse.orjson = orjson
+    if orjson is not None:
+        bench_backend("orjson", deltas)
+    else:
+        print("orjson   未安装，跳过（pip install orjson）")
+
+
+if __name__ == "__main__":
+    main()
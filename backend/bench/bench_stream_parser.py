@@ -0,0 +1,172 @@
+"""JSONStreamParser 基准测试 - 对比旧版（每个对象复制剩余缓冲区）与游标实现的解析耗时
+
+用法（在 backend 目录下运行）::
+
+    python bench/bench_stream_parser.py                      # 合成的多 MB streamAssistResponse
+    python bench/bench_stream_parser.py --sizes 1 2 4 8      # 指定合成响应大小（MB）
+    python bench/bench_stream_parser.py --response dump.json # 使用录制的上游响应（streamAssist 原始响应体）
+
+未指定录制响应时使用合成响应：带内联图片的响应、紧凑排版的短文本，以及按上游格式（缩进排版、
+带 sessionInfo 和思考片段）生成的文本回答。每种响应分别按小块（模拟网络逐块到达）和整块（一个 chunk 中包含大量对象）两种方式输入，
+并确认新旧实现解析出的对象完全一致。旧实现超过 --old-limit 秒后不再测试更大的响应。
+"""
+
+import argparse
+import base64
+import gc
+import json
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Iterable, List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.chat_handler import JSONStreamParser  # noqa: E402
+
+
+class LegacyJSONStreamParser:
+    """旧版实现：每解析一个对象或分隔符都 lstrip/切片整个剩余缓冲区"""
+
+    def __init__(self):
+        self.buffer = ""
+        self.decoder = json.JSONDecoder()
+
+    def decode(self, chunk: str) -> List[dict]:
+        self.buffer += chunk
+        results = []
+        while True:
+            self.buffer = self.buffer.lstrip()
+            if self.buffer.startswith("[") or self.buffer.startswith(","):
+                self.buffer = self.buffer[1:]
+                continue
+            if not self.buffer:
+                break
+            try:
+                obj, idx = self.decoder.raw_decode(self.buffer)
+                results.append(obj)
+                self.buffer = self.buffer[idx:]
+            except json.JSONDecodeError:
+                break
+        return results
+
+
+def build_image_response(size_mb: float, image_kb: int = 256) -> str:
+    """合成带内联 base64 图片的 streamAssistResponse 数组（文本片段与图片交替）"""
+    image = base64.b64encode(os.urandom(image_kb * 1024 * 3 // 4)).decode()
+    objects = []
+    total = 0
+    i = 0
+    while total < size_mb * 1024 * 1024:
+        text = {"streamAssistResponse": {"answer": {"replies": [
+            {"groundedContent": {"content": {"text": f"第 {i} 段回答 chunk {i} " * 4}}}]}}}
+        inline = {"streamAssistResponse": {"answer": {"replies": [
+            {"groundedContent": {"content": {"inlineData": {"mimeType": "image/png", "data": image}}}}]}}}
+        for obj in (text, inline):
+            encoded = json.dumps(obj, ensure_ascii=False)
+            objects.append(encoded)
+            total += len(encoded)
+        i += 1
+    return "[" + ",\n".join(objects) + "]"
+
+
+def build_text_response(size_mb: float) -> str:
+    """合成只包含大量短文本片段的响应数组"""
+    objects = []
+    total = 0
+    i = 0
+    while total < size_mb * 1024 * 1024:
+        encoded = json.dumps({"streamAssistResponse": {"answer": {"replies": [
+            {"groundedContent": {"content": {"text": f"token {i} 文本"}}}]}}}, ensure_ascii=False)
+        objects.append(encoded)
+        total += len(encoded)
+        i += 1
+    return "[" + ",\n".join(objects) + "]"
+
+
+def build_upstream_text_response(size_mb: float) -> str:
+    """合成与上游文本回答格式一致的响应：缩进排版、带 sessionInfo，并夹杂思考片段"""
+    session = "projects/123456789/locations/global/collections/default_collection/engines/agentspace-engine/sessions/9876543210"
+    objects = []
+    total = 0
+    i = 0
+    while total < size_mb * 1024 * 1024:
+        content = {"role": "model", "text": f"第 {i} 个片段，token {i} 文本。"}
+        if i % 5 == 0:
+            content["thought"] = True
+        encoded = json.dumps({"streamAssistResponse": {
+            "answer": {"state": "IN_PROGRESS", "replies": [
+                {"groundedContent": {"content": content}, "replyId": f"reply-{i // 50}"}]},
+            "sessionInfo": {"session": session},
+            "assistToken": "a1b2c3d4e5f6"}}, ensure_ascii=False, indent=2)
+        objects.append(encoded)
+        total += len(encoded)
+        i += 1
+    return "[" + ",\n".join(objects) + "]"
+
+
+def split_chunks(data: str, chunk_size: int) -> List[str]:
+    return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+
+def run_parser(factory: Callable, chunks: Iterable[str], repeat: int = 1):
+    """运行 repeat 次，返回最短耗时和解析结果（计时期间关闭 GC，避免累积的解析结果触发回收影响计时）"""
+    best = float("inf")
+    for _ in range(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            parser = factory()
+            start = time.perf_counter()
+            objects = []
+            for chunk in chunks:
+                objects.extend(parser.decode(chunk))
+            best = min(best, time.perf_counter() - start)
+        finally:
+            gc.enable()
+    return best, objects
+
+
+def bench_case(label: str, data: str, chunk_size: int, run_old: bool, repeat: int) -> float:
+    chunks = split_chunks(data, chunk_size) if chunk_size else [data]
+    new_seconds, new_objects = run_parser(JSONStreamParser, chunks, repeat)
+    line = f"{label:<34} {len(data) / 1024 / 1024:7.1f} MB  {len(new_objects):7d} 个对象  new {new_seconds * 1000:9.1f} ms"
+    old_seconds = 0.0
+    if run_old:
+        old_seconds, old_objects = run_parser(LegacyJSONStreamParser, chunks, repeat)
+        assert old_objects == new_objects, "新旧解析结果不一致"
+        line += f"  old {old_seconds * 1000:10.1f} ms  ({old_seconds / max(new_seconds, 1e-9):.2f}x)"
+    else:
+        line += "  old      (跳过)"
+    print(line)
+    return old_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1, 2, 4, 8, 16], help="合成响应大小（MB）")
+    parser.add_argument("--chunk-size", type=int, default=512, help="逐块输入时每块的字符数")
+    parser.add_argument("--response", type=Path, nargs="*", default=[], help="录制的上游响应文件（JSON 数组文本）")
+    parser.add_argument("--repeat", type=int, default=3, help="每个用例重复次数，取最短耗时")
+    parser.add_argument("--old-limit", type=float, default=10.0, help="旧实现单次耗时超过该秒数后跳过更大的用例")
+    args = parser.parse_args()
+
+    cases = [(f"录制 {path.name}", path.read_text(encoding="utf-8")) for path in args.response]
+    if not cases:
+        cases = [(f"内联图片 {size:g} MB", build_image_response(size)) for size in args.sizes]
+        cases += [(f"短文本 {size:g} MB", build_text_response(size)) for size in args.sizes]
+        cases += [(f"上游格式文本 {size:g} MB", build_upstream_text_response(size)) for size in args.sizes]
+
+    for chunk_size, title in ((args.chunk_size, f"逐块输入（{args.chunk_size} 字符/块）"), (0, "整块输入")):
+        print(f"\n== {title} ==")
+        run_old = {}
+        for label, data in cases:
+            kind = label.split()[0]
+            seconds = bench_case(label, data, chunk_size, run_old.get(kind, True), args.repeat)
+            if seconds > args.old_limit:
+                run_old[kind] = False
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+"""测试配置：数据目录指向临时目录，避免写入项目目录中的配置和数据库"""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="gemini-2api-test-"))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
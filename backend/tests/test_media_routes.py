@@ -0,0 +1,102 @@
+"""缓存媒体接口的集成测试：ETag、条件请求、Cache-Control 和反向代理转发"""
+
+import hashlib
+
+import pytest
+from flask import Flask
+
+from app import routes
+from app.account_manager import account_manager
+from app.media_cache import MediaCache
+
+PNG_BYTES = b"\x89PNG\r\n\x1a\n" + b"test-image" * 100
+
+
+@pytest.fixture
+def media(tmp_path, monkeypatch):
+    cache = MediaCache(tmp_path / "image", "图片", 3600, 0, "image_cache_max_mb")
+    cache.load()
+    filename = cache.store_bytes(PNG_BYTES, "sample.png")
+
+    monkeypatch.setattr(routes, "image_cache", cache)
+    monkeypatch.setattr(routes, "DATA_DIR", tmp_path)
+    monkeypatch.setattr(account_manager, "config", {})
+
+    app = Flask(__name__)
+    routes.register_routes(app)
+    return app.test_client(), cache, filename
+
+
+def test_serves_file_with_etag_and_cache_control(media):
+    client, cache, filename = media
+
+    resp = client.get(f"/image/{filename}")
+
+    assert resp.status_code == 200
+    assert resp.data == PNG_BYTES
+    assert resp.mimetype == "image/png"
+    assert resp.headers["ETag"] == f'"{hashlib.sha256(PNG_BYTES).hexdigest()}"'
+    assert resp.headers["Cache-Control"] == "public, max-age=3600, immutable"
+    assert cache.get_stats()["responses_full"] == 1
+
+
+def test_if_none_match_returns_304(media):
+    client, cache, filename = media
+    etag = client.get(f"/image/{filename}").headers["ETag"]
+
+    resp = client.get(f"/image/{filename}", headers={"If-None-Match": etag})
+
+    assert resp.status_code == 304
+    assert resp.data == b""
+    assert resp.headers["ETag"] == etag
+    assert cache.get_stats()["responses_not_modified"] == 1
+
+
+def test_range_request_returns_partial_content(media):
+    client, _, filename = media
+
+    resp = client.get(f"/image/{filename}", headers={"Range": "bytes=0-7"})
+
+    assert resp.status_code == 206
+    assert resp.data == PNG_BYTES[:8]
+    assert resp.headers["Content-Range"] == f"bytes 0-7/{len(PNG_BYTES)}"
+
+
+def test_x_accel_offload_returns_internal_redirect(media):
+    client, cache, filename = media
+    account_manager.config["media_offload_mode"] = "x-accel"
+
+    resp = client.get(f"/image/{filename}")
+
+    digest = hashlib.sha256(PNG_BYTES).hexdigest()
+    assert resp.status_code == 200
+    assert resp.data == b""
+    assert resp.mimetype == "image/png"
+    assert resp.headers["X-Accel-Redirect"] == f"/_media_cache/image/objects/{digest[:2]}/{digest[2:4]}/{digest}.png"
+    assert resp.headers["Cache-Control"] == "public, max-age=3600, immutable"
+    assert cache.get_stats()["responses_offloaded"] == 1
+
+
+def test_x_accel_offload_uses_configured_prefix(media):
+    client, _, filename = media
+    account_manager.config.update({"media_offload_mode": "x-accel", "media_offload_prefix": "/internal/"})
+
+    resp = client.get(f"/image/{filename}")
+
+    assert resp.headers["X-Accel-Redirect"].startswith("/internal/image/objects/")
+
+
+def test_x_sendfile_offload_returns_absolute_path(media):
+    client, cache, filename = media
+    account_manager.config["media_offload_mode"] = "x-sendfile"
+
+    resp = client.get(f"/image/{filename}")
+
+    assert resp.headers["X-Sendfile"] == str(cache.path_for(filename).resolve())
+    assert "X-Accel-Redirect" not in resp.headers
+
+
+def test_unknown_file_returns_404(media):
+    client, _, _ = media
+
+    assert client.get("/image/missing.png").status_code == 404
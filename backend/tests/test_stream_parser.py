@@ -0,0 +1,48 @@
+"""JSONStreamParser 测试：任意切块方式下都能解析出与整体解析相同的对象"""
+
+import json
+import random
+
+import pytest
+
+from app.chat_handler import JSONStreamParser
+
+OBJECTS = [
+    {"streamAssistResponse": {"answer": {"replies": [{"groundedContent": {"content": {"text": "你好，{世界}]"}}}]}}},
+    {"streamAssistResponse": {"sessionInfo": {"session": "sessions/123"}}},
+    {"streamAssistResponse": {"answer": {"replies": [{"groundedContent": {"content": {"text": "[,] \" \\ }"}}}]}}},
+    {"streamAssistResponse": {"answer": {"replies": [
+        {"groundedContent": {"content": {"inlineData": {"mimeType": "image/png", "data": "QUJD" * 5000}}}}]}}},
+]
+
+
+def _parse(chunks):
+    parser = JSONStreamParser()
+    results = []
+    for chunk in chunks:
+        results.extend(parser.decode(chunk))
+    return results
+
+
+@pytest.mark.parametrize("indent", [None, 2])
+@pytest.mark.parametrize("seed", range(20))
+def test_random_chunking_matches_whole_document(indent, seed):
+    data = "[" + ",\n".join(json.dumps(obj, ensure_ascii=False, indent=indent) for obj in OBJECTS * 3) + "]"
+    rng = random.Random(seed)
+    chunks = []
+    pos = 0
+    while pos < len(data):
+        size = rng.choice([1, 2, 7, 64, 512, 4096])
+        chunks.append(data[pos:pos + size])
+        pos += size
+
+    assert _parse(chunks) == OBJECTS * 3
+
+
+def test_incomplete_object_is_returned_once_complete():
+    parser = JSONStreamParser()
+
+    assert parser.decode('[{"a": 1}, {"b": ') == [{"a": 1}]
+    assert parser.decode('"x"') == []
+    assert parser.decode("}") == [{"b": "x"}]
+    assert parser.decode("]") == []